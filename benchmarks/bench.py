@@ -0,0 +1,366 @@
+"""
+Benchmarks of the generation pipeline. Every stage is timed for a grid of prop counts, instance counts and
+resolutions, results are written as JSON and can be compared against a baseline from an earlier run.
+
+Without Blender the stand-ins of fake_bpy are used: the pure Python paths (scene building code, pose sampling, layout,
+labelling, image encoding) are timed, rendering is skipped. Inside Blender the real stages are timed on the CPU too:
+
+    python benchmarks/bench.py --output results.json
+    blender --background --factory-startup --python benchmarks/bench.py -- --output results.json
+    python benchmarks/bench.py --baseline results.json
+"""
+import argparse
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+THIS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(THIS_PATH)
+for path in (REPO_PATH, THIS_PATH):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+try:
+    import bpy
+
+    FAKE_BPY = False
+except ModuleNotFoundError:
+    import fake_bpy
+
+    bpy = fake_bpy.install()
+    FAKE_BPY = True
+
+import json  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+from blendgen.appearance import sample_appearance  # noqa: E402
+from blendgen.blender_objects import AppearancePool, Camera, Grid, Light, RandomLayout  # noqa: E402
+from blendgen.dataset import ShardWriter  # noqa: E402
+from blendgen.geometry import annotate_geometry  # noqa: E402
+from blendgen.labels import annotate_mask, mask_rle  # noqa: E402
+from blendgen.layout import sample_layout  # noqa: E402
+from blendgen.profiles import FLAT_SEGMENTATION, apply_profile, swap_profile  # noqa: E402
+from blendgen.render import apply_pose, visibility_scorer  # noqa: E402
+from blendgen.sampling import sample_poses  # noqa: E402
+from blendgen.utils import (  # noqa: E402
+    cameraIntrinsics,
+    deleteScene,
+    exactColorSettings,
+    importProps,
+    joinMeshes,
+    newScene,
+    redirectOutputEnd,
+    redirectOutputStart,
+    restoreColorSettings,
+    setSegmentationColors,
+    templateVertices,
+)
+from blendgen.visibility import load_visibility_policy  # noqa: E402
+from blendgen.writer import AsyncImageWriter, encode_png, to_uint8  # noqa: E402
+
+FULL_CASES = {"n_props": [1, 8], "n_instances": [8, 64, 512], "resolution": [128, 350, 1024], "n_objects": [8, 64]}
+QUICK_CASES = {"n_props": [1], "n_instances": [8, 64], "resolution": [128, 350], "n_objects": [8]}
+
+
+class Results:
+    def __init__(self, repeats: int) -> None:
+        self.repeats = repeats
+        self.records = []
+
+    def time(self, stage: str, params: dict, function, setup=None, repeats: int = None) -> float:
+        """Runs setup() then times function(*setup()), repeats times. Returns the median in seconds."""
+        times = []
+        for _ in range(self.repeats if repeats is None else repeats):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            function(*args)
+            times.append(time.perf_counter() - start)
+        record = {
+            "stage": stage,
+            "params": params,
+            "median": statistics.median(times),
+            "min": min(times),
+            "repeats": len(times),
+        }
+        self.records.append(record)
+        print(f"{stage:>28} {json.dumps(params):<55} {record['median'] * 1000:10.3f} ms")
+        return record["median"]
+
+
+def record_key(record: dict) -> str:
+    return record["stage"] + " " + json.dumps(record["params"], sort_keys=True)
+
+
+def compare(records: list, baseline: list, tolerance: float) -> list:
+    """Records whose median is more than tolerance slower than the same stage and params in baseline."""
+    baseline_median = {record_key(record): record["median"] for record in baseline}
+    regressions = []
+    for record in records:
+        previous = baseline_median.get(record_key(record))
+        if previous is not None and record["median"] > previous * (1 + tolerance):
+            regressions.append({**record, "baseline": previous, "ratio": record["median"] / previous})
+    return regressions
+
+
+def fresh_scene(prop_path: str, n_props: int) -> list:
+    """New scene with n_props templates, returns their names."""
+    if FAKE_BPY:
+        fake_bpy.reset()
+        newScene()
+        return [fake_bpy.add_template(f"prop_{idx}", seed=idx).name for idx in range(n_props)]
+    newScene()
+    return importProps(prop_path)[:n_props]
+
+
+def synthetic_mask(rng: np.random.Generator, n_instances: int, resolution: int) -> np.ndarray:
+    """(resolution, resolution) instance ids of overlapping random rectangles."""
+    ids = np.zeros((resolution, resolution), dtype=np.int64)
+    for instance_id in range(1, n_instances + 1):
+        x, y = rng.integers(0, resolution, size=2)
+        width, height = rng.integers(1, max(2, resolution // 4), size=2)
+        ids[y : y + height, x : x + width] = instance_id
+    return ids
+
+
+def bench_scene(results: Results, prop_path: str, n_props: int, n_instances: int, resolutions: list) -> None:
+    params = {"n_props": n_props, "n_instances": n_instances}
+    results.time("newScene", params, newScene)
+    if not FAKE_BPY:
+        results.time("importProps", params, lambda: fresh_scene(prop_path, n_props), repeats=1)
+
+    names = fresh_scene(prop_path, n_props)
+    encoding = "ramp" if n_instances < 31 else "id"
+
+    grids = []
+    results.time("Grid.populate", params, lambda grid: grids.append(grid) or grid.populate(names, n_instances),
+                 setup=lambda: (Grid(n_instances),), repeats=1)
+    results.time("RandomLayout.populate", params, lambda layout: layout.populate(names, n_instances),
+                 setup=lambda: (RandomLayout(n_instances),), repeats=1)
+    grid = grids[-1]
+
+    camera = Camera("benchmark_camera")
+    bpy.context.scene.camera = camera.object
+    n_frames = 64
+    poses = sample_poses(0, range(n_frames), n_instances, grid.center, (4, 5))
+    results.time(
+        "apply_pose (64 frames)", params, lambda: [apply_pose(camera, grid, poses, k) for k in range(n_frames)]
+    )
+    results.time("templateVertices", params, lambda: templateVertices(grid.prop_list))
+    score = visibility_scorer(camera, grid, load_visibility_policy("default"))
+    results.time("visibility score (64 frames)", params, lambda: [score(poses, k) for k in range(n_frames)])
+
+    # Per-frame domain randomization only reassigns pool entries
+    lights = [Light("benchmark_light"), Light("benchmark_light_2")]
+    appearance_pool = AppearancePool(grid.members, lights, 0, n_variants=16, n_rigs=8, center=grid.center)
+    appearance = sample_appearance(0, range(n_frames), n_instances, 16, 8)
+    results.time(
+        "AppearancePool.apply (64 frames)",
+        params,
+        lambda: [appearance_pool.apply(grid, appearance, k) for k in range(n_frames)],
+    )
+
+    template_vertices, instance_template = templateVertices(grid.prop_list)
+    matrices = np.array([prop.object.matrix_basis for prop in grid.prop_list])
+    for resolution in resolutions:
+        frame_params = {**params, "resolution": resolution}
+        intrinsics = cameraIntrinsics(camera.data, (resolution, resolution))
+        results.time(
+            "annotate_geometry",
+            frame_params,
+            lambda: annotate_geometry(
+                template_vertices,
+                instance_template,
+                matrices,
+                np.array(camera.object.matrix_basis),
+                intrinsics,
+                (resolution, resolution),
+            ),
+        )
+        if FAKE_BPY:
+            continue
+
+        # Real renders on the CPU, the image with the scene's engine and the mask with Workbench
+        scene = bpy.context.scene
+        setSegmentationColors(grid.prop_list, encoding)
+        scene.render.resolution_x = scene.render.resolution_y = resolution
+        apply_pose(camera, grid, poses, 0)
+
+        def render_image():
+            old = redirectOutputStart()
+            bpy.ops.render.render()
+            redirectOutputEnd(old)
+
+        def render_mask():
+            old_profile = swap_profile(scene, FLAT_SEGMENTATION)
+            old_settings = exactColorSettings(scene)
+            render_image()
+            restoreColorSettings(scene, old_settings)
+            apply_profile(scene, old_profile)
+
+        results.time("render", frame_params, render_image)
+        results.time("segmentation render", frame_params, render_mask)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "render.png")
+            results.time("save_render", frame_params, lambda: bpy.data.images["Render Result"].save_render(path))
+
+
+def mesh_objects(n_objects: int, n_vertices: int = 482) -> list:
+    """n_objects unlinked mesh objects of random triangles at random locations, like the parts of an appended prop."""
+    rng = np.random.default_rng(0)
+    objects = []
+    for idx in range(n_objects):
+        vertices = rng.normal(size=(n_vertices, 3))
+        faces = rng.integers(0, n_vertices, size=(n_vertices, 3))
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+        mesh = bpy.data.meshes.new(f"benchmark_part_{idx}")
+        mesh.from_pydata(vertices.tolist(), [], faces.tolist())
+        obj = bpy.data.objects.new(f"benchmark_part_{idx}", mesh)
+        obj.location = rng.uniform(-5, 5, size=3)
+        objects.append(obj)
+    return objects
+
+
+def join_operator(objects: list) -> None:
+    """The operator join importProp used, objects have to be linked and selected."""
+    for obj in objects:
+        bpy.context.collection.objects.link(obj)
+    if hasattr(bpy.context, "temp_override"):
+        with bpy.context.temp_override(active_object=objects[0], selected_editable_objects=objects):
+            bpy.ops.object.join()
+    else:
+        ctx = bpy.context.copy()
+        ctx["active_object"] = objects[0]
+        ctx["selected_editable_objects"] = objects
+        bpy.ops.object.join(ctx)
+
+
+def bench_setup(results: Results, n_objects: int) -> None:
+    """Scene construction on the data API against the operators it replaced, only in Blender."""
+    params = {"n_objects": n_objects}
+    results.time("join (operator)", params, join_operator, setup=lambda: (mesh_objects(n_objects),))
+    results.time("joinMeshes", params, joinMeshes, setup=lambda: (mesh_objects(n_objects),))
+
+    def delete_operator():
+        bpy.ops.object.select_all(action="SELECT")
+        bpy.ops.object.delete()
+
+    def link_objects():
+        for obj in mesh_objects(n_objects):
+            bpy.context.collection.objects.link(obj)
+        return ()
+
+    results.time("delete (operator)", params, delete_operator, setup=link_objects)
+    results.time("deleteScene", params, deleteScene, setup=link_objects)
+
+
+def bench_labels(results: Results, n_instances: int, resolution: int) -> None:
+    params = {"n_instances": n_instances, "resolution": resolution}
+    ids = synthetic_mask(np.random.default_rng(0), n_instances, resolution)
+    instance_ids = np.arange(1, n_instances + 1)
+    results.time("mask_rle", params, lambda: mask_rle(ids, instance_ids))
+    results.time("annotate_mask", params, lambda: annotate_mask(ids, instance_ids))
+
+
+def bench_io(results: Results, resolution: int) -> None:
+    params = {"resolution": resolution}
+    pixels = np.random.default_rng(0).random((resolution, resolution, 4), dtype=np.float32)
+    results.time("to_uint8", params, lambda: to_uint8(pixels, False))
+    results.time("encode_png", params, lambda: encode_png(to_uint8(pixels, False)))
+
+    n_frames = 16
+    with tempfile.TemporaryDirectory() as directory:
+
+        def write_async(format):
+            writer = AsyncImageWriter(format)
+            for frame in range(n_frames):
+                writer.submit(frame, "image", os.path.join(directory, f"render{frame:03}"), pixels)
+            writer.close()
+
+        def write_shards():
+            writer = ShardWriter(directory, "benchmark", shard_size=n_frames)
+            for frame in range(n_frames):
+                writer.submit(frame, "image", "", pixels)
+                writer.submit(frame, "mask", "", pixels, linear=True)
+            writer.close()
+
+        results.time("AsyncImageWriter png (16)", params, lambda: write_async("png"))
+        results.time("AsyncImageWriter npy (16)", params, lambda: write_async("npy"))
+        results.time("ShardWriter (16)", params, write_shards)
+
+
+def bench_sampling(results: Results, n_instances: int) -> None:
+    params = {"n_instances": n_instances}
+    frames = range(10000)
+    results.time("sample_poses (10000 frames)", params, lambda: sample_poses(0, frames, n_instances, (0, 0, 0), (4, 5)))
+    radii = np.random.default_rng(0).uniform(0.5, 1.5, n_instances)
+    results.time("sample_layout", params, lambda: sample_layout(np.random.default_rng(0), radii))
+    results.time("sample_layout ground", params, lambda: sample_layout(np.random.default_rng(0), radii, ground=True))
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(prog="bench.py", description="Benchmark the BlendGen pipeline.")
+    parser.add_argument("--output", help="Write the results to this JSON file.", default=None)
+    parser.add_argument("--baseline", help="Compare against the results in this JSON file.", default=None)
+    parser.add_argument(
+        "--tolerance", help="Allowed slowdown against the baseline. Default 0.2.", type=float, default=0.2
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--quick", help="Fewer cases, e.g. for CI.", action="store_true")
+    parser.add_argument("--prop-path", default=os.path.join(REPO_PATH, "props"))
+    args = parser.parse_args(argv)
+
+    cases = QUICK_CASES if args.quick else FULL_CASES
+    results = Results(args.repeats)
+    print(f"BlendGen benchmarks, {'fake bpy' if FAKE_BPY else 'Blender ' + bpy.app.version_string}")
+    if not FAKE_BPY:
+        for n_objects in cases["n_objects"]:
+            newScene()
+            bench_setup(results, n_objects)
+    for n_props in cases["n_props"]:
+        for n_instances in cases["n_instances"]:
+            bench_scene(results, args.prop_path, n_props, n_instances, cases["resolution"])
+    for n_instances in cases["n_instances"]:
+        bench_sampling(results, n_instances)
+        for resolution in cases["resolution"]:
+            bench_labels(results, n_instances, resolution)
+    for resolution in cases["resolution"]:
+        bench_io(results, resolution)
+
+    output = {
+        "environment": {
+            "fake_bpy": FAKE_BPY,
+            "blender": None if FAKE_BPY else bpy.app.version_string,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results.records,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["environment"]["fake_bpy"] != FAKE_BPY:
+            print("WARNING: baseline was recorded with a different bpy")
+        regressions = compare(results.records, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(
+                f"REGRESSION: {regression['stage']} {json.dumps(regression['params'])}"
+                f" {regression['baseline'] * 1000:.3f} ms -> {regression['median'] * 1000:.3f} ms"
+                f" ({regression['ratio']:.2f}x)"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Headless stand-ins for bpy and mathutils, good enough to run BlendGen's scene building and pose code without Blender.
+Nothing is rendered: the stand-ins only keep the state the Python code reads back (transforms, meshes, custom
+properties), everything else (operators, node trees, render settings) is accepted and ignored. Timings measure the
+Python side of BlendGen, not Blender.
+
+Use install() before importing blendgen.
+"""
+import sys
+import types
+from math import sqrt
+
+import numpy as np
+
+
+class Stub:
+    """Accepts any attribute, call, item or context manager and returns another Stub."""
+
+    def __init__(self, name: str = "stub") -> None:
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Stub(name)
+        self.__dict__[name] = value
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return Stub(self._name)
+
+    def __getitem__(self, key):
+        return Stub(str(key))
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# mathutils
+
+
+class Vector:
+    def __init__(self, values=(0.0, 0.0, 0.0)) -> None:
+        self._values = np.array(values, dtype=np.float64)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._values.astype(dtype) if dtype is not None else self._values.copy()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values.tolist())
+
+    def __getitem__(self, idx):
+        return self._values[idx]
+
+    def __setitem__(self, idx, value):
+        self._values[idx] = value
+
+    def __add__(self, other):
+        return Vector(self._values + np.asarray(other, dtype=np.float64))
+
+    def __sub__(self, other):
+        return Vector(self._values - np.asarray(other, dtype=np.float64))
+
+    def __mul__(self, other):
+        return Vector(self._values * np.asarray(other, dtype=np.float64))
+
+    def __truediv__(self, other):
+        return Vector(self._values / np.asarray(other, dtype=np.float64))
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Vector(-self._values)
+
+    @property
+    def x(self):
+        return self._values[0]
+
+    @property
+    def y(self):
+        return self._values[1]
+
+    @property
+    def z(self):
+        return self._values[2]
+
+    @property
+    def length(self):
+        return float(np.linalg.norm(self._values))
+
+    def normalized(self):
+        return Vector(self._values / max(self.length, 1e-12))
+
+    def to_track_quat(self, track: str = "Z", up: str = "Y"):
+        """Rotation pointing the local track axis (only "Z") along the vector with local up as close to world Z."""
+        z_axis = self.normalized()._values
+        x_axis = np.cross((0.0, 0.0, 1.0), z_axis)
+        if np.linalg.norm(x_axis) < 1e-9:
+            x_axis = np.array((1.0, 0.0, 0.0))
+        x_axis /= np.linalg.norm(x_axis)
+        y_axis = np.cross(z_axis, x_axis)
+        return Quaternion.from_matrix(np.stack((x_axis, y_axis, z_axis), axis=1))
+
+
+class Quaternion:
+    def __init__(self, values=(1.0, 0.0, 0.0, 0.0)) -> None:
+        self._values = np.array(values, dtype=np.float64)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._values.astype(dtype) if dtype is not None else self._values.copy()
+
+    def __iter__(self):
+        return iter(self._values.tolist())
+
+    def __len__(self):
+        return 4
+
+    @staticmethod
+    def from_matrix(rotation: np.ndarray):
+        w = sqrt(max(0.0, 1 + rotation[0, 0] + rotation[1, 1] + rotation[2, 2])) / 2
+        x = sqrt(max(0.0, 1 + rotation[0, 0] - rotation[1, 1] - rotation[2, 2])) / 2
+        y = sqrt(max(0.0, 1 - rotation[0, 0] + rotation[1, 1] - rotation[2, 2])) / 2
+        z = sqrt(max(0.0, 1 - rotation[0, 0] - rotation[1, 1] + rotation[2, 2])) / 2
+        x = np.copysign(x, rotation[2, 1] - rotation[1, 2])
+        y = np.copysign(y, rotation[0, 2] - rotation[2, 0])
+        z = np.copysign(z, rotation[1, 0] - rotation[0, 1])
+        return Quaternion((w, x, y, z))
+
+    def to_matrix(self):
+        w, x, y, z = self._values / max(np.linalg.norm(self._values), 1e-12)
+        return Matrix(
+            [
+                [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+                [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+            ]
+        )
+
+
+class Matrix:
+    def __init__(self, rows=None) -> None:
+        self._values = np.eye(4) if rows is None else np.array(rows, dtype=np.float64)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._values.astype(dtype) if dtype is not None else self._values.copy()
+
+    def __iter__(self):
+        return iter(self._values.tolist())
+
+    @staticmethod
+    def Translation(vector):
+        matrix = np.eye(4)
+        matrix[:3, 3] = np.asarray(vector, dtype=np.float64)
+        return Matrix(matrix)
+
+    def to_3x3(self):
+        return Matrix(self._values[:3, :3])
+
+    def __matmul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(self._values @ other._values)
+        return Vector(self._values @ np.asarray(other, dtype=np.float64))
+
+
+def euler_matrix(angles) -> np.ndarray:
+    """XYZ Euler angles to a 3x3 rotation."""
+    x, y, z = angles
+    rotation_x = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+    rotation_y = np.array([[np.cos(y), 0, np.sin(y)], [0, 1, 0], [-np.sin(y), 0, np.cos(y)]])
+    rotation_z = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+    return rotation_z @ rotation_y @ rotation_x
+
+
+# bpy data
+
+
+class FakeVertices:
+    def __init__(self, coordinates: np.ndarray) -> None:
+        self.coordinates = np.asarray(coordinates, dtype=np.float32).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def foreach_get(self, attribute: str, out) -> None:
+        out[:] = self.coordinates.ravel()
+
+    def foreach_set(self, attribute: str, values) -> None:
+        self.coordinates = np.asarray(values, dtype=np.float32).reshape(-1, 3)
+
+
+class FakeMesh:
+    def __init__(self, name: str, coordinates=np.zeros((0, 3))) -> None:
+        self.name = self.name_full = name
+        self.vertices = FakeVertices(coordinates)
+        self.materials = []
+        self.library = None
+        self.users = 0
+
+    def transform(self, matrix) -> None:
+        matrix = np.asarray(matrix)
+        if matrix.shape == (4, 4):
+            self.vertices.coordinates = self.vertices.coordinates @ matrix[:3, :3].T.astype(np.float32) + matrix[:3, 3]
+        else:
+            self.vertices.coordinates = self.vertices.coordinates @ matrix.T.astype(np.float32)
+
+    def update(self) -> None:
+        pass
+
+    def copy(self):
+        duplicate = FakeMesh(self.name, self.vertices.coordinates)
+        duplicate.materials = list(self.materials)
+        return data.meshes.add(duplicate)
+
+    def from_pydata(self, vertices, edges, faces) -> None:
+        self.vertices = FakeVertices(vertices)
+
+
+class FakeCamera:
+    def __init__(self, name: str) -> None:
+        self.name = self.name_full = name
+        self.lens = 50.0
+        self.sensor_width = 36.0
+        self.sensor_height = 24.0
+        self.sensor_fit = "AUTO"
+        self.animation_data = None
+
+
+class FakeObject:
+    def __init__(self, name: str, data=None) -> None:
+        self.name = self.name_full = name
+        self.data = data
+        self.type = "MESH" if isinstance(data, FakeMesh) else "CAMERA" if isinstance(data, FakeCamera) else "EMPTY"
+        self.location = (0.0, 0.0, 0.0)
+        self.scale = (1.0, 1.0, 1.0)
+        self.rotation_mode = "XYZ"
+        self.rotation_euler = (0.0, 0.0, 0.0)
+        self.rotation_quaternion = (1.0, 0.0, 0.0, 0.0)
+        self.color = (1.0, 1.0, 1.0, 1.0)
+        self.pass_index = 0
+        self.hide_render = False
+        self.animation_data = None
+        self.material_slots = [Stub("slot") for _ in getattr(data, "materials", [])]
+        self.properties = {}
+
+    def __setattr__(self, name, value):
+        # Transforms are stored as arrays, like Blender converts assigned sequences
+        if name in ("location", "scale", "rotation_euler"):
+            value = Vector(value)
+        elif name == "rotation_quaternion":
+            value = Quaternion(value)
+        elif name == "data" and "material_slots" in self.__dict__:
+            # Blender resizes the slots to the materials of the new mesh, keeping the existing ones
+            n_slots = len(getattr(value, "materials", []))
+            slots = self.material_slots[:n_slots]
+            object.__setattr__(self, "material_slots", slots + [Stub("slot") for _ in range(n_slots - len(slots))])
+        object.__setattr__(self, name, value)
+
+    def __getitem__(self, key):
+        return self.properties[key]
+
+    def __setitem__(self, key, value):
+        self.properties[key] = value
+
+    def get(self, key, default=None):
+        return self.properties.get(key, default)
+
+    def copy(self):
+        duplicate = FakeObject(self.name, self.data)
+        for name in ("location", "scale", "rotation_mode", "rotation_euler", "rotation_quaternion", "color"):
+            setattr(duplicate, name, getattr(self, name))
+        duplicate.properties = dict(self.properties)
+        data.objects.add(duplicate)
+        return duplicate
+
+    @property
+    def matrix_basis(self):
+        if self.rotation_mode == "QUATERNION":
+            rotation = np.asarray(self.rotation_quaternion.to_matrix())
+        else:
+            rotation = euler_matrix(np.asarray(self.rotation_euler))
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation * np.asarray(self.scale)
+        matrix[:3, 3] = np.asarray(self.location)
+        return Matrix(matrix)
+
+    def select_set(self, state: bool) -> None:
+        pass
+
+    def animation_data_create(self):
+        self.animation_data = Stub("animation_data")
+        return self.animation_data
+
+    def animation_data_clear(self) -> None:
+        self.animation_data = None
+
+
+class FakeCollection:
+    """bpy_prop_collection of data blocks addressed by name, new() creates them with factory."""
+
+    def __init__(self, factory=None) -> None:
+        self.factory = factory if factory is not None else (lambda name, *args, **kwargs: Stub(name))
+        self.items = {}
+
+    def add(self, item):
+        # Unique names like Blender's .001 suffixes
+        name = item.name
+        suffix = 0
+        while name in self.items:
+            suffix += 1
+            name = f"{item.name}.{suffix:03}"
+        item.name = name
+        if hasattr(item, "name_full"):
+            item.name_full = name
+        self.items[name] = item
+        return item
+
+    def new(self, name: str = "", *args, **kwargs):
+        item = self.factory(name, *args, **kwargs)
+        if not hasattr(item, "name") or isinstance(item, Stub):
+            item.name = name
+        return self.add(item)
+
+    def remove(self, item, **kwargs) -> None:
+        self.items.pop(item.name, None)
+
+    def get(self, name, default=None):
+        return self.items.get(name, default)
+
+    def __getitem__(self, name):
+        return self.items[name]
+
+    def __contains__(self, name):
+        return name in self.items
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self) -> None:
+        self.items.clear()
+
+
+class FakeSceneObjects:
+    def __init__(self) -> None:
+        self.linked = []
+
+    def link(self, obj) -> None:
+        self.linked.append(obj)
+
+    def unlink(self, obj) -> None:
+        self.linked.remove(obj)
+
+    def __iter__(self):
+        return iter(list(self.linked))
+
+    def __len__(self):
+        return len(self.linked)
+
+
+data = types.SimpleNamespace(
+    objects=FakeCollection(lambda name, object_data=None: FakeObject(name, object_data)),
+    meshes=FakeCollection(lambda name: FakeMesh(name)),
+    cameras=FakeCollection(lambda name: FakeCamera(name)),
+    lights=FakeCollection(),
+    materials=FakeCollection(),
+    images=FakeCollection(),
+    actions=FakeCollection(),
+    collections=FakeCollection(),
+    node_groups=FakeCollection(),
+    libraries=Stub("libraries"),
+)
+
+
+def make_scene() -> Stub:
+    scene = Stub("scene")
+    scene.collection = Stub("collection")
+    scene.collection.objects = FakeSceneObjects()
+    scene.objects = scene.collection.objects
+    return scene
+
+
+def add_template(name: str, n_vertices: int = 1000, seed: int = 0) -> FakeObject:
+    """Mesh object standing in for an imported prop: n_vertices random points in the unit cube."""
+    rng = np.random.default_rng(seed)
+    mesh = data.meshes.new(name)
+    mesh.vertices = FakeVertices(rng.uniform(-0.5, 0.5, size=(n_vertices, 3)))
+    return data.objects.new(name, mesh)
+
+
+def reset() -> None:
+    """Empties bpy.data and starts a new scene."""
+    for collection in vars(data).values():
+        if isinstance(collection, FakeCollection):
+            collection.clear()
+    context.scene = make_scene()
+    context.collection = context.scene.collection
+
+
+context = Stub("context")
+
+
+def install() -> types.ModuleType:
+    """Registers the stand-ins as the bpy, bmesh and mathutils modules and returns bpy."""
+    bpy = types.ModuleType("bpy")
+    bpy.data = data
+    bpy.context = context
+    bpy.ops = Stub("ops")
+    bpy.types = Stub("types")
+    bpy.path = Stub("path")
+    bpy.app = types.SimpleNamespace(version=(0, 0, 0), version_string="fake")
+    mathutils = types.ModuleType("mathutils")
+    mathutils.Vector = Vector
+    mathutils.Matrix = Matrix
+    mathutils.Quaternion = Quaternion
+    bmesh = types.ModuleType("bmesh")
+    bmesh.new = Stub("new")
+    bmesh.ops = Stub("ops")
+    sys.modules["bpy"] = bpy
+    sys.modules["bmesh"] = bmesh
+    sys.modules["mathutils"] = mathutils
+    reset()
+    return bpy
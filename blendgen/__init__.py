@@ -1,3 +1,11 @@
-from .generate import generate
+from .stream import Sample, SampleStream
 
-__all__ = ["generate"]
+try:
+    from .generate import generate
+except ModuleNotFoundError as error:
+    # Outside of Blender (e.g. in the blendgen CLI) only the bpy-free modules can be used
+    if error.name != "bpy":
+        raise
+    generate = None
+
+__all__ = ["generate", "Sample", "SampleStream"]
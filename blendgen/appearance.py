@@ -0,0 +1,90 @@
+"""
+Domain randomization of appearance. A run builds a fixed pool of material variants and light rigs once, and every
+frame only picks pool entries by index: prop i of frame k gets material variant appearance["material_variant"][k, i]
+and the lights are set to rig appearance["light_rig"][k]. Like poses, the pool only depends on the scene seed and the
+indices of a frame only on the seed and its frame index. Does not depend on bpy.
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+
+from .sampling import BLOCK_SIZE
+from .streams import APPEARANCE, LIGHT_RIGS, MATERIAL_VARIANTS, stream_rng
+
+ENERGY_RANGE = (40.0, 160.0)
+WARM_TINT = (1.0, 0.8, 0.6)
+COOL_TINT = (0.75, 0.85, 1.0)
+
+
+def sample_material_variants(seed: int, n_variants: int) -> Dict[str, np.ndarray]:
+    """
+    Parameters of n_variants materials, see utils.createVariantMaterial.
+
+        Returns:
+            variants (dict(str, np.ndarray)): "color_a" and "color_b" (n, 3) linear RGB mixed by a noise texture with
+            "noise_scale" (n,) and "mix" (n,) (0 is a plain color_a), and "roughness" (n,).
+    """
+    rng = stream_rng(seed, MATERIAL_VARIANTS)
+    return {
+        "color_a": rng.random((n_variants, 3)),
+        "color_b": rng.random((n_variants, 3)),
+        "noise_scale": rng.uniform(1, 20, n_variants),
+        "mix": rng.random(n_variants) * (rng.random(n_variants) < 0.5),  # Half are untextured
+        "roughness": rng.uniform(0.05, 1, n_variants),
+    }
+
+
+def sample_light_rigs(
+    seed: int, n_rigs: int, n_lights: int, center: Tuple[float, float, float], radius_range: Tuple[float, float]
+) -> Dict[str, np.ndarray]:
+    """
+    Placements of n_lights point lights in each of n_rigs rigs, above center at a distance in [min, max) of
+    radius_range. The energy is in ENERGY_RANGE for a light at the minimum distance and grows with the squared
+    distance, so center is lit about as brightly by near and far lights.
+
+        Returns:
+            rigs (dict(str, np.ndarray)): "location" (n_rigs, n_lights, 3), "energy" (n_rigs, n_lights) in W and
+            "color" (n_rigs, n_lights, 3), between a warm and a cool tint.
+    """
+    rng = stream_rng(seed, LIGHT_RIGS)
+    directions = rng.standard_normal((n_rigs, n_lights, 3))
+    directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+    directions[..., 2] = np.abs(directions[..., 2])
+    radius = rng.uniform(radius_range[0], radius_range[1], (n_rigs, n_lights, 1))
+    tint = rng.random((n_rigs, n_lights, 1))
+    energy = rng.uniform(ENERGY_RANGE[0], ENERGY_RANGE[1], (n_rigs, n_lights)) * (radius[..., 0] / radius_range[0]) ** 2
+    return {
+        "location": np.asarray(center, dtype=np.float64) + directions * radius,
+        "energy": energy,
+        "color": (1 - tint) * np.array(WARM_TINT) + tint * np.array(COOL_TINT),
+    }
+
+
+def sample_appearance(
+    seed: int, frames: range, n_instances: int, n_variants: int = 0, n_rigs: int = 0
+) -> Dict[str, np.ndarray]:
+    """
+    Pool indices of the given frames, drawn in blocks of sampling.BLOCK_SIZE frames as sampling.sample_poses.
+
+        Returns:
+            appearance (dict(str, np.ndarray)): "material_variant" (n, n_instances) if n_variants and "light_rig" (n,)
+            if n_rigs, with row k belonging to frames[k].
+    """
+    assert frames.step == 1, "frames has to be contiguous"
+    first_block = frames.start // BLOCK_SIZE
+    last_block = max(frames.stop - 1, frames.start) // BLOCK_SIZE
+    blocks = []
+    for block_idx in range(first_block, last_block + 1):
+        rng = stream_rng(seed, APPEARANCE, block_idx)
+        blocks.append(
+            {
+                "material_variant": rng.integers(max(n_variants, 1), size=(BLOCK_SIZE, n_instances)),
+                "light_rig": rng.integers(max(n_rigs, 1), size=BLOCK_SIZE),
+            }
+        )
+    offset = frames.start - first_block * BLOCK_SIZE
+    appearance = {}
+    for key, n in (("material_variant", n_variants), ("light_rig", n_rigs)):
+        if n > 0:
+            appearance[key] = np.concatenate([block[key] for block in blocks])[offset : offset + len(frames)]
+    return appearance
@@ -0,0 +1,79 @@
+"""
+Picks the fastest render settings that still meet a quality threshold, by rendering a few calibration frames with every
+candidate profile and comparing them to a high sample Cycles reference.
+"""
+import time
+from typing import Dict, List, Tuple
+
+import bpy
+import numpy as np
+
+from .profiles import AUTOTUNE_CANDIDATES, AUTOTUNE_REFERENCE, apply_profile, choose_profile, psnr, read_profile
+from .render import apply_pose
+from .utils import redirectOutputEnd, redirectOutputStart, viewerPixels
+from .writer import linear_to_srgb
+
+
+def render_calibration(camera, grid, poses, profile: Dict, warmup: bool = True) -> Tuple[List[np.ndarray], float]:
+    """
+    Renders every pose with profile.
+
+        Returns:
+            images (list(np.ndarray)): sRGB images read from the Viewer Node, requires addViewerNode.
+            seconds (float): Median render time of a frame, after an untimed warmup render (shader compilation).
+    """
+    apply_profile(bpy.context.scene, profile)
+    images = []
+    times = []
+    for k in range(len(poses["frame"])):
+        apply_pose(camera, grid, poses, k)
+        old = redirectOutputStart()
+        if warmup and k == 0:
+            bpy.ops.render.render()
+        start = time.perf_counter()
+        bpy.ops.render.render()
+        times.append(time.perf_counter() - start)
+        redirectOutputEnd(old)
+        images.append(linear_to_srgb(viewerPixels()[..., :3]))
+    return images, float(np.median(times))
+
+
+def tune_profile(
+    camera,
+    grid,
+    poses,
+    min_psnr: float = 30.0,
+    candidates: Dict[str, Dict] = AUTOTUNE_CANDIDATES,
+    reference: Dict = AUTOTUNE_REFERENCE,
+    resolution: Tuple[int, int] = (350, 350),
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Renders the calibration poses with the reference and every candidate profile. The scene is reset to its settings
+    before tuning ahead of every profile, so a candidate is not rendered with settings left over from the previous one.
+
+        Parameters:
+            poses (dict(str, np.ndarray)): Calibration poses from sampling.sample_poses.
+            min_psnr (float): Lowest acceptable PSNR in dB of any calibration frame against the reference.
+
+        Returns:
+            chosen (dict): Result of the chosen candidate, see profiles.choose_profile.
+            results (list(dict)): "name", "profile", "seconds" and "psnr" of every candidate.
+    """
+    bpy.context.scene.camera = camera.object
+    bpy.context.scene.render.resolution_x = resolution[0]
+    bpy.context.scene.render.resolution_y = resolution[1]
+
+    # Settings of the scene for every path any profile sets, in order so the engine comes first
+    paths = dict.fromkeys(path for profile in (reference, *candidates.values()) for path in profile)
+    baseline = read_profile(bpy.context.scene, paths)
+
+    references, _ = render_calibration(camera, grid, poses, reference, warmup=False)
+    results = []
+    for name, profile in candidates.items():
+        apply_profile(bpy.context.scene, baseline)
+        images, seconds = render_calibration(camera, grid, poses, profile)
+        quality = min(psnr(reference_image, image) for reference_image, image in zip(references, images))
+        results.append({"name": name, "profile": profile, "seconds": seconds, "psnr": quality})
+        print(f"{name:>12}: {seconds:.3f} s/frame, {quality:.1f} dB")
+    apply_profile(bpy.context.scene, baseline)
+    return choose_profile(results, min_psnr), results
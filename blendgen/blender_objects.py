@@ -7,6 +7,10 @@ import bpy
 import mathutils
 import numpy as np
 
+from .appearance import sample_light_rigs, sample_material_variants
+from .layout import region_side, sample_composition, sample_layout
+from .utils import centerOrigin, createVariantMaterial, instanceIdColor, templateVertices
+
 
 class BlenderObject:
     """A superclass with utility functions for blender objects for use in more specific subclasses"""
@@ -48,6 +52,10 @@ class BlenderObject:
         x, y, z = angles
         self.object.rotation_euler = (x, y, z)
 
+    def rotate_quaternion(self, quaternion: Tuple[float]) -> None:
+        self.object.rotation_mode = "QUATERNION"
+        self.object.rotation_quaternion = quaternion
+
     def move_abs_spherical_random(self, center, r_min, r_max) -> None:
         theta = random.random() * pi
         phi = random.random() * 2 * pi
@@ -70,9 +78,14 @@ class BlenderObject:
 
 
 class Camera(BlenderObject):
-    def __init__(self, name: str, lens: float = 50) -> None:
+    def __init__(self, name: str, lens: float = 50, existing: bpy.types.Object = None) -> None:
         assert 1 <= lens <= float("inf")
         BlenderObject.__init__(self, name)
+        if existing is not None:
+            # Camera of a template scene, see generate.build_template
+            self.object = existing
+            self.data = existing.data
+            return
 
         self.data = bpy.data.cameras.new(self.name)
         self.object = bpy.data.objects.new(self.name, self.data)
@@ -80,14 +93,24 @@ class Camera(BlenderObject):
         self.move_abs_cartesian((0, 0, 0))
         bpy.context.scene.collection.objects.link(self.object)
 
-    def random_lens(self, span: float) -> None:
+    def set_lens(self, length: float) -> None:
+        self.data.lens = length
+
+    def random_lens(self, span: Tuple[float]) -> None:
         length = random.uniform(span[0], span[1])
-        self.setLens(length)
+        self.set_lens(length)
 
 
 class Light(BlenderObject):
-    def __init__(self, name: str, position: Tuple[float] = (0, 0, 0), energy: float = 30) -> None:
+    def __init__(
+        self, name: str, position: Tuple[float] = (0, 0, 0), energy: float = 30, existing: bpy.types.Object = None
+    ) -> None:
         BlenderObject.__init__(self, name)
+        if existing is not None:
+            # Light of a template scene, see generate.build_template
+            self.object = existing
+            self.data = existing.data
+            return
 
         self.data = bpy.data.lights.new(name=self.name, type="POINT")
         self.object = bpy.data.objects.new(self.name, self.data)
@@ -106,29 +129,28 @@ class Prop(BlenderObject):
 
         BlenderObject.__init__(self, name)
         self.template_object = bpy.data.objects[name]  # object to duplicate
-        self.object = self.template_object.copy()
-        self.object.data = self.template_object.data.copy()
+
+        # Center origin once on the template, every instance shares its mesh
+        if not self.template_object.get("origin_centered") and self.template_object.data.library is None:
+            centerOrigin(self.template_object)
+
+        self.object = self.template_object.copy()  # Linked duplicate, mesh data is not copied
+        self.object["template_name"] = name  # Pins the template in a lazy PropLibrary
+        self.mesh = self.object.data  # Full detail mesh, object.data can be a level of detail (see lod_cache)
+        self.object.color = instanceIdColor(segmentation_idx)  # Rendered flat by Workbench for "id" masks
         self.object.pass_index = segmentation_idx
+        materials = list(self.object.data.materials)
 
-        bpy.context.collection.objects.link(self.object)  # was need for adding it to the scene
+        # Materials are assigned per object so swapping them does not touch the shared mesh
+        for slot, material in zip(self.object.material_slots, materials):
+            slot.link = "OBJECT"
+            slot.material = material
 
-        # Center origin
-        bpy.ops.object.select_all(action="DESELECT")
-        self.object.select_set(True)
-        bpy.ops.object.origin_set(type="ORIGIN_GEOMETRY", center="BOUNDS")
-        bpy.ops.object.select_all(action="DESELECT")
+        bpy.context.collection.objects.link(self.object)  # was need for adding it to the scene
 
         # Initialise
         self.rotate_random()
 
-    def setMaterial(self, material_name: str) -> None:
-        for idx in range(len(self.object.data.materials)):
-            self.object.data.materials[idx] = bpy.data.materials.get(material_name)
-
-    def restoreMaterial(self) -> None:
-        for idx in range(len(self.object.data.materials)):
-            self.object.data.materials[idx] = self.template_object.data.materials[idx]
-
 
 class Grid:
     def __init__(self, n_spots: int) -> None:
@@ -136,6 +158,8 @@ class Grid:
         self.side_length = 2
         self.distance_to_edge = math.sqrt(3) / 2 * self.side_length
         self.prop_list = []
+        self.members = self.prop_list  # Every prop is shown in every frame, see PropPool
+        self.visible = np.zeros(0, dtype=np.int64)
 
         # Get number of spots per side
         n_per_side = 1
@@ -155,10 +179,260 @@ class Grid:
         self.coordinate_list = coordinate_list
         self.center = center
 
-    def populate(self, obj_name_list: List[str], n_instances: int) -> None:
+    def populate(self, obj_name_list: List[str], n_instances: int, library=None) -> None:
         for idx in range(n_instances):
             coordinate = self.coordinate_list[idx]
             obj_name = random.choice(obj_name_list)
-            prop = Prop(obj_name, idx)
+            if library is not None:
+                library.load(obj_name)  # Lazy PropLibrary, loads the sampled prop only
+            prop = Prop(obj_name, idx + 1)  # Index 0 is background in the object index pass
             prop.move_abs_cartesian(coordinate)
             self.prop_list.append(prop)
+        self.visible = np.arange(len(self.prop_list))
+
+    def arrange(self, frame: int) -> None:
+        """The composition is the same in every frame."""
+
+
+class RandomLayout:
+    """
+    Props at random positions and scales without overlap (see layout.sample_layout), a drop in replacement of Grid
+    with the same center, distance_to_edge and prop_list. center and distance_to_edge are known after populate.
+
+        Parameters:
+            density (float): Fraction of the volume (ground area if ground) covered by the props' bounding spheres.
+            scale_range (tuple(float)): Every prop is scaled uniformly in [min, max).
+            ground (bool): Props rest on a ground plane at z = 0, rendered as background.
+    """
+
+    def __init__(
+        self, n_spots: int, density: float = 0.2, scale_range: Tuple[float] = (1, 1), ground: bool = False
+    ) -> None:
+        self.n_spots = n_spots
+        self.density = density
+        self.scale_range = scale_range
+        self.ground = ground
+        self.center = (0, 0, 0)
+        self.distance_to_edge = 0
+        self.prop_list = []
+        self.members = self.prop_list
+        self.visible = np.zeros(0, dtype=np.int64)
+
+    def populate(self, obj_name_list: List[str], n_instances: int, library=None) -> None:
+        for idx in range(n_instances):
+            obj_name = random.choice(obj_name_list)
+            if library is not None:
+                library.load(obj_name)
+            self.prop_list.append(Prop(obj_name, idx + 1))
+
+        # Bounding spheres around the origins of the scaled props, read from the shared meshes
+        template_vertices, instance_template = templateVertices(self.prop_list)
+        rng = np.random.default_rng(np.random.randint(2**31))
+        scales = rng.uniform(self.scale_range[0], self.scale_range[1], size=n_instances)
+        radii = np.empty(n_instances)
+        for idx, prop in enumerate(self.prop_list):
+            vertices = template_vertices[instance_template[idx]] * np.array(prop.object.scale)
+            radii[idx] = np.linalg.norm(vertices, axis=1).max(initial=0) * scales[idx]
+        layout = sample_layout(rng, radii, density=self.density, ground=self.ground)
+        for prop, scale, location in zip(self.prop_list, scales, layout["location"]):
+            prop.object.scale = np.array(prop.object.scale) * scale
+            prop.move_abs_cartesian(location)
+
+        self.center = tuple(layout["center"])
+        self.distance_to_edge = float(layout["distance_to_edge"])
+        self.visible = np.arange(len(self.prop_list))
+        if self.ground:
+            self.ground_object = add_ground(self.center, 2 * self.distance_to_edge)
+
+    def arrange(self, frame: int) -> None:
+        """The composition is the same in every frame."""
+
+
+def add_ground(center: Tuple[float], size: float) -> bpy.types.Object:
+    """Square plane of side 2 * size at z = 0 below center, black so it is background in the masks."""
+    x, y, _ = center
+    vertices = [(x - size, y - size, 0), (x + size, y - size, 0), (x + size, y + size, 0), (x - size, y + size, 0)]
+    mesh = bpy.data.meshes.new("ground")
+    mesh.from_pydata(vertices, [], [(0, 1, 2, 3)])
+    ground_object = bpy.data.objects.new("ground", mesh)
+    ground_object.color = (0, 0, 0, 1)
+    bpy.context.scene.collection.objects.link(ground_object)
+    return ground_object
+
+
+class PropPool:
+    """
+    Pre-created props of every template, re-composed per frame by arrange: members are shown or hidden and moved, no
+    objects are created or removed while rendering. prop_list holds the members shown in the current frame, members
+    all of them. Same center and distance_to_edge as Grid and RandomLayout, which are fixed for the whole run.
+
+        Parameters:
+            seed (int): Compositions only depend on (seed, frame), see layout.sample_composition.
+            pool_size (int): Members per template, at most n_instances.
+            layout (str): "grid" fills the lattice of Grid, "random" and "ground" place the members like RandomLayout
+                in a region of fixed size, members that do not fit are left out of the frame.
+    """
+
+    def __init__(
+        self,
+        n_spots: int,
+        seed: int,
+        pool_size: int = None,
+        layout: str = "grid",
+        density: float = 0.2,
+        scale_range: Tuple[float] = (1, 1),
+    ) -> None:
+        self.n_spots = n_spots
+        self.seed = seed
+        self.pool_size = n_spots if pool_size is None else min(pool_size, n_spots)
+        self.layout = layout
+        self.density = density
+        self.scale_range = scale_range
+        self.prop_list = []
+        self.members = []
+
+    def populate(self, obj_name_list: List[str], n_instances: int, library=None) -> None:
+        # pool_size members of every template, all of them hidden
+        obj_name_list = sorted(set(obj_name_list))
+        self.member_index = []  # Member indices of every template
+        for obj_name in obj_name_list:
+            if library is not None:
+                library.load(obj_name)  # Every template is used, the library has to hold all of them
+            self.member_index.append(list(range(len(self.members), len(self.members) + self.pool_size)))
+            for _ in range(self.pool_size):
+                prop = Prop(obj_name, len(self.members) + 1)
+                prop.object.hide_render = True
+                self.members.append(prop)
+        self.base_scales = np.array([prop.object.scale for prop in self.members])
+
+        # Bounding radius of every template at scale 1
+        template_vertices, instance_template = templateVertices(self.members)
+        self.template_radii = np.empty(len(obj_name_list))
+        for template_idx, member_indices in enumerate(self.member_index):
+            vertices = template_vertices[instance_template[member_indices[0]]] * self.base_scales[member_indices[0]]
+            self.template_radii[template_idx] = np.linalg.norm(vertices, axis=1).max(initial=0)
+
+        if self.layout == "grid":
+            grid = Grid(n_instances)
+            self.slots = np.array(grid.coordinate_list)
+            self.side = None
+            self.center = grid.center
+            self.distance_to_edge = grid.distance_to_edge
+        else:
+            self.slots = None
+            mean_scale = np.mean(self.scale_range)
+            ground = self.layout == "ground"
+            self.side = region_side(self.template_radii.mean() * mean_scale, n_instances, self.density, ground=ground)
+            half_side = np.full(3, self.side / 2)
+            if ground:
+                half_side[2] = self.template_radii.max() * self.scale_range[1]
+            self.center = (self.side / 2, self.side / 2, 0 if ground else self.side / 2)
+            self.distance_to_edge = float(np.linalg.norm(half_side))
+            if ground:
+                self.ground_object = add_ground(self.center, 2 * self.distance_to_edge)
+        self.n_instances = n_instances
+        self.visible = np.zeros(0, dtype=np.int64)
+        self.arrange(0)
+
+    def arrange(self, frame: int) -> None:
+        """Shows, moves and scales the members composing frame, hides the ones shown before."""
+        composition = sample_composition(
+            self.seed,
+            frame,
+            self.template_radii,
+            self.pool_size,
+            self.n_instances,
+            scale_range=self.scale_range,
+            slots=self.slots,
+            side=self.side,
+            ground=self.layout == "ground",
+        )
+
+        # First free member of each drawn template
+        used = np.zeros(len(self.member_index), dtype=np.int64)
+        visible = np.empty(len(composition["template"]), dtype=np.int64)
+        for idx, template in enumerate(composition["template"]):
+            visible[idx] = self.member_index[template][used[template]]
+            used[template] += 1
+
+        for member_idx in np.setdiff1d(self.visible, visible):
+            self.members[member_idx].object.hide_render = True
+        for member_idx, scale, location in zip(visible, composition["scale"], composition["location"]):
+            prop = self.members[member_idx]
+            prop.object.hide_render = False
+            prop.object.scale = self.base_scales[member_idx] * scale
+            prop.move_abs_cartesian(location)
+        self.visible = visible
+        self.prop_list = [self.members[member_idx] for member_idx in visible]
+
+
+class AppearancePool:
+    """
+    Material variants and light rigs built once (see appearance), apply only reassigns them by index so no material or
+    light is created while rendering. Every variant has the same node tree, Eevee compiles its shader once.
+
+        Parameters:
+            members (list(Prop)): Every prop that can be shown, e.g. grid.members.
+            lights (list(Light)): Lights placed by the rigs.
+            seed (int): The pool only depends on the scene seed, so every worker builds the same pool.
+            n_variants (int): Material variants, 0 keeps the props' own materials.
+            n_rigs (int): Light rigs, 0 keeps the lights where they are.
+            radius_range (tuple(float)): Distance of the lights of a rig to center.
+    """
+
+    def __init__(
+        self,
+        members: List[Prop],
+        lights: List[Light],
+        seed: int,
+        n_variants: int = 0,
+        n_rigs: int = 0,
+        center: Tuple[float] = (0, 0, 0),
+        radius_range: Tuple[float] = (2, 6),
+    ) -> None:
+        self.lights = lights
+        variants = sample_material_variants(seed, n_variants)
+        self.materials = [
+            createVariantMaterial(
+                f"variant_{idx}",
+                tuple(variants["color_a"][idx]),
+                tuple(variants["color_b"][idx]),
+                variants["noise_scale"][idx],
+                variants["mix"][idx],
+                variants["roughness"][idx],
+            )
+            for idx in range(n_variants)
+        ]
+        self.rigs = sample_light_rigs(seed, n_rigs, len(lights), center, radius_range)
+
+        # Props without materials need a slot for the variants, object linked like the slots set up by Prop. Slots
+        # follow the mesh, so the instances of such a template share a copy of its mesh with one slot and the
+        # template's mesh (linked from the prop cache, or kept for later daemon jobs) is left as it is
+        if n_variants > 0:
+            slotted = {}
+            for prop in members:
+                if len(prop.mesh.materials) == 0:
+                    if prop.mesh.name_full not in slotted:
+                        mesh = prop.mesh.copy()
+                        mesh.name = f"{prop.mesh.name}_variants"
+                        mesh.materials.append(None)
+                        slotted[prop.mesh.name_full] = mesh
+                    prop.mesh = slotted[prop.mesh.name_full]
+                    prop.object.data = prop.mesh
+                for slot in prop.object.material_slots:
+                    slot.link = "OBJECT"
+
+    def apply(self, grid, appearance: dict, k: int) -> None:
+        """Assigns the material variants and light rig of row k of appearance from appearance.sample_appearance."""
+        if "material_variant" in appearance:
+            for prop, variant in zip(grid.prop_list, appearance["material_variant"][k]):
+                material = self.materials[variant]
+                for slot in prop.object.material_slots:
+                    if slot.material != material:
+                        slot.material = material
+        if "light_rig" in appearance:
+            rig = appearance["light_rig"][k]
+            for light_idx, light in enumerate(self.lights):
+                light.move_abs_cartesian(self.rigs["location"][rig, light_idx])
+                light.data.energy = self.rigs["energy"][rig, light_idx]
+                light.data.color = self.rigs["color"][rig, light_idx]
@@ -0,0 +1,170 @@
+"""
+A long-lived Blender that renders jobs sent over a local socket, so the Blender startup, the import of blendgen and
+of the props are paid once instead of per job. On connect the daemon greets with a JSON line {"protocol": <version>},
+a client only uses a daemon that greets in time with its own PROTOCOL_VERSION (a daemon busy with a job does not
+accept, the CLI then starts Blender itself). A job is one JSON line {"argv": [...], "token": ...} with the arguments
+of main_blender.py and the token the daemon wrote to a file only its user can read, so other local users can not run
+jobs. The daemon streams the job's output back like the stdout of a worker and ends it with a line
+"BLENDGEN_EXIT <code>". Jobs run one at a time. Does not depend on bpy, the daemon side runs in main_blender.py.
+"""
+import json
+import os
+import secrets
+import socket
+import sys
+import traceback
+from typing import Callable, Dict, Iterator, List
+
+DEFAULT_PORT = 7361
+EXIT_PREFIX = "BLENDGEN_EXIT"
+PROTOCOL_VERSION = 1
+HANDSHAKE_TIMEOUT = 0.5  # Seconds, a client waits for the greeting and the daemon for the request
+
+
+def token_path(port: int = DEFAULT_PORT) -> str:
+    return os.path.join(os.path.expanduser("~"), ".blendgen", f"daemon_{port}.token")
+
+
+def write_token(port: int = DEFAULT_PORT) -> str:
+    """New random token of the daemon on port, in a file only readable by the current user."""
+    token = secrets.token_hex(16)
+    path = token_path(port)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+        f.write(token)
+    return token
+
+
+def read_token(port: int = DEFAULT_PORT) -> str:
+    """Token of the daemon on port, None if there is none."""
+    try:
+        with open(token_path(port)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def connect(port: int = DEFAULT_PORT) -> socket.socket:
+    """Connection to the daemon on port after its greeting, None unless it greets in time with PROTOCOL_VERSION."""
+    try:
+        connection = socket.create_connection(("127.0.0.1", port), timeout=HANDSHAKE_TIMEOUT)
+    except OSError:
+        return None
+    try:
+        with connection.makefile("r", encoding="utf-8") as stream:
+            greeting = json.loads(stream.readline())
+        if greeting.get("protocol") == PROTOCOL_VERSION:
+            connection.settimeout(None)
+            return connection
+    except (OSError, ValueError, AttributeError):
+        pass
+    connection.close()
+    return None
+
+
+def daemon_running(port: int = DEFAULT_PORT) -> bool:
+    """Whether a compatible daemon of this user is waiting for a job on port."""
+    if read_token(port) is None:
+        return False
+    connection = connect(port)
+    if connection is None:
+        return False
+    connection.close()
+    return True
+
+
+def send_request(request: Dict, port: int = DEFAULT_PORT) -> socket.socket:
+    """Connection with request sent, None if no compatible daemon of this user is waiting on port."""
+    token = read_token(port)
+    connection = connect(port) if token is not None else None
+    if connection is not None:
+        connection.sendall((json.dumps({**request, "token": token}) + "\n").encode())
+    return connection
+
+
+def submit_job(argv: List[str], port: int = DEFAULT_PORT) -> socket.socket:
+    """Sends a job to the daemon, None if no daemon took it. Its output is read with job_output."""
+    return send_request({"argv": [str(arg) for arg in argv]}, port)
+
+
+def job_output(connection: socket.socket, result: Dict) -> Iterator[str]:
+    """
+    Yields the output lines of a job from submit_job until it ends.
+
+        Parameters:
+            result (dict): Gets "exit_code" of the job, 1 if the connection ended without one.
+    """
+    result["exit_code"] = 1
+    with connection:
+        for line in connection.makefile("r", encoding="utf-8"):
+            if line.startswith(EXIT_PREFIX + " "):
+                result["exit_code"] = int(line.split()[1])
+                return
+            yield line
+
+
+def stop_daemon(port: int = DEFAULT_PORT) -> None:
+    """Stops the daemon after its current job."""
+    connection = send_request({"command": "stop"}, port)
+    if connection is not None:
+        connection.close()
+
+
+def serve(run_job: Callable[[List[str]], None], port: int = DEFAULT_PORT) -> None:
+    """
+    Runs jobs until a stop request. Python output of a job (stdout and stderr) goes to the connection, output of
+    Blender itself is redirected by the job as usual.
+
+        Parameters:
+            run_job (callable): Runs a job given its argv, an exception or SystemExit fails the job only.
+    """
+    server = socket.create_server(("127.0.0.1", port))
+    token = write_token(port)
+    print(f"BlendGen daemon listening on 127.0.0.1:{port}", flush=True)
+    while True:
+        connection, _ = server.accept()
+        with connection, connection.makefile("rw", encoding="utf-8") as stream:
+            # Greet, then a client that does not send a request in time can not block the next ones
+            try:
+                connection.settimeout(HANDSHAKE_TIMEOUT)
+                stream.write(json.dumps({"protocol": PROTOCOL_VERSION}) + "\n")
+                stream.flush()
+                line = stream.readline()
+                connection.settimeout(None)
+                request = json.loads(line) if line else None
+            except (OSError, ValueError):
+                continue
+            if request is None:
+                continue  # A daemon_running check
+            if not isinstance(request, dict) or not secrets.compare_digest(str(request.get("token")), token):
+                print("Refused a request without the daemon token", flush=True)
+                continue
+            if request.get("command") == "stop":
+                break
+
+            exit_code = 0
+            error_text = ""
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = stream
+            try:
+                run_job(request["argv"])
+            except SystemExit as error:
+                exit_code = error.code if isinstance(error.code, int) else 1
+            except Exception:
+                exit_code = 1
+                error_text = traceback.format_exc()
+                print(error_text, file=sys.__stderr__)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            try:
+                stream.write(error_text)
+                stream.write(f"{EXIT_PREFIX} {exit_code}\n")
+                stream.flush()
+            except OSError:
+                pass  # The client went away, the next job can still run
+            print(f"Job finished with {exit_code}: {' '.join(request['argv'])}", flush=True)
+    server.close()
+    if read_token(port) == token:
+        os.remove(token_path(port))
@@ -0,0 +1,159 @@
+"""
+Output layouts. Besides one file per image (see frame_name) a run can be written as a sharded dataset: fixed size,
+memory-mappable .npy arrays of images and masks with an index giving O(1) random access to any frame. Does not depend
+on bpy.
+"""
+import json
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+from .labels import load_labels
+from .writer import to_uint8
+
+SHARD_INDEX_NAME = "index.jsonl"
+
+
+def frame_digits(n_images: int) -> int:
+    """Number of digits in file names, at least 3 so runs of up to 999 images keep their old names."""
+    return max(3, len(str(n_images)))
+
+
+def frame_name(frame: int, n_images: int) -> str:
+    """File name without extension of frame (0-based), e.g. render001, zero padded so names sort by frame."""
+    return f"render{frame + 1:0{frame_digits(n_images)}}"
+
+
+def mask_array(pixels: np.ndarray, linear: bool) -> np.ndarray:
+    """
+    Mask of a (height, width, 4) float RGBA buffer with row 0 at the top: (height, width) int32 instance ids of an
+    exact ("id" encoded, linear) mask, otherwise (height, width, 4) uint8 colours.
+    """
+    mask = to_uint8(pixels, linear)
+    if linear:
+        mask = mask.astype(np.int32)
+        mask = mask[..., 0] + (mask[..., 1] << 8) + (mask[..., 2] << 16)
+    return mask
+
+
+class ShardWriter:
+    """
+    Writes images and masks into shards of shard_size frames: images_<name>_<k>.npy with (shard_size, height, width,
+    4) uint8 sRGB images and masks_<name>_<k>.npy with (shard_size, height, width) int32 instance ids ("id" encoded
+    masks) or (shard_size, height, width, 4) uint8 colours. Finished shards are appended to index.jsonl, so workers
+    can share the directory. Has the same submit interface as writer.AsyncImageWriter.
+    """
+
+    def __init__(self, directory: str, name: str, shard_size: int = 1000) -> None:
+        self.directory = directory
+        self.name = name
+        self.shard_size = shard_size
+        self.n_shards = 0
+        self.images = None
+        self.masks = None
+        self.frame_start = None
+        self.n_frames = 0
+        self.blocked_seconds = 0.0
+
+    def shard_path(self, kind: str) -> str:
+        return os.path.join(self.directory, f"{kind}_{self.name}_{self.n_shards:05}.npy")
+
+    def submit(self, frame: int, kind: str, path_without_extension: str, pixels: np.ndarray, linear: bool = False):
+        """Copies a (height, width, 4) float RGBA buffer with row 0 at the bottom into the row of frame."""
+        pixels = pixels[::-1]
+        if kind == "image":
+            self.start_frame(frame, pixels.shape[:2])
+            self.images[self.n_frames - 1] = to_uint8(pixels, linear)
+        else:
+            mask = mask_array(pixels, linear)
+            if self.masks is None:
+                self.masks = np.lib.format.open_memmap(
+                    self.shard_path("masks"), mode="w+", dtype=mask.dtype, shape=(self.shard_size, *mask.shape)
+                )
+            self.masks[self.n_frames - 1] = mask
+
+    def start_frame(self, frame: int, shape: Tuple[int, int]) -> None:
+        if self.images is not None and self.n_frames == self.shard_size:
+            self.finish_shard()
+        if self.images is None:
+            self.images = np.lib.format.open_memmap(
+                self.shard_path("images"), mode="w+", dtype=np.uint8, shape=(self.shard_size, *shape, 4)
+            )
+            self.frame_start = frame
+        assert frame == self.frame_start + self.n_frames, "frames have to be written in order"
+        self.n_frames += 1
+
+    def finish_shard(self) -> None:
+        if self.images is None:
+            return
+        entry = {
+            "images": os.path.basename(self.images.filename),
+            "masks": os.path.basename(self.masks.filename) if self.masks is not None else None,
+            "frame_start": self.frame_start,
+            "n_frames": self.n_frames,
+        }
+        self.images.flush()
+        if self.masks is not None:
+            self.masks.flush()
+        with open(os.path.join(self.directory, SHARD_INDEX_NAME), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        self.n_shards += 1
+        self.images = None
+        self.masks = None
+        self.n_frames = 0
+
+    def close(self) -> None:
+        self.finish_shard()
+
+
+class ShardedDataset:
+    """
+    Random access reader of a directory written by ShardWriter. Shards are memory mapped, dataset[frame] costs one
+    table lookup and the copy of one image. If labels_directory is given the label rows of the frame are included.
+    """
+
+    def __init__(self, directory: str, labels_directory: str = None) -> None:
+        self.directory = directory
+        with open(os.path.join(directory, SHARD_INDEX_NAME)) as f:
+            self.entries = [json.loads(line) for line in f if line.strip()]
+        self.arrays = {}
+
+        n_frames = max((entry["frame_start"] + entry["n_frames"] for entry in self.entries), default=0)
+        self.frame_entry = np.full(n_frames, -1, dtype=np.int64)
+        for entry_idx, entry in enumerate(self.entries):
+            self.frame_entry[entry["frame_start"] : entry["frame_start"] + entry["n_frames"]] = entry_idx
+        self.frames = np.flatnonzero(self.frame_entry >= 0)
+
+        # Label rows of every frame, labels are sorted by frame
+        self.labels = None
+        if labels_directory is not None and os.path.isfile(os.path.join(labels_directory, "index.jsonl")):
+            self.labels = load_labels(labels_directory)
+            self.label_starts = np.searchsorted(self.labels["frame"], np.arange(n_frames + 1))
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def array(self, filename: str) -> np.ndarray:
+        if filename not in self.arrays:
+            self.arrays[filename] = np.load(os.path.join(self.directory, filename), mmap_mode="r")
+        return self.arrays[filename]
+
+    def __getitem__(self, frame: int) -> Dict[str, np.ndarray]:
+        """Image and mask of frame (0-based frame index of the run, not position in the dataset)."""
+        if frame < 0 or frame >= len(self.frame_entry) or self.frame_entry[frame] < 0:
+            raise IndexError(f"frame {frame} is not in the dataset")
+        entry = self.entries[self.frame_entry[frame]]
+        row = frame - entry["frame_start"]
+        sample = {"frame": frame, "image": np.array(self.array(entry["images"])[row])}
+        if entry["masks"] is not None:
+            sample["mask"] = np.array(self.array(entry["masks"])[row])
+        if self.labels is not None:
+            start, stop = self.label_starts[frame], self.label_starts[frame + 1]
+            labels = {key: value[start:stop] for key, value in self.labels.items() if not key.startswith("rle_")}
+            if "rle_counts" in self.labels:
+                offsets = self.labels["rle_offsets"]
+                labels["rle"] = [self.labels["rle_counts"][offsets[k] : offsets[k + 1]] for k in range(start, stop)]
+            sample["labels"] = labels
+        return sample
@@ -1,16 +1,80 @@
+import json
 import os
+import random
 
-from .blender_objects import Camera, Grid, Light
-from .render import render
-from .utils import createSegmentationMaterial, importProps, newScene
+import bpy
+import numpy as np
 
+from .appearance import sample_appearance
+from .autotune import tune_profile
+from .blender_objects import AppearancePool, Camera, Grid, Light, PropPool, RandomLayout
+from .dataset import ShardWriter
+from .labels import LabelWriter
+from .launch import template_key
+from .lod import load_lod_policy
+from .lod_cache import PropLods, lodCacheDirectory
+from .manifest import Manifest, finished_frames, pose_hash
+from .metrics import EVENTS_NAME
+from .profiles import apply_profile, load_profile
+from .prop_library import PropLibrary
+from .render import render, render_batch, visibility_scorer
+from .sampling import sample_poses, save_poses
+from .stream import StreamWriter
+from .utils import (
+    addViewerNode,
+    createSegmentationCompositor,
+    importProps,
+    newScene,
+    removeScene,
+    setSegmentationColors,
+    writeInstanceTable,
+)
+from .visibility import load_visibility_policy, screen_poses
+from .writer import AsyncImageWriter
 
-def generate(prop_paths, save_path, n_images, n_instances):
-    # prop_path = list(prop_paths.values())[0]
-    prop_path = prop_paths
-    render_directory = os.path.join(save_path, "renders")
 
-    newScene()
+def load_props(prop_path, prop_cache=True, lazy_props=False, max_loaded_props=64, max_polycount=None, session=None):
+    """
+    Imports the props, or with lazy_props only indexes them in a PropLibrary that loads the sampled ones.
+
+        Parameters:
+            session (dict): Kept by the daemon between jobs, props imported by an earlier job are reused.
+
+        Returns:
+            library (PropLibrary): None unless lazy_props.
+            prop_name_list (list(str)): Names of the template objects.
+    """
+    key = (prop_path, prop_cache, lazy_props, max_loaded_props)
+    if session is not None and key in session:
+        library, prop_name_list = session[key]
+        if library is not None or all(name in bpy.data.objects for name in prop_name_list):
+            return library, library.select(max_polycount=max_polycount) if library is not None else prop_name_list
+
+    library = None
+    if lazy_props:
+        library = PropLibrary(prop_path, max_loaded=max_loaded_props)
+        prop_name_list = library.select(max_polycount=max_polycount)
+    else:
+        prop_name_list = importProps(prop_path, cache=prop_cache)
+    if session is not None:
+        session[key] = (library, prop_name_list)
+    return library, prop_name_list
+
+
+def setup_scene(n_instances, segmentation="material", depth=False, normal=False, mask_encoding="ramp", profile=None):
+    """
+    Render settings, lights, camera and, with "passes" segmentation, compositor of the current scene, everything of a
+    run that does not depend on the props.
+
+        Returns:
+            lights (list(Light)): The two lights.
+            camera (Camera): The render camera.
+            segmentation_output (bpy.types.CompositorNodeOutputFile): From createSegmentationCompositor, None unless
+                segmentation is "passes".
+    """
+    # Engine, sampling and denoising settings, a name of profiles.RENDER_PROFILES or a profile file
+    if profile is not None:
+        apply_profile(bpy.context.scene, load_profile(profile))
 
     light = Light("test_light")
     light.data.energy = 80
@@ -19,15 +83,314 @@ def generate(prop_paths, save_path, n_images, n_instances):
     light2.data.energy = 80
     light2.move_rel_cartesian((3, 1, 0))
 
-    # Import props
-    prop_name_list = importProps(prop_path)
+    camera = Camera("test_camera")
+
+    segmentation_output = None
+    if segmentation == "passes":
+        segmentation_output = createSegmentationCompositor(
+            n_instances, depth=depth, normal=normal, encoding=mask_encoding
+        )
+    return [light, light2], camera, segmentation_output
+
+
+def template_scene(scene):
+    """setup_scene of a template scene opened as the main file, see build_template."""
+    lights = [Light(name, existing=scene.objects[name]) for name in ("test_light", "test_light_2")]
+    camera = Camera("test_camera", existing=scene.objects["test_camera"])
+    segmentation_output = None
+    if scene.node_tree is not None:
+        nodes = scene.node_tree.nodes
+        segmentation_output = next((node for node in nodes if node.bl_idname == "CompositorNodeOutputFile"), None)
+    return lights, camera, segmentation_output
+
+
+def build_template(
+    path, n_instances, segmentation="material", depth=False, normal=False, mask_encoding="ramp", profile=None
+):
+    """
+    Saves a scene made by setup_scene, without props, as the main file path. Workers launched with it as their main
+    file (see launch.blender_command) start rendering without building the scene.
+    """
+    random.seed(0)  # Colours of the segmentation ramp, a rebuilt template is the same
+    default_scene = bpy.context.scene
+    newScene()
+    removeScene(default_scene)  # Objects of the factory startup file
+    setup_scene(n_instances, segmentation, depth, normal, mask_encoding, profile)
+    key = template_key(n_instances, segmentation, mask_encoding, depth, normal, profile)
+    bpy.context.scene["blendgen_template"] = key
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp.blend"
+    bpy.ops.wm.save_as_mainfile(filepath=temporary_path, copy=True)
+    os.replace(temporary_path, path)
+
+
+def generate(
+    prop_paths,
+    save_path,
+    n_images,
+    n_instances,
+    frame_start=0,
+    frame_end=None,
+    seed=None,
+    scene_seed=None,
+    threads=0,
+    worker=False,
+    segmentation="material",
+    depth=False,
+    normal=False,
+    prop_cache=True,
+    lazy_props=False,
+    max_loaded_props=64,
+    max_polycount=None,
+    mask_encoding="ramp",
+    lens_range=(50, 50),
+    target_jitter=0.0,
+    labels=False,
+    geometry_labels=False,
+    async_write=False,
+    image_format="png",
+    compress_level=1,
+    writer_threads=4,
+    max_pending=8,
+    output_format="files",
+    shard_size=1000,
+    resume=False,
+    profile=None,
+    autotune=False,
+    min_psnr=30.0,
+    batch_size=0,
+    layout="grid",
+    density=0.2,
+    scale_range=(1, 1),
+    pool=False,
+    pool_size=None,
+    session=None,
+    stream_port=None,
+    stream_chunk=64,
+    stream_stride=None,
+    lod=None,
+    material_variants=0,
+    light_rigs=0,
+    visibility=None,
+):
+    # prop_path = list(prop_paths.values())[0]
+    prop_path = prop_paths
+    render_directory = os.path.join(save_path, "renders")
+    labels_directory = os.path.join(save_path, "labels")
+
+    # Seed both random sources used by blender_objects, workers share the scene seed so they build the same scene
+    scene_seed = seed if scene_seed is None else scene_seed
+    if scene_seed is None:
+        scene_seed = int(np.random.SeedSequence().entropy % 2**31)
+    random.seed(scene_seed)
+    np.random.seed(scene_seed)
+
+    # Use the scene of the template opened as the main file (see build_template), otherwise build it
+    scene = bpy.context.scene
+    if scene.get("blendgen_template") == template_key(n_instances, segmentation, mask_encoding, depth, normal, profile):
+        del scene["blendgen_template"]  # Later jobs of a daemon build their own scene
+        lights, camera, segmentation_output = template_scene(scene)
+    else:
+        newScene()
+        lights, camera, segmentation_output = setup_scene(
+            n_instances, segmentation, depth, normal, mask_encoding, profile
+        )
+
+    # Limit render threads, used when several workers share the machine
+    if threads > 0:
+        bpy.context.scene.render.threads_mode = "FIXED"
+        bpy.context.scene.render.threads = threads
+
+    # Import props, or only index them and load the sampled ones
+    library, prop_name_list = load_props(prop_path, prop_cache, lazy_props, max_loaded_props, max_polycount, session)
 
     # Create grid of objects
-    createSegmentationMaterial(n_instances)
-    grid = Grid(n_instances)
-    grid.populate(prop_name_list, n_instances)
+    if pool:
+        # Members of every prop, a new composition is shown in every frame
+        grid = PropPool(
+            n_instances, scene_seed, pool_size=pool_size, layout=layout, density=density, scale_range=scale_range
+        )
+    elif layout == "grid":
+        grid = Grid(n_instances)
+    else:
+        grid = RandomLayout(n_instances, density=density, scale_range=scale_range, ground=layout == "ground")
+    grid.populate(prop_name_list, n_instances, library=library)
+    if segmentation == "material":
+        setSegmentationColors(grid.members, mask_encoding)
+    writeInstanceTable(labels_directory, grid.members, mask_encoding)
+
+    # Material variants and light rigs, built once and picked per frame by index
+    appearance_pool = None
+    if material_variants > 0 or light_rigs > 0:
+        light_radius_range = (grid.distance_to_edge * 1.2, grid.distance_to_edge * 2.5)
+        appearance_pool = AppearancePool(
+            grid.members, lights, scene_seed, material_variants, light_rigs, grid.center, light_radius_range
+        )
+
+    # Decimated levels of detail, cached next to the props, shown by projected size
+    lods = None
+    if lod is not None:
+        lods = PropLods(grid.members, load_lod_policy(lod), lodCacheDirectory(prop_path))
 
     # Render
-    camera = Camera("test_camera")
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    def sample_frame_poses(frames, attempt=0):
+        poses = sample_poses(
+            scene_seed,
+            frames,
+            n_instances,
+            grid.center,
+            (grid.distance_to_edge * 1.8, grid.distance_to_edge * 2.2),
+            lens_range=lens_range,
+            target_jitter=target_jitter,
+            upper_hemisphere=layout == "ground",
+            attempt=attempt,
+        )
+        poses.update(sample_appearance(scene_seed, frames, n_instances, material_variants, light_rigs))
+        return poses
+
+    # Score the poses from the geometry and draw the ones of frames with too few visible props again
+    visibility_policy = load_visibility_policy(visibility) if visibility is not None else None
+
+    def frame_poses(frames):
+        if visibility_policy is None:
+            return sample_frame_poses(frames)
+        score = visibility_scorer(camera, grid, visibility_policy)
+        return screen_poses(lambda attempt: sample_frame_poses(frames, attempt), score, len(frames), visibility_policy)
+
+    # Send the frames to a stream.SampleStream, chunk by chunk and without an end if frame_end is None
+    if stream_port is not None:
+        addViewerNode()
+        bpy.context.scene.view_settings.view_transform = "Standard"  # Applied by the writer as the sRGB curve
+        assert segmentation == "material", "streaming requires material masks"
+        stream = StreamWriter(stream_port)
+        try:
+            chunk_start = frame_start
+            while frame_end is None or chunk_start < frame_end:
+                chunk_end = chunk_start + stream_chunk
+                chunk = range(chunk_start, chunk_end if frame_end is None else min(chunk_end, frame_end))
+                render(
+                    render_directory,
+                    camera,
+                    grid,
+                    n_images=max(n_images, chunk.stop),
+                    frames=chunk,
+                    worker=worker,
+                    mask_encoding=mask_encoding,
+                    poses=frame_poses(chunk),
+                    label_writer=stream,
+                    mask_labels=labels,
+                    geometry_labels=geometry_labels,
+                    image_writer=stream,
+                    lods=lods,
+                    appearance_pool=appearance_pool,
+                )
+                chunk_start += stream_stride or stream_chunk
+        finally:
+            stream.close()
+        return
+
+    # Sample all poses up front from the run's seed, the same for every worker
+    frames = range(frame_start, n_images if frame_end is None else frame_end)
+    poses = frame_poses(frames)
+
+    # Only time calibration frames and write the fastest profile meeting min_psnr to profile.json
+    if autotune:
+        addViewerNode()
+        chosen, results = tune_profile(camera, grid, poses, min_psnr=min_psnr)
+        tuned = {"name": chosen["name"], "profile": chosen["profile"], "min_psnr": min_psnr, "results": results}
+        with open(os.path.join(save_path, "profile.json"), "w") as f:
+            json.dump(tuned, f, indent=1)
+        print(f"Chose {chosen['name']}: {chosen['seconds']:.3f} s/frame, {chosen['psnr']:.1f} dB")
+        return
+
+    save_poses(os.path.join(labels_directory, f"poses_{frames.start:07}-{frames.stop:07}.npz"), poses)
+
+    # Only render the frames an earlier run did not finish, poses only depend on the frame so the result is the same
+    n_finished = 0
+    render_frames = frames
+    if resume:
+        pose_hashes = {frame: pose_hash(poses, k) for k, frame in enumerate(frames)}
+        labels_path = labels_directory if labels or geometry_labels else None
+        finished = set(finished_frames(save_path, frames, labels_path, pose_hashes))
+        rows = np.array([k for k, frame in enumerate(frames) if frame not in finished], dtype=np.int64)
+        n_finished = len(frames) - len(rows)
+        poses = {key: value[rows] for key, value in poses.items()}
+        render_frames = [frames[k] for k in rows]
+    label_writer = LabelWriter(labels_directory, f"{frames.start:07}") if labels or geometry_labels else None
+
+    # Encode and write images on background threads,
+    # or pack them into memory-mapped shards
+    image_writer = None
+    if async_write or output_format == "shards":
+        addViewerNode()
+        bpy.context.scene.view_settings.view_transform = "Standard"  # Applied by the writer as the sRGB curve
+    if output_format == "shards":
+        image_writer = ShardWriter(render_directory, f"{frames.start:07}", shard_size=shard_size)
+    elif async_write:
+        image_writer = AsyncImageWriter(image_format, compress_level, n_threads=writer_threads, max_pending=max_pending)
+
+    # Record finished frames so the run can be resumed, the checksums of asynchronous writes come from the writer
+    manifest = None
+    if output_format == "files":
+        manifest = Manifest(save_path, scene_seed, checksums=image_writer.checksums if async_write else None)
+
+    # Workers report their events to the parent process, which writes them
+    events_path = None if worker else os.path.join(save_path, EVENTS_NAME)
 
-    render(render_directory, camera, grid, n_images=n_images)
+    # Close the writers also when a render fails, so no writer threads or shards outlive the run (or the daemon job)
+    try:
+        if batch_size > 1 and image_writer is None and not pool and lods is None and appearance_pool is None:
+            # Keyframe the poses and render batches of frames as animations
+            render_batch(
+                render_directory,
+                camera,
+                grid,
+                poses,
+                list(render_frames),
+                n_images,
+                batch_size=batch_size,
+                worker=worker,
+                segmentation_output=segmentation_output,
+                mask_encoding=mask_encoding,
+                label_writer=label_writer,
+                mask_labels=labels,
+                geometry_labels=geometry_labels,
+                manifest=manifest,
+                n_finished=n_finished,
+                events_path=events_path,
+            )
+        else:
+            render(
+                render_directory,
+                camera,
+                grid,
+                n_images=n_images,
+                frames=render_frames,
+                worker=worker,
+                segmentation_output=segmentation_output,
+                mask_encoding=mask_encoding,
+                poses=poses,
+                label_writer=label_writer,
+                mask_labels=labels,
+                geometry_labels=geometry_labels,
+                image_writer=image_writer,
+                manifest=manifest,
+                n_finished=n_finished,
+                events_path=events_path,
+                lods=lods,
+                appearance_pool=appearance_pool,
+            )
+    finally:
+        if image_writer is not None:
+            image_writer.close()
+        if label_writer is not None:
+            label_writer.close()
+        if manifest is not None:
+            manifest.flush()  # Frames finished before an error are kept for --resume
+    if manifest is not None:
+        manifest.close()
@@ -0,0 +1,134 @@
+"""
+Analytic labels computed from scene geometry: mesh vertices are transformed and projected through the camera for all
+instances at once with NumPy, no extra render passes are needed. Does not depend on bpy.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Blender cameras look along -Z with +Y up, image coordinates have +Y down
+BLENDER_TO_IMAGE = np.diag([1.0, -1.0, -1.0, 1.0])
+NEAR = 1e-6
+
+
+def camera_intrinsics(
+    lens: float, sensor_width: float, sensor_height: float, sensor_fit: str, resolution: Tuple[int, int]
+) -> np.ndarray:
+    """3x3 pinhole intrinsics in pixels of a Blender camera without shift and with square pixels."""
+    width, height = resolution
+    if sensor_fit == "VERTICAL" or (sensor_fit == "AUTO" and height > width):
+        sensor_size = sensor_width if sensor_fit == "AUTO" else sensor_height
+        focal = lens / sensor_size * height
+    else:
+        focal = lens / sensor_width * width
+    return np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
+
+
+def project(points: np.ndarray, camera_matrix: np.ndarray, intrinsics: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Projects (..., 3) world points.
+
+        Returns:
+            pixels (np.ndarray): (..., 2) image coordinates, origin at the top left corner.
+            depth (np.ndarray): (...) distance along the viewing direction, <= 0 behind the camera.
+    """
+    world_to_image = BLENDER_TO_IMAGE @ np.linalg.inv(camera_matrix)
+    camera_points = points @ world_to_image[:3, :3].T + world_to_image[:3, 3]
+    depth = camera_points[..., 2]
+    safe_depth = np.where(depth > NEAR, depth, NEAR)
+    pixels = camera_points[..., :2] / safe_depth[..., None] @ intrinsics[:2, :2].T + intrinsics[:2, 2]
+    return pixels, depth
+
+
+def box_corners(bound_min: np.ndarray, bound_max: np.ndarray) -> np.ndarray:
+    """(8, 3) corners of an axis aligned box."""
+    selector = np.array([[i >> 2 & 1, i >> 1 & 1, i & 1] for i in range(8)], dtype=bool)
+    return np.where(selector, bound_max, bound_min)
+
+
+def transform(matrices: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """(k, n, 3) points transformed by each of the (k, 4, 4) matrices."""
+    return points @ matrices[:, :3, :3].transpose(0, 2, 1) + matrices[:, None, :3, 3]
+
+
+def annotate_geometry(
+    template_vertices: List[np.ndarray],
+    instance_template: np.ndarray,
+    matrices: np.ndarray,
+    camera_matrix: np.ndarray,
+    intrinsics: np.ndarray,
+    resolution: Tuple[int, int],
+    max_points: int = 4_000_000,
+) -> Dict[str, np.ndarray]:
+    """
+    2D boxes, oriented 3D boxes and keypoints of every instance. Instances sharing a template are projected together,
+    in chunks of at most max_points vertices, so the cost scales with the vertex count and not with the pixels.
+
+        Parameters:
+            template_vertices (list(np.ndarray)): (n_vertices, 3) local vertex coordinates of each template mesh.
+            instance_template (np.ndarray): (k,) index into template_vertices of every instance.
+            matrices (np.ndarray): (k, 4, 4) world matrices of the instances.
+            camera_matrix (np.ndarray): (4, 4) world matrix of the camera.
+            intrinsics (np.ndarray): (3, 3) from camera_intrinsics.
+            resolution (tuple(int)): Image width and height in pixels.
+
+        Returns:
+            annotations (dict(str, np.ndarray)): "bbox_2d" (k, 4) [x_min, y_min, x_max, y_max] clipped to the image,
+            -1 if the instance is out of view, "truncated" (k,) whether the box was clipped, "bbox_3d" (k, 8, 3) world
+            corners of the oriented box, "keypoints" (k, 9, 2) projected box corners and center and "depth" (k,)
+            depth of the center.
+    """
+    width, height = resolution
+    n_instances = len(instance_template)
+    bbox_2d = np.full((n_instances, 4), -1.0)
+    truncated = np.zeros(n_instances, dtype=bool)
+    bbox_3d = np.empty((n_instances, 8, 3))
+
+    for template_idx, vertices in enumerate(template_vertices):
+        instances = np.flatnonzero(instance_template == template_idx)
+        if len(instances) == 0:
+            continue
+
+        corners = box_corners(vertices.min(axis=0), vertices.max(axis=0))
+        bbox_3d[instances] = transform(matrices[instances], corners)
+
+        chunk_size = max(1, max_points // max(1, len(vertices)))
+        for chunk_start in range(0, len(instances), chunk_size):
+            chunk = instances[chunk_start : chunk_start + chunk_size]
+            pixels, depth = project(transform(matrices[chunk], vertices), camera_matrix, intrinsics)
+            in_front = depth > NEAR
+            visible = in_front.any(axis=1)
+
+            x = pixels[..., 0]
+            y = pixels[..., 1]
+            box = np.stack(
+                (
+                    np.where(in_front, x, np.inf).min(axis=1),
+                    np.where(in_front, y, np.inf).min(axis=1),
+                    np.where(in_front, x, -np.inf).max(axis=1),
+                    np.where(in_front, y, -np.inf).max(axis=1),
+                ),
+                axis=1,
+            )
+            clipped = np.stack(
+                (
+                    np.clip(box[:, 0], 0, width),
+                    np.clip(box[:, 1], 0, height),
+                    np.clip(box[:, 2], 0, width),
+                    np.clip(box[:, 3], 0, height),
+                ),
+                axis=1,
+            )
+            in_view = visible & (clipped[:, 2] > clipped[:, 0]) & (clipped[:, 3] > clipped[:, 1])
+            bbox_2d[chunk[in_view]] = clipped[in_view]
+            truncated[chunk] = in_view & ((~in_front.all(axis=1)) | np.any(box != clipped, axis=1))
+
+    centers = bbox_3d.mean(axis=1, keepdims=True)
+    keypoints, keypoint_depth = project(np.concatenate((bbox_3d, centers), axis=1), camera_matrix, intrinsics)
+    return {
+        "bbox_2d": bbox_2d,
+        "truncated": truncated,
+        "bbox_3d": bbox_3d,
+        "keypoints": keypoints,
+        "depth": keypoint_depth[:, -1],
+    }
@@ -0,0 +1,216 @@
+"""
+Per-instance annotations computed from instance id masks with vectorized NumPy, and a writer streaming any per-instance
+annotations (also the ones from geometry.annotate_geometry) into columnar .npz shards with an append-only index. Does
+not depend on bpy.
+"""
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+LABELS_INDEX_NAME = "index.jsonl"
+MAX_INSTANCE_ID = 32767  # Instance ids are Object.pass_index, a short in Blender
+
+
+def mask_bounding_boxes(ids: np.ndarray, instance_ids: np.ndarray) -> np.ndarray:
+    """(n, 4) [x_min, y_min, x_max, y_max) pixel boxes of instance_ids in ids, -1 for instances not in the mask."""
+    height, width = ids.shape
+    flat = ids.ravel()
+    order = np.argsort(flat, kind="stable")
+    sorted_ids = flat[order]
+    present, starts = np.unique(sorted_ids, return_index=True)
+    xs = order % width
+    ys = order // width
+
+    boxes_present = np.stack(
+        (
+            np.minimum.reduceat(xs, starts),
+            np.minimum.reduceat(ys, starts),
+            np.maximum.reduceat(xs, starts) + 1,
+            np.maximum.reduceat(ys, starts) + 1,
+        ),
+        axis=1,
+    )
+    boxes = np.full((len(instance_ids), 4), -1, dtype=np.int32)
+    position = np.searchsorted(present, instance_ids)
+    found = (position < len(present)) & (present[np.minimum(position, len(present) - 1)] == instance_ids)
+    boxes[found] = boxes_present[position[found]]
+    return boxes
+
+
+def mask_rle(ids: np.ndarray, instance_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Uncompressed COCO style run-length encodings (column major, starting with a run of zeros) of every instance.
+
+        Returns:
+            counts (np.ndarray): All run lengths concatenated.
+            offsets (np.ndarray): (n + 1,) counts[offsets[k] : offsets[k + 1]] is the encoding of instance_ids[k].
+    """
+    height, width = ids.shape
+    column_major = ids.T.ravel()
+    change = np.flatnonzero(column_major[1:] != column_major[:-1]) + 1
+    run_starts = np.concatenate(([0], change))
+    run_ends = np.concatenate((change, [column_major.size]))
+    run_values = column_major[run_starts]
+
+    # Runs of the instances, grouped by instance in instance_ids order, in pixel order within a group
+    instance_position = np.full(max(run_values.max(initial=0), instance_ids.max(initial=0)) + 1, -1)
+    instance_position[instance_ids] = np.arange(len(instance_ids))
+    run_instance = instance_position[run_values]
+    keep = (run_values > 0) & (run_instance >= 0)
+    order = np.argsort(run_instance[keep], kind="stable")
+    run_instance = run_instance[keep][order]
+    run_starts = run_starts[keep][order]
+    run_ends = run_ends[keep][order]
+
+    # Each instance gets 2 * n_runs + 1 counts: (zeros, ones) per run and the trailing zeros
+    n_runs = np.bincount(run_instance, minlength=len(instance_ids))
+    n_counts = 2 * n_runs + 1
+    offsets = np.concatenate(([0], np.cumsum(n_counts)))
+    counts = np.empty(offsets[-1], dtype=np.int64)
+
+    first_run = np.concatenate(([0], np.cumsum(n_runs)))[:-1]
+    run_rank = np.arange(len(run_instance)) - first_run[run_instance]
+    previous_end = np.empty_like(run_ends)
+    previous_end[1:] = run_ends[:-1]
+    previous_end[run_rank == 0] = 0
+    position = offsets[run_instance] + 2 * run_rank
+    counts[position] = run_starts - previous_end
+    counts[position + 1] = run_ends - run_starts
+
+    last_end = np.zeros(len(instance_ids), dtype=np.int64)
+    has_runs = n_runs > 0
+    last_end[has_runs] = run_ends[first_run[has_runs] + n_runs[has_runs] - 1]
+    counts[offsets[1:] - 1] = column_major.size - last_end
+    return counts, offsets
+
+
+def annotate_mask(ids: np.ndarray, instance_ids: List[int], amodal_areas: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """
+    Annotations of every instance from a (height, width) instance id mask, without per pixel Python loops.
+
+        Parameters:
+            ids (np.ndarray): Instance id of each pixel, 0 is background, row 0 is the top of the image.
+            instance_ids (list(int)): Ids of all instances in the scene, also the ones not visible.
+            amodal_areas (np.ndarray): Unoccluded pixel area of each instance if known, gives the visibility.
+
+        Returns:
+            annotations (dict(str, np.ndarray)): "instance_id", "area", "bbox", "visibility" (NaN if amodal_areas is
+            not given), "rle_counts" and "rle_offsets" (see mask_rle).
+    """
+    instance_ids = np.asarray(instance_ids, dtype=np.int64)
+    ids = ids.astype(np.int64, copy=False)
+    area = np.bincount(ids.ravel(), minlength=instance_ids.max(initial=0) + 1)[instance_ids]
+    if amodal_areas is None:
+        visibility = np.full(len(instance_ids), np.nan)
+    else:
+        visibility = np.clip(area / np.maximum(amodal_areas, 1), 0, 1)
+    rle_counts, rle_offsets = mask_rle(ids, instance_ids)
+    return {
+        "instance_id": instance_ids,
+        "area": area,
+        "bbox": mask_bounding_boxes(ids, instance_ids),
+        "visibility": visibility,
+        "rle_counts": rle_counts,
+        "rle_offsets": rle_offsets,
+    }
+
+
+def select_rows(columns: Dict[str, np.ndarray], rows: np.ndarray) -> Dict[str, np.ndarray]:
+    """Rows of columns of annotations, with "rle_counts" and "rle_offsets" of the selected rows only."""
+    selected = {key: value[rows] for key, value in columns.items() if key not in ("rle_counts", "rle_offsets")}
+    if "rle_counts" in columns:
+        offsets = columns["rle_offsets"]
+        lengths = offsets[rows + 1] - offsets[rows]
+        selected["rle_offsets"] = np.concatenate(([0], np.cumsum(lengths)))
+        start = np.repeat(offsets[rows] - selected["rle_offsets"][:-1], lengths)
+        selected["rle_counts"] = columns["rle_counts"][start + np.arange(selected["rle_offsets"][-1])]
+    return selected
+
+
+def concatenate_rows(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Concatenates columns of annotations, rebasing "rle_offsets" onto the concatenated "rle_counts"."""
+    keys = [key for key in parts[0] if key not in ("rle_counts", "rle_offsets")]
+    columns = {key: np.concatenate([part[key] for part in parts]) for key in keys}
+    if "rle_counts" in parts[0]:
+        columns["rle_counts"] = np.concatenate([part["rle_counts"] for part in parts])
+        rle_starts = np.cumsum([0] + [len(part["rle_counts"]) for part in parts])
+        columns["rle_offsets"] = np.concatenate(
+            [part["rle_offsets"][:-1] + start for start, part in zip(rle_starts, parts)] + [rle_starts[-1:]]
+        )
+    return columns
+
+
+class LabelWriter:
+    """
+    Buffers per-frame annotations and writes them as columnar .npz shards, one row per (frame, instance). Every
+    written shard is appended to index.jsonl, so several workers can write into the same directory.
+    """
+
+    def __init__(self, labels_directory: str, name: str, frames_per_shard: int = 1000) -> None:
+        self.labels_directory = labels_directory
+        self.name = name
+        self.frames_per_shard = frames_per_shard
+        self.n_shards = 0
+        self.rows = []
+
+        # Resumed runs add shards next to the ones already written
+        while os.path.exists(self.shard_path()):
+            self.n_shards += 1
+
+    def shard_path(self) -> str:
+        return os.path.join(self.labels_directory, f"labels_{self.name}_{self.n_shards:05}.npz")
+
+    def add(self, frame: int, annotations: Dict[str, np.ndarray]) -> None:
+        self.rows.append((frame, annotations))
+        if len(self.rows) >= self.frames_per_shard:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.rows) == 0:
+            return
+
+        columns = concatenate_rows([annotations for _, annotations in self.rows])
+        columns["frame"] = np.concatenate(
+            [np.full(len(annotations["instance_id"]), frame) for frame, annotations in self.rows]
+        )
+
+        filename = os.path.basename(self.shard_path())
+        np.savez(self.shard_path(), **columns)
+        entry = {
+            "file": filename,
+            "frame_start": int(self.rows[0][0]),
+            "frame_stop": int(self.rows[-1][0]) + 1,
+            "n_rows": len(columns["frame"]),
+        }
+        with open(os.path.join(self.labels_directory, LABELS_INDEX_NAME), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        self.n_shards += 1
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+def load_labels(labels_directory: str) -> Dict[str, np.ndarray]:
+    """
+    Concatenates all shards listed in index.jsonl, sorted by frame. Frames rendered again by a resumed run only keep
+    the rows of the shard written last.
+    """
+    with open(os.path.join(labels_directory, LABELS_INDEX_NAME)) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    shards = []
+    for entry in entries:
+        with np.load(os.path.join(labels_directory, entry["file"])) as data:
+            shards.append({key: data[key] for key in data.files})
+    columns = concatenate_rows(shards)
+
+    frame = columns["frame"]
+    shard = np.concatenate([np.full(len(part["frame"]), shard_idx) for shard_idx, part in enumerate(shards)])
+    last_shard = np.zeros(frame.max(initial=0) + 1, dtype=np.int64)
+    np.maximum.at(last_shard, frame, shard)
+    rows = np.flatnonzero(shard == last_shard[frame])
+    rows = rows[np.argsort(frame[rows], kind="stable")]
+    return select_rows(columns, rows)
@@ -0,0 +1,294 @@
+"""Launching and supervision of Blender worker processes. Does not depend on bpy, used by the CLI."""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+from .daemon import DEFAULT_PORT, job_output, submit_job
+from .metrics import EVENTS_NAME, Aggregator, parse_event, serve_metrics
+
+MAIN_BLENDER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main_blender.py")
+TEMPLATE_VERSION = 2  # Bumped when setup_scene changes what a template holds
+
+
+def split_frames(n_images: int, n_workers: int) -> List[Tuple[int, int]]:
+    """Splits range(n_images) into at most n_workers disjoint, contiguous (start, end) ranges."""
+    n_workers = max(1, min(n_workers, n_images))
+    base, remainder = divmod(n_images, n_workers)
+    frame_ranges = []
+    start = 0
+    for worker_idx in range(n_workers):
+        end = start + base + (1 if worker_idx < remainder else 0)
+        frame_ranges.append((start, end))
+        start = end
+    return frame_ranges
+
+
+def template_key(
+    n_instances: int,
+    segmentation: str = "material",
+    mask_encoding: str = "ramp",
+    depth: bool = False,
+    normal: bool = False,
+    profile: str = None,
+) -> str:
+    """Name of the template scene built with these settings, see generate.build_template."""
+    settings = [TEMPLATE_VERSION, segmentation, mask_encoding, depth, normal, profile]
+    if mask_encoding == "ramp":
+        settings.append(n_instances)  # Splits of the colour ramp
+    if profile is not None and os.path.isfile(profile):
+        settings.append(os.path.getmtime(profile))
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:16]
+
+
+def scene_settings(options: List[str]) -> Dict:
+    """The main_blender.py options of a job the scene of generate.setup_scene depends on, as template_key arguments."""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--segmentation", default="material")
+    parser.add_argument("--mask-encoding", default="ramp")
+    parser.add_argument("--depth", action="store_true")
+    parser.add_argument("--normal", action="store_true")
+    parser.add_argument("--profile", default=None)
+    args, _ = parser.parse_known_args([str(option) for option in options])
+    return vars(args)
+
+
+def template_path(prop_path: str, key: str) -> str:
+    """Template .blend of key in .blendgen_cache/templates/ of the prop directory."""
+    prop_dir = prop_path if os.path.isdir(prop_path) else os.path.dirname(prop_path)
+    return os.path.join(prop_dir, ".blendgen_cache", "templates", f"{key}.blend")
+
+
+def blender_arguments(template: str = None) -> List[str]:
+    """
+    Background Blender with factory settings, so the user's startup file and add-ons are not loaded, opening template
+    as the main file if given.
+    """
+    arguments = ["blender", "--background", "--factory-startup"]
+    if template is not None:
+        arguments.append(template)
+    return arguments + ["--python-exit-code", "1", "--python", MAIN_BLENDER_PATH, "--"]
+
+
+def blender_command(
+    prop_path: str, save_dir_path: str, n_images: int, n_instances: int, *options: str, template: str = None
+) -> List[str]:
+    """Argument list running main_blender.py in a background Blender, exiting non-zero on Python errors."""
+    command = blender_arguments(template)
+    command += [prop_path, save_dir_path, str(n_images), str(n_instances)]
+    command += [str(option) for option in options]
+    return command
+
+
+def build_template(path: str, n_instances: int, *options: str) -> int:
+    """
+    Builds the template scene of jobs with options (see scene_settings) in a Blender and saves it to path.
+
+        Returns:
+            exit_code (int): Exit code of Blender.
+    """
+    print(f"Building template scene {path}.")
+    command = blender_arguments() + ["--build-template", path, str(n_instances)]
+    command += [str(option) for option in options]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if process.returncode != 0:
+        print(f"ERROR: Building the template scene exited with {process.returncode}")
+        print(process.stdout)
+    return process.returncode
+
+
+def run_workers(
+    prop_path: str,
+    save_dir_path: str,
+    n_images: int,
+    n_instances: int,
+    n_workers: int,
+    seed: int,
+    *options: str,
+    metrics_port: int = None,
+    template: str = None,
+) -> int:
+    """
+    Renders n_images with n_workers Blender processes in parallel and merges their per-frame events (see
+    metrics.Metrics) into the throughput of the run, shown as a progress line and appended to events.jsonl.
+
+        Parameters:
+            n_workers (int): Number of Blender processes, each renders a disjoint range of frames.
+            seed (int): Seed of every worker, frames only depend on it and their index (see sampling.sample_poses), so
+                the workers build the same scene and split the frames of a single run.
+            options (str): Extra arguments passed on to every main_blender.py.
+            metrics_port (int): If given, the merged metrics are served as Prometheus text on
+                http://127.0.0.1:metrics_port/metrics while the workers run.
+            template (str): Template .blend opened by every worker instead of building the scene, see build_template.
+
+        Returns:
+            exit_code (int): 0 if all workers succeeded, otherwise 1.
+    """
+    frame_ranges = split_frames(n_images, n_workers)
+    threads_per_worker = max(1, (os.cpu_count() or 1) // len(frame_ranges))
+
+    print()
+    n_workers = len(frame_ranges)
+    print(f"Generating {n_images} renders in {save_dir_path} with {n_workers} worker{'s' if n_workers > 1 else ''}.")
+
+    launch_time = time.time()
+    processes = []
+    for worker_idx, (frame_start, frame_end) in enumerate(frame_ranges):
+        command = blender_command(
+            prop_path,
+            save_dir_path,
+            n_images,
+            n_instances,
+            "--frame-start",
+            frame_start,
+            "--frame-end",
+            frame_end,
+            "--seed",
+            seed,
+            "--scene-seed",
+            seed,
+            "--threads",
+            threads_per_worker,
+            "--worker",
+            *options,
+            template=template,
+        )
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True
+        )
+        processes.append(process)
+
+    outputs = [process.stdout for process in processes]
+    tails = follow_workers(outputs, n_images, save_dir_path, metrics_port, launch_time=launch_time)
+
+    # Merge exit status
+    exit_code = 0
+    for worker_idx, process in enumerate(processes):
+        if process.wait() != 0:
+            frame_start, frame_end = frame_ranges[worker_idx]
+            print()
+            print(f"ERROR: Worker {worker_idx} (frames {frame_start}-{frame_end - 1}) exited with {process.returncode}")
+            for line in tails[worker_idx]:
+                print(f"    {line}")
+            exit_code = 1
+
+    return exit_code
+
+
+def run_in_daemon(
+    prop_path: str,
+    save_dir_path: str,
+    n_images: int,
+    n_instances: int,
+    seed: int,
+    *options: str,
+    port: int = DEFAULT_PORT,
+    metrics_port: int = None,
+) -> int:
+    """
+    Renders n_images in the running daemon (see daemon.py) instead of a new Blender, like run_workers with one
+    worker.
+
+        Returns:
+            exit_code (int): Exit code of the job, None if the daemon did not take it (it is busy, stopped or speaks
+            another protocol version).
+    """
+    # Same arguments as a worker of run_workers rendering every frame
+    command = blender_command(prop_path, save_dir_path, n_images, n_instances, "--seed", seed, "--scene-seed", seed)
+    argv = command[command.index("--") + 1 :] + ["--worker", *options]
+    launch_time = time.time()
+    connection = submit_job(argv, port)
+    if connection is None:
+        print(f"The daemon on port {port} did not take the job, starting Blender instead.")
+        return None
+
+    print()
+    print(f"Generating {n_images} renders in {save_dir_path} with the daemon on port {port}.")
+    result = {}
+    tails = follow_workers([job_output(connection, result)], n_images, save_dir_path, metrics_port, launch_time)
+
+    if result["exit_code"] != 0:
+        print()
+        print(f"ERROR: Daemon job exited with {result['exit_code']}")
+        for line in tails[0]:
+            print(f"    {line}")
+    return result["exit_code"]
+
+
+def follow_workers(
+    outputs: List[Iterable[str]], n_images: int, save_dir_path: str, metrics_port: int = None, launch_time: float = None
+) -> list:
+    """
+    Reads the output lines of Blender workers until they end, merges their events into the progress of the run and
+    appends them to events.jsonl, see run_workers.
+
+        Parameters:
+            outputs (list(iterable(str))): Output lines of every worker, e.g. the stdout of its process.
+            launch_time (float): time.time() when the workers were started, gives the time to the first frame.
+
+        Returns:
+            tails (list(deque(str))): Last lines of every worker that were not events, to show on failure.
+    """
+    # One reader thread per worker, all lines end up in the same queue
+    lines = queue.Queue()
+
+    def read_output(worker_idx, output):
+        for line in output:
+            lines.put((worker_idx, line.rstrip("\n")))
+        lines.put((worker_idx, None))
+
+    for worker_idx, output in enumerate(outputs):
+        threading.Thread(target=read_output, args=(worker_idx, output), daemon=True).start()
+
+    # Merge events
+    aggregator = Aggregator(n_images, launch_time)
+    server = serve_metrics(aggregator, metrics_port) if metrics_port is not None else None
+    tails = [deque(maxlen=20) for _ in outputs]
+    n_running = len(outputs)
+    aggregator.print_status()
+    with open(os.path.join(save_dir_path, EVENTS_NAME), "a") as events_file:
+        while n_running > 0:
+            worker_idx, line = lines.get()
+            if line is None:
+                n_running -= 1
+                continue
+            event = parse_event(line)
+            if event is None:
+                tails[worker_idx].append(line)
+                continue
+            event["worker"] = worker_idx
+            events_file.write(json.dumps(event) + "\n")
+            aggregator.add(worker_idx, event)
+            if event["event"] == "frame":
+                events_file.flush()
+                aggregator.print_status()
+    if server is not None:
+        server.shutdown()
+
+    # Where the time went
+    summary = aggregator.summary()
+    if summary["first_frame_seconds"] is not None:
+        print()
+        startup = ""
+        if summary["startup_seconds"] is not None:
+            startup = f" (rendering started after {summary['startup_seconds']:.2f} s)"
+        print(f"Time to first frame: {summary['first_frame_seconds']:.2f} s{startup}")
+    prepass = summary["prepass"]
+    if prepass.get("frames"):
+        print()
+        print(
+            f"Visibility pre-pass: {prepass['accepted_first'] / prepass['frames']:.1%} of frames accepted at the first"
+            f" pose, {prepass['accepted'] / prepass['frames']:.1%} after resampling,"
+            f" {prepass['tried'] / prepass['frames']:.2f} poses scored per frame"
+        )
+    if summary["stage_seconds"]:
+        print()
+        stages = ", ".join(f"{stage} {seconds:.3f}" for stage, seconds in summary["stage_seconds"].items())
+        print(f"Seconds per frame: {stages}")
+    return tails
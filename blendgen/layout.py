@@ -0,0 +1,167 @@
+"""
+Random, overlap free placement of props. Every prop is bounded by a sphere, spheres are placed one at a time by
+rejection sampling and overlaps are only tested against the spheres in neighbouring cells of a uniform hash grid, so a
+layout of n props costs O(n) expected time at a fixed density. Does not depend on bpy.
+"""
+from collections import defaultdict
+from typing import Dict, Tuple
+
+import numpy as np
+
+from .streams import COMPOSITION, stream_rng
+
+
+class SpatialHash:
+    """
+    Uniform hash grid of spheres. With a cell size of at least twice the largest radius, a sphere can only overlap
+    spheres whose centers are in the same or a neighbouring cell.
+
+        Parameters:
+            dimensions (int): 3, or 2 to hash only x and y (spheres on a ground plane).
+    """
+
+    def __init__(self, cell_size: float, dimensions: int = 3) -> None:
+        self.cell_size = cell_size
+        self.dimensions = dimensions
+        self.cells = defaultdict(list)
+        self.centers = []
+        self.radii = []
+        offsets = np.stack(np.meshgrid(*[(-1, 0, 1)] * dimensions, indexing="ij"), axis=-1).reshape(-1, dimensions)
+        self.neighbour_offsets = [tuple(offset) for offset in offsets]
+
+    def cell(self, center: np.ndarray) -> Tuple[int, ...]:
+        return tuple(np.floor(center[: self.dimensions] / self.cell_size).astype(int))
+
+    def overlaps(self, center: np.ndarray, radius: float) -> bool:
+        cell = self.cell(center)
+        for offset in self.neighbour_offsets:
+            for idx in self.cells.get(tuple(c + o for c, o in zip(cell, offset)), ()):
+                if np.sum((self.centers[idx] - center) ** 2) < (self.radii[idx] + radius) ** 2:
+                    return True
+        return False
+
+    def add(self, center: np.ndarray, radius: float) -> None:
+        self.cells[self.cell(center)].append(len(self.centers))
+        self.centers.append(center)
+        self.radii.append(radius)
+
+
+def sample_layout(
+    rng: np.random.Generator,
+    radii: np.ndarray,
+    density: float = 0.2,
+    ground: bool = False,
+    n_candidates: int = 32,
+    growth: float = 1.1,
+    side: float = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Places spheres without overlap in a cube, or on the z = 0 plane in a square, sized so the spheres fill density of
+    its volume (area). Large spheres are placed first, a sphere that does not fit after n_candidates tries grows the
+    region by growth. If side is given the region has that size instead and spheres that do not fit are left out.
+
+        Parameters:
+            radii (np.ndarray): (n,) bounding radius of every prop.
+            density (float): Fraction of the volume (area on the ground) covered by spheres, random sequential
+                packing stalls around 0.38 in 3D and 0.55 in 2D.
+            ground (bool): Spheres rest on the z = 0 plane.
+
+        Returns:
+            layout (dict(str, np.ndarray)): "location" (n, 3) sphere centers, "placed" (n,) whether the sphere was
+            placed, "center" (3,) center of the region and "distance_to_edge" () largest distance from center to a
+            sphere surface.
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    n = len(radii)
+    locations = np.zeros((n, 3))
+    placed_mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return {"location": locations, "placed": placed_mask, "center": np.zeros(3), "distance_to_edge": np.float64(0)}
+
+    dimensions = 2 if ground else 3
+    fixed_side = side is not None
+    if not fixed_side:
+        # Radius of spheres with the same mean volume (area)
+        mean_radius = np.sqrt(np.mean(radii**2)) if ground else np.cbrt(np.mean(radii**3))
+        side = region_side(mean_radius, n, density, ground=ground)
+    index = SpatialHash(max(2 * radii.max(), 1e-6), dimensions=dimensions)
+
+    for idx in np.argsort(-radii, kind="stable"):
+        radius = radii[idx]
+        while True:
+            # Centers keep the whole sphere inside the region
+            low = np.minimum(radius, side / 2)
+            candidates = rng.uniform(low, np.maximum(side - radius, low), size=(n_candidates, dimensions))
+            placed = next((candidate for candidate in candidates if not index.overlaps(candidate, radius)), None)
+            if placed is not None or fixed_side:
+                break
+            side *= growth
+        if placed is None:
+            continue
+        index.add(placed, radius)
+        locations[idx, :dimensions] = placed
+        if ground:
+            locations[idx, 2] = radius
+        placed_mask[idx] = True
+
+    center = np.full(3, side / 2)
+    if ground:
+        center[2] = 0
+    distance_to_edge = np.max(np.linalg.norm(locations - center, axis=1) + radii, where=placed_mask, initial=0)
+    return {"location": locations, "placed": placed_mask, "center": center, "distance_to_edge": distance_to_edge}
+
+
+def region_side(mean_radius: float, n: int, density: float, ground: bool = False) -> float:
+    """Side of the cube (square if ground) n spheres of mean_radius fill density of, as in sample_layout."""
+    if ground:
+        return np.sqrt(n * np.pi * mean_radius**2 / density)
+    return np.cbrt(n * 4 / 3 * np.pi * mean_radius**3 / density)
+
+
+def sample_composition(
+    seed: int,
+    frame: int,
+    template_radii: np.ndarray,
+    capacity: int,
+    n_instances: int,
+    scale_range: Tuple[float, float] = (1, 1),
+    slots: np.ndarray = None,
+    side: float = None,
+    ground: bool = False,
+) -> Dict[str, np.ndarray]:
+    """
+    Random composition of a frame for a PropPool, seeded by (seed, frame) like sampling.sample_poses.
+
+        Parameters:
+            template_radii (np.ndarray): (n_templates,) bounding radius of every template at scale 1.
+            capacity (int): Pool members per template, no template is used more often.
+            slots (np.ndarray): (n_instances, 3) fixed locations (Grid lattice). Otherwise instances are placed
+                without overlap by sample_layout in a region of the given side.
+
+        Returns:
+            composition (dict(str, np.ndarray)): "template" (n,), "scale" (n,) and "location" (n, 3) of the instances
+            that were placed.
+    """
+    rng = stream_rng(seed, COMPOSITION, frame)
+    n_templates = len(template_radii)
+    n_instances = min(n_instances, n_templates * capacity)
+
+    # Templates drawn uniformly, draws of full templates go to templates with members left
+    templates = rng.integers(n_templates, size=n_instances)
+    counts = np.bincount(templates, minlength=n_templates)
+    for idx in range(n_instances):
+        template = templates[idx]
+        if counts[template] > capacity:
+            counts[template] -= 1
+            templates[idx] = rng.choice(np.flatnonzero(counts < capacity))
+            counts[templates[idx]] += 1
+    scales = rng.uniform(scale_range[0], scale_range[1], size=n_instances)
+
+    if slots is not None:
+        locations = np.asarray(slots, dtype=np.float64)[:n_instances]
+        placed = np.ones(n_instances, dtype=bool)
+    else:
+        layout = sample_layout(rng, template_radii[templates] * scales, side=side, ground=ground)
+        locations = layout["location"]
+        placed = layout["placed"]
+    return {"template": templates[placed], "scale": scales[placed], "location": locations[placed]}
@@ -0,0 +1,59 @@
+"""
+Level of detail policies. A policy lists the decimation ratio of every level, level 0 being the full mesh, and the
+projected diameter in pixels below which the next coarser level is used. Like render profiles, a policy is given by
+name or as a JSON file. Does not depend on bpy.
+"""
+import json
+import os
+from typing import Dict
+
+import numpy as np
+
+LOD_POLICIES = {
+    # Full detail down to 150 px, a quarter of the triangles down to 40 px
+    "default": {"ratios": [1.0, 0.25, 0.05], "min_pixels": [150, 40]},
+    # For props scanned at very high resolution
+    "aggressive": {"ratios": [1.0, 0.1, 0.02, 0.005], "min_pixels": [250, 80, 20]},
+}
+
+
+def load_lod_policy(policy: str) -> Dict:
+    """Policy by name, or from a JSON file with "ratios" and "min_pixels"."""
+    if policy in LOD_POLICIES:
+        policy = dict(LOD_POLICIES[policy])
+    elif os.path.isfile(policy):
+        with open(policy) as f:
+            policy = json.load(f)
+    else:
+        print(f"ERROR: lod policy has to be one of {list(LOD_POLICIES)} or a policy file: {policy}")
+        quit()
+    assert len(policy["min_pixels"]) == len(policy["ratios"]) - 1, "every level but the last needs min_pixels"
+    assert policy["ratios"][0] == 1, "level 0 is the full mesh"
+    assert all(a > b for a, b in zip(policy["min_pixels"], policy["min_pixels"][1:])), "min_pixels has to decrease"
+    return policy
+
+
+def projected_diameters(
+    locations: np.ndarray, radii: np.ndarray, camera_matrix: np.ndarray, intrinsics: np.ndarray
+) -> np.ndarray:
+    """
+    Diameter in pixels of the image of bounding spheres, from their distance along the view axis.
+
+        Parameters:
+            locations (np.ndarray): (n, 3) world sphere centers.
+            radii (np.ndarray): (n,) sphere radii.
+            camera_matrix (np.ndarray): (4, 4) world matrix of the camera, looking along its -z axis.
+            intrinsics (np.ndarray): (3, 3) from geometry.camera_intrinsics.
+    """
+    camera_matrix = np.asarray(camera_matrix)
+    offsets = np.asarray(locations, dtype=np.float64) - camera_matrix[:3, 3]
+    depths = -offsets @ camera_matrix[:3, 2]
+    # A sphere reaching the camera plane covers the frame
+    depths = np.maximum(depths - radii, 1e-6) + radii
+    return 2 * intrinsics[0, 0] * np.asarray(radii) / depths
+
+
+def choose_levels(diameters: np.ndarray, policy: Dict) -> np.ndarray:
+    """Level of every projected diameter: the number of min_pixels thresholds it is below."""
+    min_pixels = np.asarray(policy["min_pixels"], dtype=np.float64)
+    return np.sum(np.asarray(diameters)[:, None] < min_pixels[None, :], axis=1)
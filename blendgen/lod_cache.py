@@ -0,0 +1,172 @@
+"""
+On-disk cache of decimated props. Every level of a policy is a mesh made with the Decimate modifier and kept in a
+library .blend next to the prop cache, with a JSON index recording the content hash of the prop it was made from. Per
+frame PropLods gives every shown prop the level of its projected size by swapping the object's mesh.
+"""
+import hashlib
+import json
+import os
+
+import bpy
+import numpy as np
+
+from .lod import choose_levels, projected_diameters
+from .utils import cameraIntrinsics, redirectOutputEnd, redirectOutputStart, templateVertices
+
+LOD_BLEND_NAME = "lods.blend"
+LOD_INDEX_NAME = "lods.json"
+LOD_VERSION = 2
+
+
+def lodCacheDirectory(prop_path: str) -> str:
+    """.blendgen_cache/lod/ in the prop directory, or next to a single prop file."""
+    prop_dir = prop_path if os.path.isdir(prop_path) else os.path.dirname(prop_path)
+    return os.path.join(prop_dir, ".blendgen_cache", "lod")
+
+
+def lodMeshName(mesh: bpy.types.Mesh, ratio: float) -> str:
+    return f"{mesh.name}_lod{ratio:g}"
+
+
+def lodFingerprint(content_hash: str) -> list:
+    return [LOD_VERSION, content_hash]
+
+
+def meshHash(mesh: bpy.types.Mesh) -> str:
+    """sha1 of the vertex coordinates and polygons of mesh, for props without the "source_sha1" of the prop cache."""
+    sha1 = hashlib.sha1()
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coordinates)
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    for array in (coordinates, loop_vertices, loop_starts):
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()
+
+
+def propHash(prop) -> str:
+    """Content hash of the full mesh of prop, the hash of its source file if it came through the prop cache."""
+    return prop.object.get("source_sha1") or meshHash(prop.mesh)
+
+
+def decimatedMesh(mesh: bpy.types.Mesh, ratio: float, name: str) -> bpy.types.Mesh:
+    """Copy of mesh with about ratio of its triangles, collapsed by the Decimate modifier of a temporary object."""
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)  # Modifiers are only evaluated in the depsgraph of a scene
+    modifier = obj.modifiers.new("decimate", "DECIMATE")
+    modifier.decimate_type = "COLLAPSE"
+    modifier.ratio = ratio
+    evaluated = obj.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    decimated = bpy.data.meshes.new_from_object(evaluated)
+    decimated.name = name
+    bpy.data.objects.remove(obj)
+    return decimated
+
+
+def loadLods(meshes: list, content_hashes: list, ratios: list, cache_dir: str) -> dict:
+    """
+    Levels of every mesh, loaded from the cache in cache_dir or decimated and added to it.
+
+        Parameters:
+            meshes (list(bpy.types.Mesh)): Full meshes of the props.
+            content_hashes (list(str)): Content hash of every mesh (see propHash), cached levels of a changed prop
+                are made again.
+            ratios (list(float)): Decimation ratio of every level, the first is 1 (the mesh itself).
+
+        Returns:
+            lods (dict(str, list(bpy.types.Mesh))): Levels by full mesh name (name_full).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, LOD_INDEX_NAME)
+    cache_blend = os.path.join(cache_dir, LOD_BLEND_NAME)
+    index = {}
+    if os.path.isfile(index_path) and os.path.isfile(cache_blend):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    # Cached levels of unchanged meshes
+    fingerprints = {mesh.name_full: lodFingerprint(content_hash) for mesh, content_hash in zip(meshes, content_hashes)}
+    wanted = {lodMeshName(mesh, ratio): (mesh, ratio) for mesh in meshes for ratio in ratios[1:]}
+    cached = [name for name, (mesh, _) in wanted.items() if index.get(name) == fingerprints[mesh.name_full]]
+    loaded = {}
+    if cached:
+        old = redirectOutputStart()
+        with bpy.data.libraries.load(cache_blend, link=False) as (data_from, data_to):
+            in_library = [name for name in cached if name in data_from.meshes]
+            data_to.meshes = in_library
+        redirectOutputEnd(old)
+        loaded = {name: mesh for name, mesh in zip(in_library, data_to.meshes) if mesh is not None}
+
+    # Decimate the others and rewrite the library with every level
+    missing = [name for name in wanted if name not in loaded]
+    if missing:
+        print(f"Decimating {len(missing)} levels of detail into {cache_dir}.")
+        for name in missing:
+            mesh, ratio = wanted[name]
+            loaded[name] = decimatedMesh(mesh, ratio, name)
+            index[name] = fingerprints[mesh.name_full]
+        if os.path.isfile(cache_blend):
+            # Keep the levels of other props in the library
+            with bpy.data.libraries.load(cache_blend, link=False) as (data_from, data_to):
+                data_to.meshes = [name for name in data_from.meshes if name not in loaded and name in index]
+            kept = {mesh for mesh in data_to.meshes if mesh is not None}
+        else:
+            kept = set()
+        bpy.data.libraries.write(cache_blend + ".tmp", kept | set(loaded.values()), fake_user=True)
+        os.replace(cache_blend + ".tmp", cache_blend)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+        for mesh in kept:
+            bpy.data.meshes.remove(mesh)
+
+    # Levels read from the library come with copies of the materials, use the ones of the full mesh. Levels are marked
+    # so utils.removeScene removes them after a daemon job, also the ones no object shows at the end.
+    lods = {}
+    for mesh in meshes:
+        levels = [loaded[lodMeshName(mesh, ratio)] for ratio in ratios[1:]]
+        for level in levels:
+            for idx, material in enumerate(mesh.materials[: len(level.materials)]):
+                level.materials[idx] = material
+            level["is_lod"] = True
+        lods[mesh.name_full] = [mesh] + levels
+    return lods
+
+
+class PropLods:
+    """
+    Swaps the mesh of every shown prop for the level of detail of its projected size.
+
+        Parameters:
+            members (list(Prop)): Every prop that can be shown, e.g. grid.members.
+            policy (dict): From lod.load_lod_policy.
+            cache_dir (str): Directory of the LOD cache, see lodCacheDirectory.
+    """
+
+    def __init__(self, members: list, policy: dict, cache_dir: str) -> None:
+        self.policy = policy
+        props = list({prop.mesh.name_full: prop for prop in members}.values())  # One prop of every mesh
+        meshes = [prop.mesh for prop in props]
+        self.lods = loadLods(meshes, [propHash(prop) for prop in props], policy["ratios"], cache_dir)
+
+        # Bounding radius of every member at scale 1, instances are origin centred
+        template_vertices, member_template = templateVertices(members)
+        template_radii = np.array([np.linalg.norm(vertices, axis=1).max(initial=0) for vertices in template_vertices])
+        self.radius = {id(prop): template_radii[template] for prop, template in zip(members, member_template)}
+
+    def apply(self, camera, grid, resolution: tuple) -> np.ndarray:
+        """Sets the level of every prop in grid.prop_list for the current camera, returns the levels."""
+        props = grid.prop_list
+        locations = np.array([prop.object.location for prop in props]).reshape(-1, 3)
+        radii = np.array([self.radius[id(prop)] * max(prop.object.scale) for prop in props])
+        diameters = projected_diameters(
+            locations, radii, np.array(camera.object.matrix_basis), cameraIntrinsics(camera.data, resolution)
+        )
+        levels = choose_levels(diameters, self.policy)
+        for prop, level in zip(props, levels):
+            mesh = self.lods[prop.mesh.name_full][level]
+            if prop.object.data != mesh:
+                prop.object.data = mesh
+        return levels
@@ -0,0 +1,176 @@
+"""
+Checkpointing of runs. Every finished frame is appended to manifest.jsonl with its seed, camera pose, the hash of its
+sampled poses (camera and every prop) and the size and CRC-32 of each output file, the arguments of the run are kept in
+run.json. A resumed run renders only the frames whose outputs are missing or do not match the manifest, or whose poses
+changed. Does not depend on bpy.
+"""
+import hashlib
+import json
+import os
+import zlib
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from .labels import LABELS_INDEX_NAME
+
+MANIFEST_NAME = "manifest.jsonl"
+RUN_NAME = "run.json"
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> Tuple[int, int]:
+    """(crc32, size) of a file."""
+    crc = 0
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return crc, size
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+
+
+def pose_hash(poses: Dict[str, np.ndarray], k: int) -> str:
+    """sha1 of row k of every array of poses (see sampling.sample_poses), e.g. the prop rotations of a frame."""
+    sha1 = hashlib.sha1()
+    for key in sorted(poses):
+        sha1.update(key.encode())
+        sha1.update(np.ascontiguousarray(poses[key][k]).tobytes())
+    return sha1.hexdigest()
+
+
+def save_run(save_path: str, run: Dict) -> None:
+    with open(os.path.join(save_path, RUN_NAME), "w") as f:
+        json.dump(run, f, indent=1)
+
+
+def load_run(save_path: str) -> Dict:
+    with open(os.path.join(save_path, RUN_NAME)) as f:
+        return json.load(f)
+
+
+def load_manifest(save_path: str) -> Dict[int, Dict]:
+    """Last manifest entry of every frame. A line cut off by a crash is ignored."""
+    entries = {}
+    path = os.path.join(save_path, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["frame"]] = entry
+    return entries
+
+
+def labelled_frames(labels_directory: str) -> np.ndarray:
+    """Sorted frames with rows in the label shards listed in index.jsonl."""
+    index_path = os.path.join(labels_directory, LABELS_INDEX_NAME)
+    if not os.path.isfile(index_path):
+        return np.zeros(0, dtype=np.int64)
+    frames = []
+    with open(index_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            with np.load(os.path.join(labels_directory, json.loads(line)["file"])) as data:
+                frames.append(np.unique(data["frame"]))
+    return np.unique(np.concatenate(frames)) if frames else np.zeros(0, dtype=np.int64)
+
+
+def verify_entry(save_path: str, entry: Dict) -> bool:
+    """Whether every output file of a manifest entry exists with the recorded size and checksum."""
+    for name, (crc, size) in entry["files"].items():
+        path = os.path.join(save_path, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+        if file_checksum(path) != (crc, size):
+            return False
+    return True
+
+
+def finished_frames(
+    save_path: str, frames: Iterable[int], labels_directory: str = None, pose_hashes: Dict[int, str] = None
+) -> List[int]:
+    """
+    Frames of frames that do not have to be rendered again.
+
+        Parameters:
+            labels_directory (str): If given, frames also need rows in the label shards, labels are buffered and a
+                crash can lose the labels of frames already in the manifest.
+            pose_hashes (dict(int, str)): If given, the pose_hash of every frame, frames rendered with other poses
+                (e.g. sampled by an older version) are rendered again.
+    """
+    entries = load_manifest(save_path)
+    labelled = None if labels_directory is None else set(labelled_frames(labels_directory).tolist())
+    finished = []
+    for frame in frames:
+        entry = entries.get(frame)
+        if entry is None or (labelled is not None and frame not in labelled):
+            continue
+        if pose_hashes is not None and entry.get("pose_sha1") != pose_hashes[frame]:
+            continue
+        if verify_entry(save_path, entry):
+            finished.append(frame)
+    return finished
+
+
+class Manifest:
+    """
+    Appends an entry to manifest.jsonl once all output files of a frame are written.
+
+        Parameters:
+            checksums (dict(str, tuple(int))): (crc32, size) of every written path, filled by writer.AsyncImageWriter.
+                Frames wait in pending until all their paths are in it. If not given the files are complete when
+                added and are read back to compute the checksums. Files written by Blender itself, e.g. the passes of
+                the compositor, are given as external_paths of add and are always read back.
+    """
+
+    def __init__(self, save_path: str, seed: int, checksums: Dict[str, Tuple[int, int]] = None) -> None:
+        self.save_path = save_path
+        self.seed = seed
+        self.checksums = checksums
+        self.pending = []
+
+    def add(self, frame: int, paths: List[str], external_paths: List[str] = (), **fields) -> None:
+        """
+        Adds a frame with its output paths and extra fields, e.g. its camera pose, and writes finished frames.
+
+            Parameters:
+                paths (list(str)): Files of the frame, waited for in checksums if given.
+                external_paths (list(str)): Files of the frame that are complete when added, e.g. written by Blender
+                    during the render. They never show up in checksums, so they are read back here.
+        """
+        fields = {key: np.asarray(value).tolist() for key, value in fields.items()}
+        external = {os.path.relpath(path, self.save_path): list(file_checksum(path)) for path in external_paths}
+        self.pending.append((frame, paths, external, fields))
+        self.flush()
+
+    def flush(self) -> None:
+        lines = []
+        pending = []
+        for frame, paths, external, fields in self.pending:
+            if self.checksums is not None and not all(path in self.checksums for path in paths):
+                pending.append((frame, paths, external, fields))
+                continue
+            files = {}
+            for path in paths:
+                checksum = self.checksums.pop(path) if self.checksums is not None else file_checksum(path)
+                files[os.path.relpath(path, self.save_path)] = list(checksum)
+            files.update(external)
+            entry = {"frame": int(frame), "seed": self.seed, **fields, "files": files}
+            lines.append(json.dumps(entry) + "\n")
+        self.pending = pending
+
+        # One write per flush, appends of workers sharing the manifest do not interleave within a line
+        if lines:
+            with open(os.path.join(self.save_path, MANIFEST_NAME), "a") as f:
+                f.write("".join(lines))
+
+    def close(self) -> None:
+        """Writes the remaining frames, their files have to be written by now."""
+        self.flush()
+        assert not self.pending, f"{len(self.pending)} frames were not written"
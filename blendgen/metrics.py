@@ -0,0 +1,275 @@
+"""
+Instrumentation of runs. Blender reports every frame as a JSON event with the time spent in each stage, frames per
+second, ETA, peak RSS and bpy.data block counts, on stdout as a line prefixed by EVENT_PREFIX when running as a worker.
+The parent process merges the events of its workers in an Aggregator, appends them to events.jsonl and shows the
+overall throughput, optionally also as Prometheus text on a local port. Does not depend on bpy.
+"""
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+from .progress import printProgressBar
+
+EVENT_PREFIX = "BLENDGEN_EVENT"
+EVENTS_NAME = "events.jsonl"
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes, or None where it can not be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kB on Linux
+
+
+def parse_event(line: str) -> Dict:
+    """The event of a line written by Metrics in a worker, otherwise None."""
+    if not line.startswith(EVENT_PREFIX + " "):
+        return None
+    try:
+        return json.loads(line[len(EVENT_PREFIX) + 1 :])
+    except json.JSONDecodeError:
+        return None
+
+
+def format_eta(seconds: float) -> str:
+    return "--:--:--" if seconds is None else str(timedelta(seconds=round(seconds)))
+
+
+def status_suffix(fps: float, eta: float) -> str:
+    # Padded so a shorter status overwrites a longer one
+    return f"{fps:6.2f} fps, ETA {format_eta(eta)}".ljust(32)
+
+
+class Metrics:
+    """
+    Times the stages of every frame of a render loop and reports each frame as an event.
+
+        Parameters:
+            total (int): Frames of the run, including n_finished.
+            n_finished (int): Frames already rendered by an earlier run.
+            worker (bool): Print events for the parent process, otherwise show a progress bar.
+            events_path (str): If given, events are also appended to this file (events.jsonl when not a worker).
+            window (int): Frames per second are measured over the last window reports.
+    """
+
+    def __init__(
+        self, total: int, n_finished: int = 0, worker: bool = False, events_path: str = None, window: int = 32
+    ) -> None:
+        self.total = total
+        self.done = n_finished
+        self.worker = worker
+        self.events_file = open(events_path, "a") if events_path is not None else None
+        self.stages = {}
+        self.start_time = time.perf_counter()
+        self.frame_start = self.start_time
+        self.reports = deque([(self.start_time, n_finished)], maxlen=window)
+        self.emit({"event": "start", "done": self.done, "total": total})
+        if not worker:
+            printProgressBar(self.done, total, prefix="Progress:", suffix=status_suffix(0, None), length=50)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Adds the time spent in the block to stage name of the current frame."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def fps(self) -> float:
+        (first_time, first_done), (last_time, last_done) = self.reports[0], self.reports[-1]
+        return (last_done - first_done) / (last_time - first_time) if last_time > first_time else 0.0
+
+    def frame(self, frame: int, n_frames: int = 1, data: Dict[str, int] = None) -> None:
+        """
+        Reports n_frames finished frames, the last one frame, with the stage times measured since the last report.
+
+            Parameters:
+                data (dict(str, int)): Counts of bpy.data blocks, e.g. from utils.dataBlockCounts.
+        """
+        now = time.perf_counter()
+        self.done += n_frames
+        self.reports.append((now, self.done))
+        fps = self.fps()
+        eta = (self.total - self.done) / fps if fps > 0 else None
+        event = {
+            "event": "frame",
+            "frame": int(frame),
+            "n_frames": n_frames,
+            "done": self.done,
+            "total": self.total,
+            "seconds": now - self.frame_start,
+            "stages": self.stages,
+            "fps": fps,
+            "eta": eta,
+            "peak_rss": peak_rss(),
+        }
+        if data is not None:
+            event["data"] = data
+        self.emit(event)
+        if not self.worker:
+            printProgressBar(self.done, self.total, prefix="Progress:", suffix=status_suffix(fps, eta), length=50)
+        self.stages = {}
+        self.frame_start = time.perf_counter()
+
+    def emit(self, event: Dict) -> None:
+        event["time"] = time.time()
+        line = json.dumps(event)
+        if self.worker:
+            print(f"{EVENT_PREFIX} {line}", flush=True)
+        if self.events_file is not None:
+            self.events_file.write(line + "\n")
+            self.events_file.flush()
+
+    def close(self) -> None:
+        seconds = time.perf_counter() - self.start_time
+        self.emit({"event": "end", "done": self.done, "total": self.total, "seconds": seconds})
+        if self.events_file is not None:
+            self.events_file.close()
+
+
+class Aggregator:
+    """
+    Merges the events of several workers into the throughput of the whole run.
+
+        Parameters:
+            total (int): Frames of the run over all workers.
+            launch_time (float): time.time() when the workers were started. Gives the time until the first worker
+                started rendering (its "start" event, after Blender started and the scene was built) and until the
+                first frame was rendered.
+    """
+
+    def __init__(self, total: int, launch_time: float = None) -> None:
+        self.total = total
+        self.launch_time = launch_time
+        self.start_time = None
+        self.first_frame_time = None
+        self.prepass = {}  # Summed "prepass" events of visibility.prepass_stats
+        self.lock = threading.Lock()
+        self.workers = {}  # Last frame event of every worker
+        self.finished = set()
+        self.done = {}
+        self.stage_seconds = {}
+        self.n_frames = 0
+
+    def add(self, worker_idx: int, event: Dict) -> None:
+        with self.lock:
+            if "done" in event:
+                self.done[worker_idx] = event["done"]
+            if event["event"] == "end":
+                self.finished.add(worker_idx)
+            if event["event"] == "start" and self.start_time is None:
+                self.start_time = event["time"]
+            if event["event"] == "prepass":
+                for key in ("frames", "accepted_first", "accepted", "tried"):
+                    self.prepass[key] = self.prepass.get(key, 0) + event[key]
+            if event["event"] != "frame":
+                return
+            if self.first_frame_time is None:
+                self.first_frame_time = event["time"]
+            self.workers[worker_idx] = event
+            self.n_frames += event["n_frames"]
+            for stage, seconds in event["stages"].items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def since_launch(self, event_time: float) -> float:
+        if self.launch_time is None or event_time is None:
+            return None
+        return event_time - self.launch_time
+
+    def summary(self) -> Dict:
+        """
+        Frames done, frames per second and ETA of the run, mean seconds per frame of every stage, seconds from the
+        launch to the first "start" event and to the first frame, and the acceptance of the visibility pre-pass.
+        """
+        with self.lock:
+            done = sum(self.done.values())
+            fps = sum(event["fps"] for idx, event in self.workers.items() if idx not in self.finished)
+            stage_means = {stage: seconds / self.n_frames for stage, seconds in self.stage_seconds.items()}
+            return {
+                "done": done,
+                "total": self.total,
+                "fps": fps,
+                "eta": (self.total - done) / fps if fps > 0 else None,
+                "stage_seconds": stage_means,
+                "peak_rss": max((event["peak_rss"] or 0 for event in self.workers.values()), default=0),
+                "startup_seconds": self.since_launch(self.start_time),
+                "first_frame_seconds": self.since_launch(self.first_frame_time),
+                "prepass": dict(self.prepass),
+            }
+
+    def print_status(self) -> None:
+        summary = self.summary()
+        suffix = status_suffix(summary["fps"], summary["eta"])
+        printProgressBar(min(summary["done"], self.total), self.total, prefix="Progress:", suffix=suffix, length=50)
+
+    def prometheus_text(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [
+            "# TYPE blendgen_frames_done gauge",
+            f"blendgen_frames_done {summary['done']}",
+            "# TYPE blendgen_frames_total gauge",
+            f"blendgen_frames_total {summary['total']}",
+            "# TYPE blendgen_frames_per_second gauge",
+            f"blendgen_frames_per_second {summary['fps']}",
+            "# TYPE blendgen_eta_seconds gauge",
+            f"blendgen_eta_seconds {summary['eta'] if summary['eta'] is not None else 'NaN'}",
+        ]
+        for name in ("startup_seconds", "first_frame_seconds"):
+            if summary[name] is not None:
+                lines += [f"# TYPE blendgen_{name} gauge", f"blendgen_{name} {summary[name]}"]
+        for name, value in summary["prepass"].items():
+            lines += [f"# TYPE blendgen_prepass_{name}_total counter", f"blendgen_prepass_{name}_total {value}"]
+        lines.append("# TYPE blendgen_stage_seconds_total counter")
+        with self.lock:
+            lines += [f'blendgen_stage_seconds_total{{stage="{stage}"}} {s}' for stage, s in self.stage_seconds.items()]
+            workers = sorted(self.workers.items())
+        lines.append("# TYPE blendgen_worker_frames_per_second gauge")
+        lines += [f'blendgen_worker_frames_per_second{{worker="{idx}"}} {event["fps"]}' for idx, event in workers]
+        lines.append("# TYPE blendgen_worker_peak_rss_bytes gauge")
+        lines += [
+            f'blendgen_worker_peak_rss_bytes{{worker="{idx}"}} {event["peak_rss"]}'
+            for idx, event in workers
+            if event["peak_rss"] is not None
+        ]
+        lines.append("# TYPE blendgen_worker_data_blocks gauge")
+        for idx, event in workers:
+            for block_type, count in event.get("data", {}).items():
+                lines.append(f'blendgen_worker_data_blocks{{worker="{idx}",type="{block_type}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(aggregator: Aggregator, port: int) -> ThreadingHTTPServer:
+    """Serves aggregator.prometheus_text() on http://127.0.0.1:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = aggregator.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Would break the progress line
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
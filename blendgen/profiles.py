@@ -0,0 +1,141 @@
+"""
+Render profiles: named presets of engine, sampling, denoising and light bounce settings. A profile maps dotted attribute
+paths of bpy.types.Scene to values, so custom profiles (e.g. the one picked by the autotuner) are plain JSON. Threads
+are not part of a profile, they depend on the machine and the number of workers and are set by --threads after it.
+Does not depend on bpy.
+"""
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+RENDER_PROFILES = {
+    # Workbench with studio lighting, a preview of composition and poses
+    "draft": {
+        "render.engine": "BLENDER_WORKBENCH",
+        "display.shading.light": "STUDIO",
+        "display.shading.color_type": "MATERIAL",
+        "display.render_aa": "FXAA",
+    },
+    # Eevee with few samples
+    "balanced": {
+        "render.engine": "BLENDER_EEVEE",
+        "eevee.taa_render_samples": 16,
+        "eevee.use_gtao": True,
+        "eevee.use_soft_shadows": True,
+        "eevee.use_ssr": False,
+    },
+    # Path traced on the CPU with adaptive sampling and denoising
+    "final": {
+        "render.engine": "CYCLES",
+        "cycles.device": "CPU",
+        "cycles.samples": 128,
+        "cycles.use_adaptive_sampling": True,
+        "cycles.adaptive_threshold": 0.01,
+        "cycles.max_bounces": 8,
+        "cycles.diffuse_bounces": 4,
+        "cycles.glossy_bounces": 4,
+        "cycles.transmission_bounces": 8,
+        "cycles.use_denoising": True,
+        "cycles.denoiser": "OPENIMAGEDENOISE",
+        "cycles.tile_size": 2048,
+    },
+}
+
+# Candidates of the autotuner, fastest first, and the reference their quality is measured against
+AUTOTUNE_CANDIDATES = {
+    "eevee_8": {**RENDER_PROFILES["balanced"], "eevee.taa_render_samples": 8, "eevee.use_soft_shadows": False},
+    "balanced": RENDER_PROFILES["balanced"],
+    "eevee_64": {**RENDER_PROFILES["balanced"], "eevee.taa_render_samples": 64},
+    "cycles_16": {
+        **RENDER_PROFILES["final"],
+        "cycles.samples": 16,
+        "cycles.max_bounces": 2,
+        "cycles.adaptive_threshold": 0.1,
+    },
+    "cycles_32": {
+        **RENDER_PROFILES["final"],
+        "cycles.samples": 32,
+        "cycles.max_bounces": 4,
+        "cycles.adaptive_threshold": 0.05,
+    },
+    "cycles_64": {**RENDER_PROFILES["final"], "cycles.samples": 64, "cycles.max_bounces": 4},
+}
+AUTOTUNE_REFERENCE = {**RENDER_PROFILES["final"], "cycles.samples": 512, "cycles.adaptive_threshold": 0.005}
+
+# Workbench showing every object's colour unlit, without shadows, outlines or anti-aliasing. Swapped in only around the
+# mask render (see swap_profile), so the colour render keeps the shading of its own profile, e.g. "draft".
+FLAT_SEGMENTATION = {
+    "render.engine": "BLENDER_WORKBENCH",
+    "display.shading.light": "FLAT",
+    "display.shading.color_type": "OBJECT",
+    "display.shading.show_object_outline": False,
+    "display.shading.show_shadows": False,
+    "display.shading.show_cavity": False,
+    "display.shading.show_specular_highlight": False,
+    "display.render_aa": "OFF",
+}
+
+
+def load_profile(profile: str) -> Dict:
+    """Profile by name, or from a JSON file with the profile in "profile" (as written by the autotuner)."""
+    if profile in RENDER_PROFILES:
+        return dict(RENDER_PROFILES[profile])
+    if not os.path.isfile(profile):
+        print(f"ERROR: profile has to be one of {list(RENDER_PROFILES)} or a profile file: {profile}")
+        quit()
+    with open(profile) as f:
+        return json.load(f)["profile"]
+
+
+def apply_profile(scene, profile: Dict) -> None:
+    """Sets every attribute path of profile on scene, in order, so the engine is set before its settings."""
+    for path, value in profile.items():
+        *parents, name = path.split(".")
+        target = scene
+        for parent in parents:
+            target = getattr(target, parent)
+        setattr(target, name, value)
+
+
+def read_profile(scene, paths) -> Dict:
+    """Current values of the attribute paths on scene, in the same order, as a profile."""
+    profile = {}
+    for path in paths:
+        target = scene
+        for name in path.split("."):
+            target = getattr(target, name)
+        profile[path] = target
+    return profile
+
+
+def swap_profile(scene, profile: Dict) -> Dict:
+    """
+    Applies profile to scene.
+
+        Returns:
+            old (dict): Previous values of the paths of profile, apply_profile(scene, old) restores them.
+    """
+    old = read_profile(scene, profile)
+    apply_profile(scene, profile)
+    return old
+
+
+def psnr(reference: np.ndarray, image: np.ndarray) -> float:
+    """Peak signal to noise ratio in dB of the RGB channels of two images with values in [0, 1]."""
+    error = np.mean((np.clip(reference[..., :3], 0, 1) - np.clip(image[..., :3], 0, 1)) ** 2)
+    return float("inf") if error == 0 else float(10 * np.log10(1 / error))
+
+
+def choose_profile(results: List[Dict], min_psnr: float) -> Dict:
+    """
+    Fastest result whose worst calibration frame is at least min_psnr, or the one of highest quality if none is.
+
+        Parameters:
+            results (list(dict)): One dict per candidate with "name", "seconds" (per frame) and "psnr" (worst frame).
+    """
+    passing = [result for result in results if result["psnr"] >= min_psnr]
+    if not passing:
+        return max(results, key=lambda result: result["psnr"])
+    return min(passing, key=lambda result: result["seconds"])
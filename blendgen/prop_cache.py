@@ -0,0 +1,127 @@
+"""
+On-disk cache of imported props. All props are stored joined, rescaled to unit size and origin centred in a single
+library .blend, with a JSON index recording which source file and version each cached prop came from.
+"""
+import hashlib
+import json
+import os
+
+import bpy
+import mathutils
+
+from .utils import centerOrigin, importProp, redirectOutputEnd, redirectOutputStart
+
+CACHE_BLEND_NAME = "props.blend"
+CACHE_INDEX_NAME = "props.json"
+CACHE_VERSION = 1
+
+
+def fileHash(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def loadCacheIndex(cache_dir: str) -> dict:
+    index_path = os.path.join(cache_dir, CACHE_INDEX_NAME)
+    if not os.path.isfile(index_path) or not os.path.isfile(os.path.join(cache_dir, CACHE_BLEND_NAME)):
+        return {}
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get("version") != CACHE_VERSION:
+        return {}
+    return index["props"]
+
+
+def saveCacheIndex(cache_dir: str, props: dict) -> None:
+    index_path = os.path.join(cache_dir, CACHE_INDEX_NAME)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"version": CACHE_VERSION, "props": props}, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def isCached(entry: dict, prop_path: str) -> bool:
+    """Checks size and mtime first, only hashes the file if they changed (e.g. after a copy)."""
+    if entry is None or entry["path"] != prop_path:
+        return False
+    stat = os.stat(prop_path)
+    if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+        return True
+    if entry["size"] == stat.st_size and entry["sha1"] == fileHash(prop_path):
+        entry["mtime"] = stat.st_mtime
+        return True
+    return False
+
+
+def normalizeProp(obj: bpy.types.Object) -> None:
+    """Bakes the object transform into the mesh and moves the bounding box center to the origin."""
+    obj.data.transform(obj.matrix_basis)
+    obj.matrix_basis = mathutils.Matrix.Identity(4)
+    centerOrigin(obj)
+    obj.location = (0, 0, 0)
+
+
+def loadCachedProps(cache_dir: str, prop_names: list[str], link: bool) -> None:
+    cache_blend = os.path.join(cache_dir, CACHE_BLEND_NAME)
+    old = redirectOutputStart()
+    with bpy.data.libraries.load(cache_blend, link=link) as (data_from, data_to):
+        data_to.objects = [name for name in prop_names if name in data_from.objects]
+    redirectOutputEnd(old)
+
+    # Restore names if they clashed with existing objects
+    for prop_name, obj in zip(prop_names, data_to.objects):
+        if not link and obj.name != prop_name:
+            obj.name = prop_name
+
+
+def importPropsCached(blender_files: list[str], cache_dir: str) -> list[str]:
+    """
+    Imports props through the cache in cache_dir. Unchanged props are linked from the cache library, changed or new
+    ones are imported with importProp and the library is rewritten.
+
+        Parameters:
+            blender_files (list(str)): Full paths to the prop .blend files.
+            cache_dir (str): Directory of the cache, created if missing.
+
+        Returns:
+            prop_name_list (list(str)): List of imported props' names.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_props = loadCacheIndex(cache_dir)
+
+    prop_name_list = [os.path.basename(path)[:-6] for path in blender_files]
+    stale = [
+        (prop_name, path)
+        for prop_name, path in zip(prop_name_list, blender_files)
+        if not isCached(cached_props.get(prop_name), path)
+    ]
+
+    # Everything cached, link from the library
+    if len(stale) == 0:
+        loadCachedProps(cache_dir, prop_name_list, link=True)
+        saveCacheIndex(cache_dir, cached_props)  # Updated mtimes
+        return prop_name_list
+
+    # Append valid props so the library can be rewritten with them included
+    stale_names = {prop_name for prop_name, _ in stale}
+    valid_names = [prop_name for prop_name in prop_name_list if prop_name not in stale_names]
+    loadCachedProps(cache_dir, valid_names, link=False)
+
+    print(f"Preprocessing {len(stale)} new or changed props into {cache_dir}.")
+    for prop_name, path in stale:
+        importProp(path)
+        normalizeProp(bpy.data.objects[prop_name])
+        stat = os.stat(path)
+        cached_props[prop_name] = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": fileHash(path)}
+        bpy.data.objects[prop_name]["source_sha1"] = cached_props[prop_name]["sha1"]  # Key of the LOD cache
+
+    # Write library with every prop, dependencies (meshes, materials, images) are included automatically
+    cache_blend = os.path.join(cache_dir, CACHE_BLEND_NAME)
+    datablocks = {bpy.data.objects[prop_name] for prop_name in prop_name_list}
+    bpy.data.libraries.write(cache_blend + ".tmp", datablocks, path_remap="ABSOLUTE", fake_user=True)
+    os.replace(cache_blend + ".tmp", cache_blend)
+    saveCacheIndex(cache_dir, {prop_name: cached_props[prop_name] for prop_name in prop_name_list})
+
+    return prop_name_list
@@ -0,0 +1,202 @@
+"""
+Lazy prop library for very large prop directories. A persistent JSON index holds the metadata of every prop so props
+can be filtered and sampled without opening any .blend file, and preprocessed props are only loaded into bpy.data
+when sampled, with the least recently used ones removed again.
+"""
+import json
+import os
+import random
+from collections import OrderedDict
+from typing import Callable, List
+
+import bpy
+
+from .prop_cache import fileHash, isCached, normalizeProp
+from .progress import printProgressBar
+from .utils import importProp, redirectOutputEnd, redirectOutputStart
+
+LIBRARY_INDEX_NAME = "library.json"
+LIBRARY_DIR_NAME = "library"
+LIBRARY_VERSION = 1
+
+
+class PropLibrary:
+    def __init__(self, prop_dir: str, cache_dir: str = None, max_loaded: int = 64) -> None:
+        """
+        Opens (and updates) the index of prop_dir, only new or changed props are imported.
+
+            Parameters:
+                prop_dir (str): Directory containing prop .blend files, or a single .blend file.
+                cache_dir (str): Where index and preprocessed props are stored. Default is <prop_dir>/.blendgen_cache,
+                    or .blendgen_cache next to a single file.
+                max_loaded (int): Maximum number of props kept in bpy.data at the same time, props with instances
+                    in the scene are not removed so more can be loaded while they are shown.
+        """
+        if os.path.isfile(prop_dir) and prop_dir.endswith(".blend"):
+            default_cache_dir = os.path.join(os.path.dirname(prop_dir), ".blendgen_cache")
+        elif os.path.isdir(prop_dir):
+            default_cache_dir = os.path.join(prop_dir, ".blendgen_cache")
+        else:
+            print(f"ERROR: {prop_dir} is neither a prop directory nor a .blend file.")
+            print("Quitting BlendGen")
+            quit()
+        self.prop_dir = prop_dir
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()  # prop name -> bpy.types.Object, most recently used last
+
+        os.makedirs(os.path.join(self.cache_dir, LIBRARY_DIR_NAME), exist_ok=True)
+        self.index = self.load_index()
+        self.update_index()
+
+        if len(self.index) == 0:
+            print(f"ERROR: Directory {prop_dir} does not contain any .blend files.")
+            print("Quitting BlendGen")
+            quit()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.index)
+
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, LIBRARY_INDEX_NAME)
+
+    def prop_blend_path(self, prop_name: str) -> str:
+        return os.path.join(self.cache_dir, LIBRARY_DIR_NAME, prop_name + ".blend")
+
+    def load_index(self) -> dict:
+        if not os.path.isfile(self.index_path()):
+            return {}
+        with open(self.index_path()) as f:
+            index = json.load(f)
+        if index.get("version") != LIBRARY_VERSION:
+            return {}
+        return index["props"]
+
+    def save_index(self) -> None:
+        with open(self.index_path() + ".tmp", "w") as f:
+            json.dump({"version": LIBRARY_VERSION, "props": self.index}, f)
+        os.replace(self.index_path() + ".tmp", self.index_path())
+
+    def update_index(self) -> None:
+        """Preprocesses new and changed props into one .blend each, so the index never needs a full rewrite."""
+        if os.path.isfile(self.prop_dir):
+            blender_files = {os.path.basename(self.prop_dir)[:-6]: self.prop_dir}
+        else:
+            blender_files = {
+                filename[:-6]: os.path.join(self.prop_dir, filename)
+                for filename in os.listdir(self.prop_dir)
+                if filename.endswith(".blend")
+            }
+
+        # Forget removed props
+        for prop_name in [prop_name for prop_name in self.index if prop_name not in blender_files]:
+            del self.index[prop_name]
+
+        stale = [
+            (prop_name, path)
+            for prop_name, path in sorted(blender_files.items())
+            if not (isCached(self.index.get(prop_name), path) and os.path.isfile(self.prop_blend_path(prop_name)))
+        ]
+        if len(stale) == 0:
+            return
+
+        print(f"Indexing {len(stale)} new or changed props into {self.cache_dir}.")
+        printProgressBar(0, len(stale), prefix="Progress:", suffix="Complete", length=50)
+        for i, (prop_name, path) in enumerate(stale):
+            importProp(path)
+            obj = bpy.data.objects[prop_name]
+            normalizeProp(obj)
+
+            stat = os.stat(path)
+            self.index[prop_name] = {
+                "path": path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha1": fileHash(path),
+                "polycount": len(obj.data.polygons),
+                "n_vertices": len(obj.data.vertices),
+                "dimensions": list(obj["original_dimensions"]),
+            }
+            obj["source_sha1"] = self.index[prop_name]["sha1"]  # Key of the LOD cache
+            bpy.data.libraries.write(self.prop_blend_path(prop_name), {obj}, path_remap="ABSOLUTE", fake_user=True)
+            self.remove(obj)
+
+            # Save now and then so an interrupted indexing run is not lost
+            if (i + 1) % 100 == 0:
+                self.save_index()
+            printProgressBar(i + 1, len(stale), prefix="Progress:", suffix="Complete", length=50)
+
+        self.save_index()
+
+    def select(
+        self, min_polycount: int = 0, max_polycount: int = None, where: Callable[[dict], bool] = None
+    ) -> List[str]:
+        """Names of props whose index entry matches, no files are opened."""
+        names = []
+        for prop_name, entry in self.index.items():
+            if entry["polycount"] < min_polycount:
+                continue
+            if max_polycount is not None and entry["polycount"] > max_polycount:
+                continue
+            if where is not None and not where(entry):
+                continue
+            names.append(prop_name)
+        return names
+
+    def sample(self, prop_names: List[str] = None) -> bpy.types.Object:
+        """Loads and returns a random prop, from prop_names if given."""
+        return self.load(random.choice(prop_names if prop_names is not None else self.names))
+
+    def load(self, prop_name: str) -> bpy.types.Object:
+        """Returns the template object of prop_name, appending it from its preprocessed .blend if not loaded."""
+        if prop_name in self.loaded:
+            self.loaded.move_to_end(prop_name)
+            return self.loaded[prop_name]
+
+        # Appended (not linked) so evicted props can be removed from bpy.data again
+        old = redirectOutputStart()
+        with bpy.data.libraries.load(self.prop_blend_path(prop_name), link=False) as (data_from, data_to):
+            data_to.objects = [prop_name]
+        redirectOutputEnd(old)
+        obj = data_to.objects[0]
+        obj.name = prop_name
+
+        self.loaded[prop_name] = obj
+        self.evict()
+        return obj
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used props beyond max_loaded. Props with instances (see
+        blender_objects.Prop) are pinned, their template and mesh are still used, as is the prop just loaded.
+        """
+        if len(self.loaded) <= self.max_loaded:
+            return
+        shown = {obj.get("template_name") for obj in bpy.data.objects}
+        for prop_name in list(self.loaded)[:-1]:
+            if len(self.loaded) <= self.max_loaded:
+                break
+            if prop_name not in shown:
+                self.remove(self.loaded.pop(prop_name))
+
+    @staticmethod
+    def remove(obj: bpy.types.Object) -> None:
+        """Removes a template object, and its mesh, materials and images unless instances still use them."""
+        mesh = obj.data
+        bpy.data.objects.remove(obj)
+        if mesh.users > 0:
+            return
+
+        materials = [material for material in mesh.materials if material is not None]
+        bpy.data.meshes.remove(mesh)
+        for material in materials:
+            if material.users > 0:
+                continue
+            images = []
+            if material.node_tree is not None:
+                images = [node.image for node in material.node_tree.nodes if getattr(node, "image", None) is not None]
+            bpy.data.materials.remove(material)
+            for image in images:
+                if image.users == 0:
+                    bpy.data.images.remove(image)
@@ -1,50 +1,454 @@
 import bpy
+import numpy as np
 
-from .utils import printProgressBar, redirectOutputEnd, redirectOutputStart
+from .dataset import frame_digits, frame_name
+from .geometry import annotate_geometry, camera_intrinsics
+from .labels import annotate_mask
+from .manifest import pose_hash
+from .metrics import Metrics
+from .profiles import FLAT_SEGMENTATION, apply_profile, swap_profile
+from .visibility import (
+    frame_score,
+    instance_matrices,
+    look_at_matrices,
+    prepass_stats,
+    score_visibility,
+    subsample_points,
+)
+from .utils import (
+    cameraIntrinsics,
+    dataBlockCounts,
+    decodeInstanceIds,
+    exactColorSettings,
+    readMask,
+    redirectOutputEnd,
+    redirectOutputStart,
+    restoreColorSettings,
+    setKeyframes,
+    templateVertices,
+    viewerPixels,
+)
 
 
-def render(render_directory, camera, grid, n_images=1, resolution=(350, 350)):
+def apply_pose(camera, grid, poses, k):
+    """Moves camera and props to row k of poses from sampling.sample_poses."""
+    camera.move_abs_cartesian(poses["camera_location"][k])
+    camera.look_at(poses["camera_target"][k])
+    camera.set_lens(poses["lens"][k])
+    for prop, rotation in zip(grid.prop_list, poses["prop_rotation"][k]):
+        prop.rotate_quaternion(rotation)
+
+
+def appearance_indices(poses, k):
+    """Pool indices of row k of poses, see appearance.sample_appearance."""
+    if poses is None:
+        return {}
+    return {key: poses[key][k] for key in ("material_variant", "light_rig") if key in poses}
+
+
+def visibility_scorer(camera, grid, policy, resolution=(350, 350)):
+    """
+    score(poses, k) of visibility.screen_poses: the frame_score of the props of grid in row k of poses. A PropPool is
+    arranged for the frame of the row.
+    """
+    template_vertices, member_template = templateVertices(grid.members)
+    template_points = subsample_points(template_vertices)
+    sensor = (camera.data.sensor_width, camera.data.sensor_height, camera.data.sensor_fit)
+
+    def score(poses, k):
+        grid.arrange(int(poses["frame"][k]))
+        props = grid.prop_list
+        locations = np.array([prop.object.location for prop in props]).reshape(-1, 3)
+        scales = np.array([prop.object.scale for prop in props]).reshape(-1, 3)
+        matrices = instance_matrices(locations, poses["prop_rotation"][k][: len(props)], scales)
+        camera_matrix = look_at_matrices(poses["camera_location"][k : k + 1], poses["camera_target"][k : k + 1])[0]
+        intrinsics = camera_intrinsics(poses["lens"][k], *sensor, resolution)
+        scores = score_visibility(
+            template_points,
+            member_template[grid.visible],
+            matrices,
+            camera_matrix,
+            intrinsics,
+            resolution,
+            policy["buffer_size"],
+        )
+        return frame_score(scores, policy)
+
+    return score
+
+
+def frame_annotations(
+    camera, grid, instance_ids, resolution, mask=None, geometry=None, lod_levels=None, appearance=None
+):
+    """
+    Annotations of the current frame.
+
+        Parameters:
+            mask (np.ndarray): (height, width, 4) uint8 "id" encoded mask, row 0 at the top. Gives annotate_mask.
+            geometry (tuple): (template_vertices, instance_template) from templateVertices. Gives annotate_geometry.
+            lod_levels (np.ndarray): Level of detail every instance was rendered with, see lod_cache.PropLods.
+            appearance (dict): From appearance_indices, the material variant of every instance and the light rig.
+    """
+    annotations = {"instance_id": np.asarray(instance_ids)}
+    if lod_levels is not None:
+        annotations["lod"] = np.asarray(lod_levels)
+    for key, value in (appearance or {}).items():
+        annotations[key] = np.broadcast_to(value, (len(instance_ids),))
+    if mask is not None:
+        annotations.update(annotate_mask(decodeInstanceIds(mask), instance_ids))
+    if geometry is not None:
+        # No parenting, so matrix_basis is the world matrix and needs no depsgraph update
+        matrices = np.array([prop.object.matrix_basis for prop in grid.prop_list])
+        annotations.update(
+            annotate_geometry(
+                *geometry,
+                matrices,
+                np.array(camera.object.matrix_basis),
+                cameraIntrinsics(camera.data, resolution),
+                resolution,
+            )
+        )
+    return annotations
+
+
+def add_manifest_entry(manifest, frame, paths, camera, fields=None, external_paths=()):
+    """
+    Manifest entry of frame with its camera pose and extra fields, e.g. the appearance, levels of detail and the
+    pose_hash checked on resume.
+    """
+    manifest.add(
+        frame,
+        paths,
+        external_paths,
+        camera_location=camera.object.location,
+        camera_rotation=camera.object.rotation_quaternion,
+        lens=camera.data.lens,
+        **(fields or {}),
+    )
+
+
+def segmentation_paths(segmentation_output, render_directory, frame, digits):
+    """Files written by the File Output node of createSegmentationCompositor for frame (0-based)."""
+    paths = []
+    for slot in segmentation_output.file_slots:
+        slot_format = segmentation_output.format if slot.use_node_format else slot.format
+        extension = ".exr" if slot_format.file_format == "OPEN_EXR" else ".png"
+        slot_path = slot.path.replace("#" * digits, f"{frame + 1:0{digits}}")
+        paths.append(f"{render_directory}/{slot_path}{extension}")
+    return paths
+
+
+def render(
+    render_directory,
+    camera,
+    grid,
+    n_images=1,
+    resolution=(350, 350),
+    frames=None,
+    worker=False,
+    segmentation_output=None,
+    mask_encoding="ramp",
+    poses=None,
+    label_writer=None,
+    mask_labels=True,
+    geometry_labels=False,
+    image_writer=None,
+    manifest=None,
+    n_finished=0,
+    events_path=None,
+    lods=None,
+    appearance_pool=None,
+):
+    """
+    Renders images and segmentation masks of grid from random camera positions.
+
+        Parameters:
+            frames (range): Frame indices to render, default is range(n_images). File names are numbered by frame
+                index so workers rendering disjoint ranges into the same directory never collide. Can be any
+                increasing sequence, e.g. the frames a resumed run still has to render.
+            worker (bool): Report every frame as a parseable event line for the parent process (metrics.Metrics)
+                instead of a progress bar.
+            segmentation_output (bpy.types.CompositorNodeOutputFile): File Output node from
+                createSegmentationCompositor. If given the mask is written from render passes in the same render,
+                otherwise the scene is rendered a second time with Workbench showing the unlit object colours, see
+                profiles.FLAT_SEGMENTATION and setSegmentationColors.
+            mask_encoding (str): "ramp" or "id", with "id" the segmentation render is done without colour management
+                so the instance ids in the mask are exact.
+            poses (dict(str, np.ndarray)): Precomputed poses from sampling.sample_poses, row k is used for frames[k].
+                If not given the camera is moved with Python's random module.
+            label_writer (labels.LabelWriter): If given, the annotations of each frame are added to it.
+            mask_labels (bool): Annotations computed from the mask, requires mask_encoding "id".
+            geometry_labels (bool): 2D/3D boxes and keypoints computed by projecting the prop meshes.
+            image_writer (writer.AsyncImageWriter): If given, images and material masks are not written by Blender but
+                read from the Viewer Node and encoded on the writer's threads while the next frame renders. Requires
+                addViewerNode and the "Standard" view transform.
+            manifest (manifest.Manifest): If given, every frame is recorded with its camera pose and output files.
+            n_finished (int): Frames already rendered by an earlier run, counted in the progress.
+            events_path (str): If given, the per-frame events of metrics.Metrics are also appended to this file.
+            lods (lod_cache.PropLods): If given, every prop is rendered with the level of detail of its projected size,
+                recorded as "lod" in the annotations.
+            appearance_pool (blender_objects.AppearancePool): If given, the material variants and light rig of every
+                frame are taken from the "material_variant" and "light_rig" of poses and recorded in the annotations
+                and the manifest.
+    """
+    if frames is None:
+        frames = range(n_images)
+    n_frames = len(frames)
 
     # Setup camera
     bpy.context.scene.camera = camera.object  # Set camera as render camera
     bpy.context.scene.render.resolution_x = resolution[0]  # Set resolution width
     bpy.context.scene.render.resolution_y = resolution[1]  # Set resolution height
 
-    print()
-    print(f"Generating {n_images} renders in {render_directory}.")
-    printProgressBar(0, n_images, prefix="Progress:", suffix="Complete", length=50)
+    digits = frame_digits(n_images)
+    if segmentation_output is not None:
+        segmentation_output.base_path = render_directory
+        for slot in segmentation_output.file_slots:
+            slot.path = slot.path.replace("###", "#" * digits)
+    if geometry_labels:
+        template_vertices, member_template = templateVertices(grid.members)
+
+    if not worker:
+        print()
+        print(f"Generating {n_frames} renders in {render_directory}.")
+    metrics = Metrics(n_finished + n_frames, n_finished, worker=worker, events_path=events_path)
+    if poses is not None and "prepass_accepted" in poses:
+        metrics.emit({"event": "prepass", **prepass_stats(poses)})
+
+    for n_done, i in enumerate(frames, start=1):
+        # Props of the frame, a PropPool shows a new composition
+        with metrics.stage("arrange"):
+            grid.arrange(i)
+            instance_ids = [prop.object.pass_index for prop in grid.prop_list]
+
+        with metrics.stage("pose"):
+            if poses is not None:
+                # Apply precomputed camera and prop poses
+                apply_pose(camera, grid, poses, n_done - 1)
+            else:
+                # Randomize camera position and direction
 
-    for i in range(n_images):
-        # Randomize camera position and direction
+                # camera.moveRandomSphere(grid.center, grid.distance_to_edge, grid.distance_to_edge*1.1)
+                camera.move_abs_spherical_random(grid.center, grid.distance_to_edge * 1.8, grid.distance_to_edge * 2.2)
+                camera.look_at(grid.center)
 
-        # camera.moveRandomSphere(grid.center, grid.distance_to_edge, grid.distance_to_edge*1.1)
-        camera.move_abs_spherical_random(grid.center, grid.distance_to_edge * 1.8, grid.distance_to_edge * 2.2)
-        camera.look_at(grid.center)
+        # Material variants and light rig of the frame, only pool entries are reassigned
+        appearance = appearance_indices(poses, n_done - 1) if appearance_pool is not None else {}
+        if appearance:
+            with metrics.stage("appearance"):
+                appearance_pool.apply(grid, poses, n_done - 1)
+
+        # Levels of detail for the camera of the frame
+        lod_levels = None
+        if lods is not None:
+            with metrics.stage("lod"):
+                lod_levels = lods.apply(camera, grid, resolution)
 
         ## Setup savepath
-        filename = f"render{i+1:03}.png"
+        name = frame_name(i, n_images)
+        filename = f"{name}.png"
         filepath = render_directory + "/" + filename
         bpy.context.scene.render.filepath = filepath
+        write_still = image_writer is None  # Otherwise the pixels are handed to the writer threads
+        mask_pixels = None
+        paths = [filepath]
+        external_paths = []  # Written by Blender during the render, also with an image_writer
 
         # Redirect output to log file
         old = redirectOutputStart()
 
-        # Render image
-        bpy.ops.render.render(write_still=True)
+        if segmentation_output is not None:
+            # Render image, the compositor writes render###_segmentation.png with ### = frame_current
+            bpy.context.scene.frame_current = i + 1
+            with metrics.stage("render"):
+                bpy.ops.render.render(write_still=write_still)
+            if image_writer is not None:
+                with metrics.stage("write"):
+                    paths[0] = image_writer.submit(i, "image", f"{render_directory}/{name}", viewerPixels())
+            redirectOutputEnd(old)
+            external_paths = segmentation_paths(segmentation_output, render_directory, i, digits)
+        else:
+            # Render image
+            with metrics.stage("render"):
+                bpy.ops.render.render(write_still=write_still)
+            if image_writer is not None:
+                with metrics.stage("write"):
+                    paths[0] = image_writer.submit(i, "image", f"{render_directory}/{name}", viewerPixels())
+
+            # Segmentation, the cheapest engine renders the flat object colours
+            with metrics.stage("segmentation"):
+                old_profile = swap_profile(bpy.context.scene, FLAT_SEGMENTATION)
+                segmentation_filename = f"{name}_segmentation.png"
+                segmentation_filepath = render_directory + "/" + segmentation_filename
+                bpy.context.scene.render.filepath = segmentation_filepath
+                if mask_encoding == "id":
+                    old_settings = exactColorSettings(bpy.context.scene)
+                    bpy.ops.render.render(write_still=write_still)
+                    restoreColorSettings(bpy.context.scene, old_settings)
+                else:
+                    bpy.ops.render.render(write_still=write_still)
+            if image_writer is not None:
+                with metrics.stage("write"):
+                    mask_pixels = viewerPixels()
+                    linear = mask_encoding == "id"
+                    mask_path = f"{render_directory}/{name}_segmentation"
+                    segmentation_filepath = image_writer.submit(i, "mask", mask_path, mask_pixels, linear=linear)
+            paths.append(segmentation_filepath)
+            apply_profile(bpy.context.scene, old_profile)
+
+            # Disable output redirection
+            redirectOutputEnd(old)
+
+        # Annotations from the mask just written and from the scene geometry
+        if label_writer is not None:
+            with metrics.stage("labels"):
+                if mask_labels and mask_pixels is not None:
+                    mask = np.round(mask_pixels[::-1] * 255).astype(np.uint8)
+                elif mask_labels:
+                    mask = readMask(f"{render_directory}/{name}_segmentation.png")
+                else:
+                    mask = None
+                geometry = (template_vertices, member_template[grid.visible]) if geometry_labels else None
+                annotations = frame_annotations(
+                    camera, grid, instance_ids, resolution, mask, geometry, lod_levels, appearance
+                )
+                label_writer.add(i, annotations)
+
+        if manifest is not None:
+            with metrics.stage("manifest"):
+                fields = dict(appearance)
+                if lod_levels is not None:
+                    fields["lod"] = lod_levels
+                if poses is not None:
+                    fields["pose_sha1"] = pose_hash(poses, n_done - 1)
+                add_manifest_entry(manifest, i, paths, camera, fields, external_paths)
+
+        metrics.frame(i, data=dataBlockCounts())
+    metrics.close()
+
+
+def contiguous_batches(frames, batch_size):
+    """Splits increasing frames into runs of consecutive frames of at most batch_size frames."""
+    batch = []
+    for frame in frames:
+        if batch and (frame != batch[-1] + 1 or len(batch) == batch_size):
+            yield batch
+            batch = []
+        batch.append(frame)
+    if batch:
+        yield batch
+
+
+def render_batch(
+    render_directory,
+    camera,
+    grid,
+    poses,
+    frames,
+    n_images,
+    batch_size=64,
+    resolution=(350, 350),
+    worker=False,
+    segmentation_output=None,
+    mask_encoding="ramp",
+    label_writer=None,
+    mask_labels=True,
+    geometry_labels=False,
+    manifest=None,
+    n_finished=0,
+    events_path=None,
+):
+    """
+    Like render, but the poses of up to batch_size consecutive frames are keyframed on scene frames frame + 1 and
+    rendered with one animation render, Blender replaces the "#" of the output paths by the frame number. Writes the
+    same files and labels as render, material masks are a second animation render with Workbench.
 
-        # Segmentation
-        for prop in grid.prop_list:
-            prop.setMaterial("segmentation_material")
-        segmentation_filename = f"render{i+1:03}_segmentation.png"
-        segmentation_filepath = render_directory + "/" + segmentation_filename
-        bpy.context.scene.render.filepath = segmentation_filepath
-        bpy.ops.render.render(write_still=True)
+        Parameters:
+            poses (dict(str, np.ndarray)): Precomputed poses from sampling.sample_poses, row k is used for frames[k].
+            frames (list(int)): Increasing frame indices to render.
+    """
+    scene = bpy.context.scene
+    scene.camera = camera.object
+    scene.render.resolution_x = resolution[0]
+    scene.render.resolution_y = resolution[1]
+
+    digits = frame_digits(n_images)
+    if segmentation_output is not None:
+        segmentation_output.base_path = render_directory
+        for slot in segmentation_output.file_slots:
+            slot.path = slot.path.replace("###", "#" * digits)
+    instance_ids = [prop.object.pass_index for prop in grid.prop_list]
+    geometry = templateVertices(grid.prop_list) if geometry_labels else None
+    row_of_frame = {frame: k for k, frame in enumerate(frames)}
+
+    n_frames = len(frames)
+    if not worker:
+        print()
+        print(f"Generating {n_frames} renders in {render_directory} in batches of {batch_size}.")
+    metrics = Metrics(n_finished + n_frames, n_finished, worker=worker, events_path=events_path)
+    if "prepass_accepted" in poses:
+        metrics.emit({"event": "prepass", **prepass_stats(poses)})
+
+    for batch in contiguous_batches(frames, batch_size):
+        # Camera rotations come from look_at, so apply every pose once and keyframe the result
+        with metrics.stage("keyframes"):
+            rows = [row_of_frame[frame] for frame in batch]
+            scene_frames = np.array(batch) + 1
+            camera_rotations = []
+            for k in rows:
+                apply_pose(camera, grid, poses, k)
+                camera_rotations.append(tuple(camera.object.rotation_quaternion))
+            setKeyframes(camera.object, "location", scene_frames, poses["camera_location"][rows])
+            setKeyframes(camera.object, "rotation_quaternion", scene_frames, camera_rotations)
+            setKeyframes(camera.data, "lens", scene_frames, poses["lens"][rows])
+            for prop_idx, prop in enumerate(grid.prop_list):
+                setKeyframes(prop.object, "rotation_quaternion", scene_frames, poses["prop_rotation"][rows, prop_idx])
+            scene.frame_start = scene_frames[0]
+            scene.frame_end = scene_frames[-1]
+
+        old = redirectOutputStart()
+
+        # Images, and with segmentation_output the compositor writes the passes of every frame
+        with metrics.stage("render"):
+            scene.render.filepath = f"{render_directory}/render{'#' * digits}"
+            bpy.ops.render.render(animation=True)
+
+        # Masks, the cheapest engine renders the flat object colours
+        if segmentation_output is None:
+            with metrics.stage("segmentation"):
+                old_profile = swap_profile(scene, FLAT_SEGMENTATION)
+                scene.render.filepath = f"{render_directory}/render{'#' * digits}_segmentation"
+                if mask_encoding == "id":
+                    old_settings = exactColorSettings(scene)
+                    bpy.ops.render.render(animation=True)
+                    restoreColorSettings(scene, old_settings)
+                else:
+                    bpy.ops.render.render(animation=True)
+                apply_profile(scene, old_profile)
 
-        # Disable output redirection
         redirectOutputEnd(old)
 
-        # Restore materials
-        for prop in grid.prop_list:
-            prop.restoreMaterial()
+        for frame, k in zip(batch, rows):
+            name = frame_name(frame, n_images)
+            paths = [f"{render_directory}/{name}.png"]
+            if segmentation_output is not None:
+                paths += segmentation_paths(segmentation_output, render_directory, frame, digits)
+            else:
+                paths.append(f"{render_directory}/{name}_segmentation.png")
+
+            # The keyframed values of the frame, without a frame change
+            apply_pose(camera, grid, poses, k)
+            if label_writer is not None:
+                with metrics.stage("labels"):
+                    mask = readMask(f"{render_directory}/{name}_segmentation.png") if mask_labels else None
+                    label_writer.add(frame, frame_annotations(camera, grid, instance_ids, resolution, mask, geometry))
+            if manifest is not None:
+                with metrics.stage("manifest"):
+                    add_manifest_entry(manifest, frame, paths, camera, {"pose_sha1": pose_hash(poses, k)})
+
+        metrics.frame(batch[-1], n_frames=len(batch), data=dataBlockCounts())
+    metrics.close()
 
-        printProgressBar(i + 1, n_images, prefix="Progress:", suffix="Complete", length=50)
+    # Later renders set poses directly
+    for id_data in [camera.object, camera.data] + [prop.object for prop in grid.prop_list]:
+        id_data.animation_data_clear()
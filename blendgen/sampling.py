@@ -0,0 +1,111 @@
+"""
+Vectorized pose sampling. Every camera and prop pose of a run is drawn up front as NumPy arrays. Frames are drawn in
+fixed size blocks seeded by the seed and the block index (see streams), so the pose of a frame only depends on the seed
+and its frame index: shards, reruns and runs with a different n_images all get the same pose for the same frame. Does
+not depend on bpy.
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+
+from .streams import POSES, stream_rng
+
+BLOCK_SIZE = 1024
+
+
+def uniform_directions(rng: np.random.Generator, n: int) -> np.ndarray:
+    """(n, 3) unit vectors uniformly distributed on the sphere."""
+    directions = rng.standard_normal((n, 3))
+    return directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+
+def uniform_quaternions(rng: np.random.Generator, shape: Tuple[int, ...]) -> np.ndarray:
+    """(*shape, 4) uniformly distributed rotations as (w, x, y, z) quaternions (Shoemake 1992)."""
+    u1, u2, u3 = rng.random((3, *shape))
+    a = np.sqrt(1 - u1)
+    b = np.sqrt(u1)
+    angle2 = 2 * np.pi * u2
+    angle3 = 2 * np.pi * u3
+    return np.stack((a * np.sin(angle2), a * np.cos(angle2), b * np.sin(angle3), b * np.cos(angle3)), axis=-1)
+
+
+def sample_block(seed: int, block_idx: int, n_instances: int, attempt: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Unscaled random values for frames block_idx * BLOCK_SIZE to (block_idx + 1) * BLOCK_SIZE. attempt > 0 draws the
+    poses a frame gets when the pose of an earlier attempt was rejected, see visibility.screen_poses.
+    """
+    rng = stream_rng(seed, POSES, block_idx, attempt)
+    return {
+        "camera_direction": uniform_directions(rng, BLOCK_SIZE),
+        "camera_radius": rng.random(BLOCK_SIZE),
+        "lens": rng.random(BLOCK_SIZE),
+        "target_direction": uniform_directions(rng, BLOCK_SIZE),
+        "target_radius": rng.random(BLOCK_SIZE),
+        "prop_rotation": uniform_quaternions(rng, (BLOCK_SIZE, n_instances)),
+    }
+
+
+def sample_poses(
+    seed: int,
+    frames: range,
+    n_instances: int,
+    center: Tuple[float, float, float],
+    radius_range: Tuple[float, float],
+    lens_range: Tuple[float, float] = (50, 50),
+    target_jitter: float = 0.0,
+    upper_hemisphere: bool = False,
+    attempt: int = 0,
+) -> Dict[str, np.ndarray]:
+    """
+    Samples the poses of the given frames.
+
+        Parameters:
+            seed (int): Seed of the run, the same for every shard.
+            frames (range): Frame indices, contiguous.
+            n_instances (int): Number of props, each gets a rotation per frame.
+            center (tuple(float)): Point the camera orbits.
+            radius_range (tuple(float)): Camera distance to center, uniform in [min, max).
+            lens_range (tuple(float)): Focal length in mm, uniform in [min, max).
+            target_jitter (float): Look-at target is uniform in a ball of this radius around center.
+            upper_hemisphere (bool): Keep the camera above center, e.g. above a ground plane.
+            attempt (int): Independent poses of the same frames for attempt > 0, drawn when a pose was rejected.
+
+        Returns:
+            poses (dict(str, np.ndarray)): "frame" (n,), "camera_location" (n, 3), "camera_target" (n, 3),
+            "lens" (n,) and "prop_rotation" (n, n_instances, 4) with row k belonging to frames[k].
+    """
+    assert frames.step == 1, "frames has to be contiguous"
+    n_frames = len(frames)
+    if n_frames == 0:
+        blocks = [sample_block(seed, 0, n_instances, attempt)]
+        offset = 0
+    else:
+        first_block = frames.start // BLOCK_SIZE
+        last_block = (frames.stop - 1) // BLOCK_SIZE
+        block_indices = range(first_block, last_block + 1)
+        blocks = [sample_block(seed, block_idx, n_instances, attempt) for block_idx in block_indices]
+        offset = frames.start - first_block * BLOCK_SIZE
+    values = {key: np.concatenate([block[key] for block in blocks])[offset : offset + n_frames] for key in blocks[0]}
+
+    center = np.asarray(center, dtype=np.float64)
+    if upper_hemisphere:
+        values["camera_direction"][:, 2] = np.abs(values["camera_direction"][:, 2])
+    radius = radius_range[0] + values["camera_radius"] * (radius_range[1] - radius_range[0])
+    # Cube root gives a uniform distribution inside the ball
+    target_radius = target_jitter * np.cbrt(values["target_radius"])
+    return {
+        "frame": np.arange(frames.start, frames.start + n_frames),
+        "camera_location": center + values["camera_direction"] * radius[:, None],
+        "camera_target": center + values["target_direction"] * target_radius[:, None],
+        "lens": lens_range[0] + values["lens"] * (lens_range[1] - lens_range[0]),
+        "prop_rotation": values["prop_rotation"],
+    }
+
+
+def save_poses(path: str, poses: Dict[str, np.ndarray]) -> None:
+    np.savez_compressed(path, **poses)
+
+
+def load_poses(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
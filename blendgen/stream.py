@@ -0,0 +1,273 @@
+"""
+Online generation: Blender workers send every rendered frame over a local socket to the process consuming the samples,
+e.g. the data loader of a training run, instead of writing it to disk. Frames arrive as (image, mask, labels) NumPy
+arrays in a bounded queue. When the consumer falls behind the queue fills up, the socket buffers fill up and the
+workers block in StreamWriter.add until there is room again. Does not depend on bpy.
+"""
+import io
+import os
+import queue
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+
+from .dataset import mask_array
+from .launch import blender_command, split_frames
+from .writer import to_uint8
+
+HEADER = struct.Struct(">Q")
+
+
+class Sample(NamedTuple):
+    """
+    A rendered frame.
+
+        image (np.ndarray): (height, width, 4) uint8 sRGB image, row 0 at the top.
+        mask (np.ndarray): (height, width) int32 instance ids of "id" encoded masks, otherwise (height, width, 4)
+            uint8 colours.
+        labels (dict(str, np.ndarray)): "frame", "instance_id" and the annotations of --labels/--geometry-labels, one
+            row per instance (see labels.annotate_mask and geometry.annotate_geometry).
+    """
+
+    image: np.ndarray
+    mask: np.ndarray
+    labels: Dict[str, np.ndarray]
+
+
+def send_arrays(connection: socket.socket, arrays: Dict[str, np.ndarray]) -> None:
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    data = buffer.getbuffer()
+    connection.sendall(HEADER.pack(len(data)))
+    connection.sendall(data)
+
+
+def receive_arrays(stream) -> Dict[str, np.ndarray]:
+    """Arrays of the next message of a binary file of a socket, None at the end of the stream."""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    with np.load(io.BytesIO(data)) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+class StreamWriter:
+    """
+    Sends the frames of a Blender worker to a SampleStream. Has the submit interface of writer.AsyncImageWriter for
+    the image and the mask of a frame and the add interface of labels.LabelWriter, which sends the frame. The time
+    spent waiting for the consumer is kept in blocked_seconds.
+    """
+
+    def __init__(self, port: int) -> None:
+        self.connection = socket.create_connection(("127.0.0.1", port))
+        self.frame = {}
+        self.blocked_seconds = 0.0
+
+    def submit(
+        self, frame: int, kind: str, path_without_extension: str, pixels: np.ndarray, linear: bool = False
+    ) -> str:
+        """Keeps a (height, width, 4) float RGBA buffer with row 0 at the bottom as the image or mask of frame."""
+        pixels = pixels[::-1]
+        if kind == "image":
+            self.frame = {"image": to_uint8(pixels, linear)}
+        else:
+            self.frame["mask"] = mask_array(pixels, linear)
+        return path_without_extension
+
+    def add(self, frame: int, annotations: Dict[str, np.ndarray]) -> None:
+        """Sends the frame with its annotations, blocks while the consumer's queue is full."""
+        arrays = {**self.frame, "frame": np.int64(frame)}
+        arrays.update({f"label_{key}": value for key, value in annotations.items()})
+        start = time.perf_counter()
+        send_arrays(self.connection, arrays)
+        self.blocked_seconds += time.perf_counter() - start
+        self.frame = {}
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class SampleStream:
+    """
+    Iterator over Samples rendered by Blender workers in the background, started when the stream is created. Use as a
+    context manager, or call close, to stop the workers.
+
+        Parameters:
+            prop_path (str): Prop file or directory, as for the blendgen CLI.
+            n_images (int): Frames to render before the iteration stops, None to render new frames indefinitely.
+            n_workers (int): Blender processes, each renders different frames.
+            max_queued (int): Samples received but not yet consumed, workers block when the queue is full.
+            seed (int): Frames only depend on the seed and the frame index, as in a run of the CLI.
+            chunk_size (int): Frames whose poses a worker samples at once.
+            options (list(str)): Extra main_blender.py arguments, e.g. ["--mask-encoding", "id", "--labels"].
+            save_path (str): Directory for the workers' logs and instance tables, a temporary one by default.
+    """
+
+    def __init__(
+        self,
+        prop_path: str,
+        n_instances: int,
+        n_images: int = None,
+        n_workers: int = 1,
+        max_queued: int = 64,
+        seed: int = 0,
+        chunk_size: int = 64,
+        options: List[str] = (),
+        save_path: str = None,
+    ) -> None:
+        self.samples = queue.Queue(maxsize=max_queued)
+        self.closed = threading.Event()
+        self.temporary = save_path is None
+        self.save_path = tempfile.mkdtemp(prefix="blendgen_stream_") if save_path is None else save_path
+        for directory in ("renders", "labels"):
+            os.makedirs(os.path.join(self.save_path, directory), exist_ok=True)
+
+        self.server = socket.create_server(("127.0.0.1", 0))
+        port = self.server.getsockname()[1]
+
+        # Workers render disjoint frame ranges, or interleaved chunks of an endless sequence
+        if n_images is None:
+            frame_ranges = [(worker_idx * chunk_size, None) for worker_idx in range(n_workers)]
+            stride = n_workers * chunk_size
+        else:
+            frame_ranges = split_frames(n_images, n_workers)
+            stride = chunk_size
+        threads = max(1, (os.cpu_count() or 1) // len(frame_ranges))
+
+        self.processes = []
+        self.log_paths = []
+        for worker_idx, (frame_start, frame_end) in enumerate(frame_ranges):
+            command = blender_command(
+                prop_path,
+                self.save_path,
+                n_images or 0,
+                n_instances,
+                "--seed",
+                seed,
+                "--scene-seed",
+                seed,
+                "--threads",
+                threads,
+                "--worker",
+                "--frame-start",
+                frame_start,
+                "--stream-port",
+                port,
+                "--stream-chunk",
+                chunk_size,
+                "--stream-stride",
+                stride,
+                *options,
+            )
+            if frame_end is not None:
+                command += ["--frame-end", str(frame_end)]
+            log_path = os.path.join(self.save_path, f"worker_{worker_idx}.log")
+            with open(log_path, "w") as log:
+                process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            self.processes.append(process)
+            self.log_paths.append(log_path)
+
+        self.readers = []
+        self.connections = []
+        self.acceptor = threading.Thread(target=self.accept, daemon=True)
+        self.acceptor.start()
+
+    def accept(self) -> None:
+        self.server.settimeout(0.5)
+        while len(self.readers) < len(self.processes) and not self.closed.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # Closed
+            self.connections.append(connection)
+            reader = threading.Thread(target=self.read, args=(connection,), daemon=True)
+            self.readers.append(reader)
+            reader.start()
+
+    def read(self, connection: socket.socket) -> None:
+        with connection.makefile("rb") as stream:
+            while not self.closed.is_set():
+                try:
+                    arrays = receive_arrays(stream)
+                except OSError:
+                    return
+                if arrays is None:
+                    return
+                labels = {key[len("label_") :]: value for key, value in arrays.items() if key.startswith("label_")}
+                labels["frame"] = arrays["frame"]
+                sample = Sample(arrays["image"], arrays.get("mask"), labels)
+
+                # Not reading further is the backpressure on the worker
+                while not self.closed.is_set():
+                    try:
+                        self.samples.put(sample, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Sample:
+        while True:
+            try:
+                return self.samples.get(timeout=0.5)
+            except queue.Empty:
+                pass
+            if self.closed.is_set():
+                raise StopIteration
+            # Finished when every worker exited and everything they sent was consumed
+            if all(process.poll() is not None for process in self.processes):
+                if any(reader.is_alive() for reader in self.readers) or not self.samples.empty():
+                    continue
+                self.raise_errors()
+                raise StopIteration
+
+    def raise_errors(self) -> None:
+        for worker_idx, process in enumerate(self.processes):
+            if process.returncode not in (0, None):
+                with open(self.log_paths[worker_idx]) as f:
+                    tail = "".join(deque(f, maxlen=20))
+                raise RuntimeError(f"Worker {worker_idx} exited with {process.returncode}:\n{tail}")
+
+    def close(self) -> None:
+        """Stops the workers and drops the queued samples."""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.server.close()
+        for connection in self.connections:
+            connection.close()
+        for thread in [self.acceptor, *self.readers]:
+            thread.join()
+        if self.temporary:
+            shutil.rmtree(self.save_path, ignore_errors=True)
+
+    def __enter__(self) -> "SampleStream":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
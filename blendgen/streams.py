@@ -0,0 +1,17 @@
+"""
+Registry of the random streams of a run. Every stream draws from np.random.default_rng([seed, stream, a, b]) with its
+own stream id and the same key length, SeedSequence ignores trailing zeros so keys of different lengths (e.g.
+[seed, 1] and [seed, 1, 0]) could otherwise give the same numbers. Does not depend on bpy.
+"""
+import numpy as np
+
+POSES = 1  # a = block, b = attempt, see sampling.sample_block
+COMPOSITION = 2  # a = frame, see layout.sample_composition
+MATERIAL_VARIANTS = 3  # see appearance.sample_material_variants
+LIGHT_RIGS = 4  # see appearance.sample_light_rigs
+APPEARANCE = 5  # a = block, see appearance.sample_appearance
+
+
+def stream_rng(seed: int, stream: int, a: int = 0, b: int = 0) -> np.random.Generator:
+    """Generator of stream for the indices a and b, e.g. block and attempt."""
+    return np.random.default_rng([seed, stream, a, b])
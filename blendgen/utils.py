@@ -1,24 +1,60 @@
 import datetime
+import json
 import os
 import random
 import sys
 
+import bmesh
 import bpy
+import mathutils
+import numpy as np
+
+from .geometry import camera_intrinsics
+from .labels import MAX_INSTANCE_ID
 
 
 def newScene():
     bpy.ops.scene.new(type="EMPTY")
 
 
+def removeScene(scene: bpy.types.Scene) -> None:
+    """
+    Removes scene with its objects, the generated materials and the levels of detail, props imported into bpy.data
+    are kept. Used by the daemon to clean up after a job.
+    """
+    for obj in list(scene.objects):
+        data = obj.data
+        bpy.data.objects.remove(obj)
+        # Cameras, lights and ground planes, prop instances share the mesh of their template
+        if data is not None and data.users == 0 and data.id_type in ("MESH", "CAMERA", "LIGHT"):
+            getattr(bpy.data, {"MESH": "meshes", "CAMERA": "cameras", "LIGHT": "lights"}[data.id_type]).remove(data)
+    for material in list(bpy.data.materials):
+        if material.get("is_auto"):
+            bpy.data.materials.remove(material)
+    for mesh in list(bpy.data.meshes):
+        if mesh.get("is_lod"):
+            bpy.data.meshes.remove(mesh)
+    bpy.data.scenes.remove(scene)
+
+
 def deleteScene():
-    for obj in bpy.context.scene.objects:
-        if obj.name[-1].isdigit() is True:
-            obj.select_set(True)
-        else:
-            obj.select_set(False)
+    """Removes the objects of the scene whose names end in a digit (the generated instances)."""
+    for obj in list(bpy.context.scene.objects):
+        if obj.name[-1].isdigit():
+            bpy.data.objects.remove(obj)
 
-    bpy.ops.object.delete()
-    bpy.ops.object.select_all(action="DESELECT")
+
+def centerOrigin(obj: bpy.types.Object) -> None:
+    """Moves the mesh so its bounding box center is at the object origin, like origin_set with center="BOUNDS"."""
+    mesh = obj.data
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coordinates)
+    coordinates = coordinates.reshape(-1, 3)
+    center = mathutils.Vector((coordinates.min(axis=0) + coordinates.max(axis=0)) / 2)
+    mesh.transform(mathutils.Matrix.Translation(-center))
+    mesh.update()
+    obj.location += obj.matrix_basis.to_3x3() @ center
+    obj["origin_centered"] = True
 
 
 def getRandomCoordinates(x_range, y_range, z_range):
@@ -28,6 +64,60 @@ def getRandomCoordinates(x_range, y_range, z_range):
     return (x, y, z)
 
 
+def joinMeshes(objects: list) -> bpy.types.Object:
+    """
+    Joins mesh objects into the first one like bpy.ops.object.join, but without operators or a context. The meshes are
+    merged with bmesh in the local space of the first object, material slots are concatenated and the face material
+    indices remapped in bulk. The other objects are removed.
+    """
+    target = objects[0]
+    if len(objects) == 1:
+        return target
+
+    to_local = target.matrix_world.inverted()
+    merged = bmesh.new()
+    materials = list(target.data.materials)
+    remaps = []  # (first face, material index of the joined mesh per slot) of every joined object
+    for obj in objects:
+        n_verts, n_faces = len(merged.verts), len(merged.faces)
+        merged.from_mesh(obj.data)
+        if obj is target:
+            continue
+        merged.verts.ensure_lookup_table()
+        bmesh.ops.transform(merged, matrix=to_local @ obj.matrix_world, verts=merged.verts[n_verts:])
+        remap = []
+        for material in obj.data.materials:
+            if material not in materials:
+                materials.append(material)
+            remap.append(materials.index(material))
+        remaps.append((n_faces, remap))
+
+    mesh = target.data
+    merged.to_mesh(mesh)
+    merged.free()
+
+    # Slots of the first object keep their indices, the others are shifted to their joined slot
+    material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", material_indices)
+    bounds = [first for first, _ in remaps[1:]] + [len(material_indices)]
+    for (first, remap), end in zip(remaps, bounds):
+        if remap:
+            indices = material_indices[first:end]
+            material_indices[first:end] = np.asarray(remap)[np.minimum(indices, len(remap) - 1)]
+    mesh.polygons.foreach_set("material_index", material_indices)
+    mesh.materials.clear()
+    for material in materials:
+        mesh.materials.append(material)
+    mesh.update()
+
+    for obj in objects[1:]:
+        data = obj.data
+        bpy.data.objects.remove(obj)
+        if data.users == 0:
+            bpy.data.meshes.remove(data)
+    return target
+
+
 def importProp(prop_path: str) -> str:
     old = redirectOutputStart()
     # Append objects to blend file's data (not linked to scene)
@@ -35,40 +125,26 @@ def importProp(prop_path: str) -> str:
         data_to.objects = [name for name in data_from.objects]
         print("Appended objects: ", data_to.objects)
 
-    # Link objects (objects have to be linked to show up in the scene)
-    # for obj in data_to.objects:
-    #    bpy.context.collection.objects.link(obj)
-
     # Delete non-meshes (Cameras, light sources etc)
-    bpy.ops.object.select_all(action="DESELECT")
     objs_to_join = []
     for obj in data_to.objects:
+        if obj is None:
+            continue
         if obj.type == "MESH":
             objs_to_join.append(obj)
         else:
-            bpy.context.collection.objects.link(obj)  # Link object to select and delete
-            obj.select_set(True)
-    bpy.ops.object.delete()
-    bpy.ops.object.select_all(action="DESELECT")
-
-    # JOIN OBJECTS
-    ## Get a context
-    ctx = bpy.context.copy()
-    ## One of the objects to join (have to have a active selection)
-    ctx["active_object"] = objs_to_join[0]
-    ## Select all objects to join
-    ctx["selected_editable_objects"] = objs_to_join
-
-    # Join
-    bpy.ops.object.join(ctx)
+            bpy.data.objects.remove(obj)
+
+    # Join, the joined object has the first object's name
+    imported_obj = joinMeshes(objs_to_join)
 
     # Rename and get reference to joined object
     file_name = os.path.basename(prop_path)
     prop_name = file_name[:-6]
-    imported_obj = bpy.data.objects[objs_to_join[0].name]  # Has inherited active obj's name
     imported_obj.name = prop_name
 
     # Resize prop
+    imported_obj["original_dimensions"] = list(imported_obj.dimensions)
     imported_obj.dimensions = imported_obj.dimensions / max(imported_obj.dimensions)
 
     redirectOutputEnd(old)
@@ -76,7 +152,7 @@ def importProp(prop_path: str) -> str:
     return prop_name
 
 
-def importDirectory(dir_path: str) -> list[str]:
+def importDirectory(dir_path: str, cache_dir: str = None) -> list[str]:
     blender_files = [os.path.join(dir_path, f) for f in os.listdir(dir_path) if f.endswith(".blend")]
     prop_name_list = [os.path.basename(path)[:-6] for path in blender_files]
 
@@ -87,18 +163,24 @@ def importDirectory(dir_path: str) -> list[str]:
         quit()
 
     # Import props
+    if cache_dir is not None:
+        from .prop_cache import importPropsCached  # prop_cache depends on this module
+
+        return importPropsCached(blender_files, cache_dir)
+
     for prop_path in blender_files:
         importProp(prop_path)
 
     return prop_name_list
 
 
-def importProps(prop_path: str) -> list[str]:
+def importProps(prop_path: str, cache: bool = False) -> list[str]:
     """
     Wrapper import function. Will either import whole directory or single file depending on prop_path.
 
         Parameters:
             prop_path (str): Full path to prop directory or single .blend file.
+            cache (bool): Import through the prop cache in .blendgen_cache/ next to the props.
 
         Returns:
             prop_name_list (list(str)): List of imported props' names.
@@ -106,7 +188,13 @@ def importProps(prop_path: str) -> list[str]:
 
     prop_name_list = []
     if prop_path[-6:] == ".blend":
-        if os.path.isfile(prop_path):
+        if os.path.isfile(prop_path) and cache:
+            from .prop_cache import importPropsCached  # prop_cache depends on this module
+
+            prop_name = os.path.basename(prop_path)[:-6]
+            cache_dir = os.path.join(os.path.dirname(prop_path), ".blendgen_cache", prop_name)
+            prop_name_list = importPropsCached([prop_path], cache_dir)
+        elif os.path.isfile(prop_path):
             prop_name = importProp(prop_path)
             prop_name_list.append(prop_name)
         else:
@@ -115,7 +203,8 @@ def importProps(prop_path: str) -> list[str]:
             quit()
     else:
         if os.path.exists(prop_path):
-            prop_name_list = importDirectory(prop_path)
+            cache_dir = os.path.join(prop_path, ".blendgen_cache") if cache else None
+            prop_name_list = importDirectory(prop_path, cache_dir)
         else:
             print(f"ERROR: Prop directory {prop_path} does not exist.")
             print("Quitting BlendGen.")
@@ -124,65 +213,61 @@ def importProps(prop_path: str) -> list[str]:
     return prop_name_list
 
 
-def createSegmentationMaterial(n_instances: int) -> bpy.types.Material:
-
-    if n_instances >= 32:
-        print("ERROR: Colorband cannot have 32 or more classes, setting to 31")
-        n_instances = 31
+def createVariantMaterial(
+    name: str, color_a: tuple, color_b: tuple, noise_scale: float, mix: float, roughness: float
+) -> bpy.types.Material:
+    """
+    Material of a randomization pool (see appearance.sample_material_variants): color_a mixed with color_b by a noise
+    texture. Every variant has the same nodes and links and only differs in unlinked input values, which Eevee passes
+    as uniforms, so all variants share one compiled shader.
+    """
 
     # Create material
-    material = bpy.data.materials.new("segmentation_material")
+    material = bpy.data.materials.new(name)
     material["is_auto"] = True
     material.use_nodes = True
 
     # Nodes
     nodes = material.node_tree.nodes
     nodes.clear()
-    step_size = 1 / n_instances
     sep = 3  # Visual separation
 
-    # Object Info node
-    node_info = material.node_tree.nodes.new("ShaderNodeObjectInfo")
-    node_info.location = (-300 * sep, 100)
+    # Texture Coordinate node
+    node_coordinates = nodes.new("ShaderNodeTexCoord")
+    node_coordinates.location = (-400 * sep, 0)
 
-    # Value node
-    node_value = material.node_tree.nodes.new("ShaderNodeValue")
-    node_value.location = (-300 * sep, -100)
-    node_value.outputs[0].default_value = step_size
+    # Noise Texture node
+    node_noise = nodes.new("ShaderNodeTexNoise")
+    node_noise.location = (-300 * sep, 0)
+    node_noise.inputs["Scale"].default_value = noise_scale
 
     # Math node
-    node_math = material.node_tree.nodes.new("ShaderNodeMath")
+    node_math = nodes.new("ShaderNodeMath")
     node_math.location = (-200 * sep, 0)
-    node_math.operation = "MULTIPLY_ADD"
-    node_math.inputs[2].default_value = step_size / 2
-
-    # ColorRamp node
-    node_ramp = material.node_tree.nodes.new("ShaderNodeValToRGB")
-    node_ramp.location = (-100 * sep, 0)
-    node_ramp.color_ramp.color_mode = "RGB"
-    node_ramp.color_ramp.interpolation = "CONSTANT"
-    # Split ColorRamp
-    step_size = 1 / n_instances
-    for i in range(1, n_instances):  # For three objects **two** splits are needed
-        node_ramp.color_ramp.elements.new(step_size * i)
+    node_math.operation = "MULTIPLY"
+    node_math.inputs[1].default_value = mix
 
-    for i in range(0, n_instances):
-        node_ramp.color_ramp.elements[i].color = (random.random(), random.random(), random.random(), 1)
+    # MixRGB node
+    node_mix = nodes.new("ShaderNodeMixRGB")
+    node_mix.location = (-100 * sep, 0)
+    node_mix.inputs["Color1"].default_value = (*color_a, 1)
+    node_mix.inputs["Color2"].default_value = (*color_b, 1)
 
     # Shader node
-    node_shader = nodes.new("ShaderNodeEmission")
+    node_shader = nodes.new("ShaderNodeBsdfPrincipled")
     node_shader.location = (0, 0)
+    node_shader.inputs["Roughness"].default_value = roughness
 
     # Material Output node
     node_output = nodes.new("ShaderNodeOutputMaterial")
     node_output.location = (100 * sep, 0)
 
     # Create connections between nodes
-    material.node_tree.links.new(node_info.outputs["Object Index"], node_math.inputs[0])
-    material.node_tree.links.new(node_value.outputs["Value"], node_math.inputs[1])
-    material.node_tree.links.new(node_math.outputs["Value"], node_ramp.inputs["Fac"])
-    material.node_tree.links.new(node_ramp.outputs["Color"], node_shader.inputs["Color"])
-    material.node_tree.links.new(node_shader.outputs["Emission"], node_output.inputs["Surface"])
+    material.node_tree.links.new(node_coordinates.outputs["Object"], node_noise.inputs["Vector"])
+    material.node_tree.links.new(node_noise.outputs["Fac"], node_math.inputs[0])
+    material.node_tree.links.new(node_math.outputs["Value"], node_mix.inputs["Fac"])
+    material.node_tree.links.new(node_mix.outputs["Color"], node_shader.inputs["Base Color"])
+    material.node_tree.links.new(node_shader.outputs["BSDF"], node_output.inputs["Surface"])
 
     return material
 
@@ -227,40 +312,345 @@ def createRenderDirectory(prop_name="", folder_name=None):
 
 
 # Redirect output (https://blender.stackexchange.com/a/44563/69661)
+# The log file is opened once and swapped in with dup2, so redirecting every frame costs no open/close
+_logfile_fd = None
+
+
 def redirectOutputStart():
-    logfile = ".blenderlog"
-    open(logfile, "a").close()
-    old = os.dup(1)
+    global _logfile_fd
+    if _logfile_fd is None:
+        _logfile_fd = os.open(".blenderlog", os.O_WRONLY | os.O_CREAT | os.O_APPEND)
     sys.stdout.flush()
-    os.close(1)
-    os.open(logfile, os.O_WRONLY)
+    old = os.dup(1)
+    os.dup2(_logfile_fd, 1)
     return old
 
 
 def redirectOutputEnd(old) -> None:
-    os.close(1)
-    os.dup(old)
+    sys.stdout.flush()
+    os.dup2(old, 1)
     os.close(old)
 
 
-# Print iterations progress (https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console)
-def printProgressBar(iteration, total, prefix="", suffix="", decimals=1, length=100, fill="█", printEnd="\r"):
+def createSegmentationCompositor(n_instances: int, depth: bool = False, normal: bool = False, encoding: str = "ramp"):
+    """
+    Writes the segmentation mask (and optionally depth and normals) from render passes through the compositor, so a
+    single render gives both the image and the mask. Requires Cycles since Eevee has no object index pass.
+
+        Parameters:
+            n_instances (int): Number of prop instances, with pass_index 1 to n_instances.
+            depth (bool): Also write the Z pass as render###_depth.exr.
+            normal (bool): Also write the normal pass as render###_normal.exr.
+            encoding (str): "ramp" for random colours (at most 31 instances) or "id" for the exact 24 bit encoding of
+                instanceIdColor.
+
+        Returns:
+            node_file_output (bpy.types.CompositorNodeOutputFile): Node writing the passes, its base_path has to be set
+            to the render directory and scene.frame_current to the image number before rendering.
+    """
+
+    if encoding == "ramp" and n_instances >= 32:
+        print("ERROR: Colorband cannot have 32 or more classes, setting to 31")
+        n_instances = 31
+
+    scene = bpy.context.scene
+    scene.render.engine = "CYCLES"
+    view_layer = scene.view_layers[0]
+    view_layer.use_pass_object_index = True
+    view_layer.use_pass_z = depth
+    view_layer.use_pass_normal = normal
+
+    # Nodes
+    scene.use_nodes = True
+    tree = scene.node_tree
+    nodes = tree.nodes
+    nodes.clear()
+    step_size = 1 / n_instances
+    sep = 3  # Visual separation
+
+    def new_math(operation, value, location):
+        node = nodes.new("CompositorNodeMath")
+        node.location = location
+        node.operation = operation
+        node.inputs[1].default_value = value
+        return node
+
+    # Render Layers node
+    node_layers = nodes.new("CompositorNodeRLayers")
+    node_layers.location = (-400 * sep, 0)
+
+    # Composite node, the colour image is written by render(write_still=True) as before
+    node_composite = nodes.new("CompositorNodeComposite")
+    node_composite.location = (100 * sep, 200)
+
+    # File Output node, "###" is replaced by scene.frame_current
+    node_file_output = nodes.new("CompositorNodeOutputFile")
+    node_file_output.location = (100 * sep, 0)
+    node_file_output.format.file_format = "PNG"
+    node_file_output.file_slots[0].path = "render###_segmentation"
+
+    tree.links.new(node_layers.outputs["Image"], node_composite.inputs["Image"])
+
+    if encoding == "id":
+        # Split pass_index into bytes, written without view transform so the values are exact
+        node_r = new_math("MODULO", 256, (-300 * sep, 200))
+        node_g_shift = new_math("DIVIDE", 256, (-300 * sep, 0))
+        node_g_floor = new_math("FLOOR", 0, (-250 * sep, 0))
+        node_g = new_math("MODULO", 256, (-200 * sep, 0))
+        node_b_shift = new_math("DIVIDE", 65536, (-300 * sep, -200))
+        node_b = new_math("FLOOR", 0, (-250 * sep, -200))
+
+        node_combine = nodes.new("CompositorNodeCombineColor")
+        node_combine.location = (-50 * sep, 0)
+        node_combine.mode = "RGB"
+
+        tree.links.new(node_layers.outputs["IndexOB"], node_r.inputs[0])
+        tree.links.new(node_layers.outputs["IndexOB"], node_g_shift.inputs[0])
+        tree.links.new(node_g_shift.outputs["Value"], node_g_floor.inputs[0])
+        tree.links.new(node_g_floor.outputs["Value"], node_g.inputs[0])
+        tree.links.new(node_layers.outputs["IndexOB"], node_b_shift.inputs[0])
+        tree.links.new(node_b_shift.outputs["Value"], node_b.inputs[0])
+        for channel, node in enumerate((node_r, node_g, node_b)):
+            node_byte = new_math("DIVIDE", 255, (-150 * sep, 200 - 200 * channel))
+            tree.links.new(node.outputs["Value"], node_byte.inputs[0])
+            tree.links.new(node_byte.outputs["Value"], node_combine.inputs[channel])
+        tree.links.new(node_combine.outputs["Image"], node_file_output.inputs[0])
+
+        node_file_output.format.color_mode = "RGB"
+        node_file_output.format.color_depth = "8"
+        node_file_output.format.color_management = "OVERRIDE"
+        node_file_output.format.view_settings.view_transform = "Raw"
+    else:
+        # Math node, maps pass_index to the same ColorRamp position as the segmentation material
+        node_math = new_math("MULTIPLY_ADD", step_size, (-200 * sep, 0))
+        node_math.inputs[2].default_value = -step_size / 2
+
+        # ColorRamp node
+        node_ramp = nodes.new("CompositorNodeValToRGB")
+        node_ramp.location = (-100 * sep, 0)
+        node_ramp.color_ramp.color_mode = "RGB"
+        node_ramp.color_ramp.interpolation = "CONSTANT"
+        for i in range(1, n_instances):
+            node_ramp.color_ramp.elements.new(step_size * i)
+
+        for i in range(0, n_instances):
+            node_ramp.color_ramp.elements[i].color = (random.random(), random.random(), random.random(), 1)
+
+        # Background mask, index 0 is black
+        node_background = new_math("GREATER_THAN", 0.5, (-100 * sep, -200))
+
+        node_mix = nodes.new("CompositorNodeMixRGB")
+        node_mix.location = (0, 0)
+        node_mix.blend_type = "MULTIPLY"
+        node_mix.inputs[0].default_value = 1
+
+        tree.links.new(node_layers.outputs["IndexOB"], node_math.inputs[0])
+        tree.links.new(node_math.outputs["Value"], node_ramp.inputs["Fac"])
+        tree.links.new(node_layers.outputs["IndexOB"], node_background.inputs[0])
+        tree.links.new(node_ramp.outputs["Image"], node_mix.inputs[1])
+        tree.links.new(node_background.outputs["Value"], node_mix.inputs[2])
+        tree.links.new(node_mix.outputs["Image"], node_file_output.inputs[0])
+
+    # Optional passes as 32 bit EXR
+    for enabled, output_name, slot_name in ((depth, "Depth", "depth"), (normal, "Normal", "normal")):
+        if not enabled:
+            continue
+        node_file_output.file_slots.new(f"render###_{slot_name}")
+        slot = node_file_output.file_slots[-1]
+        slot.use_node_format = False
+        slot.format.file_format = "OPEN_EXR"
+        slot.format.color_depth = "32"
+        tree.links.new(node_layers.outputs[output_name], node_file_output.inputs[-1])
+
+    return node_file_output
+
+
+def instanceIdColor(instance_id: int) -> tuple[float]:
+    """
+    Colour encoding instance_id as id = R + 256 * G + 65536 * B with 8 bit channels. Background is 0. The encoding
+    has room for 24 bits, but ids are also the pass_index of the instance and end at MAX_INSTANCE_ID.
+
+        Parameters:
+            instance_id (int): pass_index of the instance, 1 to MAX_INSTANCE_ID.
+
+        Returns:
+            color (tuple(float)): RGBA colour, exact when written to an 8 bit image without view transform.
+    """
+    assert 0 <= instance_id <= MAX_INSTANCE_ID, f"at most {MAX_INSTANCE_ID} instances, including pool members"
+    return (instance_id % 256 / 255, instance_id // 256 % 256 / 255, instance_id // 65536 / 255, 1.0)
+
+
+def decodeInstanceIds(mask: np.ndarray) -> np.ndarray:
+    """Instance ids (0 is background) from an (height, width, 3 or 4) uint8 mask written with the "id" encoding."""
+    mask = mask.astype(np.int32)
+    return mask[..., 0] + (mask[..., 1] << 8) + (mask[..., 2] << 16)
+
+
+def meshVertices(mesh: bpy.types.Mesh) -> np.ndarray:
+    """(n_vertices, 3) local vertex coordinates, read in bulk."""
+    coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coordinates)
+    return coordinates.reshape(-1, 3).astype(np.float64)
+
+
+def templateVertices(prop_list: list) -> tuple:
+    """
+    Vertices of every distinct full detail mesh used by the props, read once per mesh since instances share their
+    template's mesh.
+
+        Returns:
+            template_vertices (list(np.ndarray)): (n_vertices, 3) local coordinates per mesh.
+            instance_template (np.ndarray): Index into template_vertices of every prop.
+    """
+    mesh_index = {}
+    template_vertices = []
+    instance_template = np.empty(len(prop_list), dtype=np.int64)
+    for idx, prop in enumerate(prop_list):
+        mesh = prop.mesh
+        if mesh.name_full not in mesh_index:
+            mesh_index[mesh.name_full] = len(template_vertices)
+            template_vertices.append(meshVertices(mesh))
+        instance_template[idx] = mesh_index[mesh.name_full]
+    return template_vertices, instance_template
+
+
+def cameraIntrinsics(camera_data: bpy.types.Camera, resolution: tuple) -> np.ndarray:
+    return camera_intrinsics(
+        camera_data.lens, camera_data.sensor_width, camera_data.sensor_height, camera_data.sensor_fit, resolution
+    )
+
+
+def addViewerNode() -> None:
+    """
+    Routes the render result to the Viewer Node image, whose pixels (unlike the Render Result's) can be read from
+    Python. Keeps an existing compositor setup.
+    """
+    scene = bpy.context.scene
+    scene.use_nodes = True
+    tree = scene.node_tree
+    nodes = tree.nodes
+
+    node_layers = next((node for node in nodes if node.bl_idname == "CompositorNodeRLayers"), None)
+    if node_layers is None:
+        node_layers = nodes.new("CompositorNodeRLayers")
+    if not any(node.bl_idname == "CompositorNodeComposite" for node in nodes):
+        node_composite = nodes.new("CompositorNodeComposite")
+        tree.links.new(node_layers.outputs["Image"], node_composite.inputs["Image"])
+
+    node_viewer = nodes.new("CompositorNodeViewer")
+    node_viewer.location = (node_layers.location.x + 600, node_layers.location.y + 400)
+    tree.links.new(node_layers.outputs["Image"], node_viewer.inputs["Image"])
+    nodes.active = node_viewer
+
+
+def viewerPixels() -> np.ndarray:
+    """Copy of the last render as a (height, width, 4) float32 array in scene linear colours, row 0 at the bottom."""
+    image = bpy.data.images["Viewer Node"]
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+
+def readMask(path: str) -> np.ndarray:
+    """Loads an 8 bit mask as a (height, width, 4) uint8 array with row 0 at the top of the image."""
+    image = bpy.data.images.load(path)
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    return np.round(pixels * 255).astype(np.uint8).reshape(height, width, 4)[::-1]
+
+
+def exactColorSettings(scene: bpy.types.Scene) -> tuple:
+    """
+    Render settings writing emission colours unchanged to 8 bit images: no view transform, dither or pixel filter.
+
+        Returns:
+            old (tuple): Previous settings, to be given to restoreColorSettings.
+    """
+    old = (
+        scene.view_settings.view_transform,
+        scene.view_settings.look,
+        scene.render.dither_intensity,
+        scene.render.filter_size,
+    )
+    scene.view_settings.view_transform = "Raw"
+    scene.view_settings.look = "None"
+    scene.render.dither_intensity = 0
+    scene.render.filter_size = 0
+    return old
+
+
+def restoreColorSettings(scene: bpy.types.Scene, old: tuple) -> None:
+    view_transform, look, dither_intensity, filter_size = old
+    scene.view_settings.view_transform = view_transform
+    scene.view_settings.look = look
+    scene.render.dither_intensity = dither_intensity
+    scene.render.filter_size = filter_size
+
+
+def dataBlockCounts() -> dict:
+    """Number of blocks in bpy.data of the types a run creates, growing counts point to leaked data."""
+    return {
+        name: len(getattr(bpy.data, name))
+        for name in ("objects", "meshes", "materials", "images", "node_groups", "collections", "libraries")
+    }
+
+
+def setKeyframes(id_data: bpy.types.ID, data_path: str, frames: np.ndarray, values: np.ndarray) -> None:
+    """
+    Replaces the animation of data_path with constant keyframes, written with foreach_set instead of one
+    keyframe_insert per frame and channel.
+
+        Parameters:
+            id_data (bpy.types.ID): Object or data block owning data_path, e.g. a camera's data for "lens".
+            frames (np.ndarray): (n,) scene frames.
+            values (np.ndarray): (n,) or (n, channels) values, e.g. (n, 4) for "rotation_quaternion".
+    """
+    if id_data.animation_data is None:
+        id_data.animation_data_create()
+    if id_data.animation_data.action is None:
+        id_data.animation_data.action = bpy.data.actions.new(f"{id_data.name}_action")
+    fcurves = id_data.animation_data.action.fcurves
+
+    values = np.asarray(values, dtype=np.float32).reshape(len(frames), -1)
+    keyframes = np.empty((len(frames), 2), dtype=np.float32)
+    keyframes[:, 0] = frames
+    for channel in range(values.shape[1]):
+        fcurve = fcurves.find(data_path, index=channel)
+        if fcurve is not None:
+            fcurves.remove(fcurve)
+        fcurve = fcurves.new(data_path, index=channel)
+        keyframes[:, 1] = values[:, channel]
+        fcurve.keyframe_points.add(len(frames))
+        fcurve.keyframe_points.foreach_set("co", keyframes.ravel())
+        fcurve.keyframe_points.foreach_set("interpolation", np.zeros(len(frames), dtype=np.int32))  # CONSTANT
+        fcurve.update()
+
+
+def setSegmentationColors(prop_list: list, encoding: str) -> None:
     """
-    Call in a loop to create terminal progress bar
-    @params:
-        iteration   - Required  : current iteration (Int)
-        total       - Required  : total iterations (Int)
-        prefix      - Optional  : prefix string (Str)
-        suffix      - Optional  : suffix string (Str)
-        decimals    - Optional  : positive number of decimals in percent complete (Int)
-        length      - Optional  : character length of bar (Int)
-        fill        - Optional  : bar fill character (Str)
-        printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
+    Sets the object colour of every prop to a random colour of the "ramp" encoding, the masks are rendered unlit with
+    Workbench (see profiles.FLAT_SEGMENTATION). With "id" encoding Prop already sets instanceIdColor.
     """
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filledLength = int(length * iteration // total)
-    bar = fill * filledLength + "-" * (length - filledLength)
-    print(f"\r{prefix} |{bar}| {percent}% {suffix}", end=printEnd)
-    # Print New Line on Complete
-    if iteration == total:
-        print()
+    if encoding == "id":
+        return
+    colors = [(random.random(), random.random(), random.random(), 1) for _ in range(len(prop_list))]
+    for prop in prop_list:
+        prop.object.color = colors[prop.object.pass_index - 1]
+
+
+def writeInstanceTable(labels_path: str, prop_list: list, encoding: str) -> None:
+    """Writes instance_ids.json mapping every instance id in the masks to its prop."""
+    instances = {}
+    for prop in prop_list:
+        instance_id = prop.object.pass_index
+        instances[instance_id] = {"prop": prop.name, "object": prop.object.name}
+        if encoding == "id":
+            instances[instance_id]["color"] = [round(c * 255) for c in instanceIdColor(instance_id)[:3]]
+
+    table_path = os.path.join(labels_path, "instance_ids.json")
+    with open(f"{table_path}.{os.getpid()}.tmp", "w") as f:
+        json.dump({"encoding": encoding, "background": 0, "instances": instances}, f, indent=1)
+    os.replace(f"{table_path}.{os.getpid()}.tmp", table_path)
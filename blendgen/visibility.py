@@ -0,0 +1,223 @@
+"""
+Visibility pre-pass. Before anything is rendered, the sampled poses of a run are scored from the scene geometry: the
+vertices of every shown prop are projected with NumPy and splatted into a small depth buffer, which tells how much of
+each prop is in the frame, how much of it is not hidden behind other props and how many pixels it covers. Frames with
+too few useful props get new poses (sampling.sample_poses with attempt > 0) until one is accepted or max_attempts poses
+were tried, then the best one is kept. Like render profiles, a policy is given by name or as a JSON file. Does not
+depend on bpy.
+"""
+import json
+import os
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .geometry import NEAR, project, transform
+
+VISIBILITY_POLICIES = {
+    # Half of the props in the frame and not mostly hidden
+    "default": {
+        "min_in_frame": 0.5,
+        "min_visible": 0.3,
+        "min_pixels": 100,
+        "min_useful": 0.5,
+        "max_attempts": 8,
+        "buffer_size": 64,
+    },
+    # Nearly every prop fully in the frame and clearly visible
+    "strict": {
+        "min_in_frame": 0.9,
+        "min_visible": 0.6,
+        "min_pixels": 400,
+        "min_useful": 0.8,
+        "max_attempts": 16,
+        "buffer_size": 96,
+    },
+}
+MAX_POINTS = 512  # Vertices per template splatted into the depth buffer, several per cell of a prop
+
+
+def load_visibility_policy(policy: str) -> Dict:
+    """
+    Policy by name, or from a JSON file with the keys of VISIBILITY_POLICIES["default"], missing keys are taken from it.
+    A prop is useful if at least min_in_frame of it is in the frame, at least min_visible of the cells it covers show
+    it in front and it shows in front on min_pixels pixels. A frame is accepted if min_useful of its props are useful.
+    """
+    if policy in VISIBILITY_POLICIES:
+        return dict(VISIBILITY_POLICIES[policy])
+    if os.path.isfile(policy):
+        with open(policy) as f:
+            return {**VISIBILITY_POLICIES["default"], **json.load(f)}
+    print(f"ERROR: visibility policy has to be one of {list(VISIBILITY_POLICIES)} or a policy file: {policy}")
+    quit()
+
+
+def look_at_matrices(locations: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    (n, 4, 4) world matrices of cameras at locations looking at targets with +Y as close to world +Z as possible, like
+    BlenderObject.look_at.
+    """
+    z_axis = np.asarray(locations, dtype=np.float64) - targets
+    z_axis /= np.linalg.norm(z_axis, axis=-1, keepdims=True)
+    up = np.where(np.abs(z_axis[:, 2:]) > 1 - 1e-9, [0.0, 1.0, 0.0], [0.0, 0.0, 1.0])  # Looking straight up or down
+    y_axis = up - np.sum(up * z_axis, axis=-1, keepdims=True) * z_axis
+    y_axis /= np.linalg.norm(y_axis, axis=-1, keepdims=True)
+    x_axis = np.cross(y_axis, z_axis)
+    matrices = np.tile(np.eye(4), (len(z_axis), 1, 1))
+    matrices[:, :3, :3] = np.stack((x_axis, y_axis, z_axis), axis=-1)
+    matrices[:, :3, 3] = locations
+    return matrices
+
+
+def instance_matrices(locations: np.ndarray, quaternions: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """(k, 4, 4) world matrices of props at locations with (w, x, y, z) rotations and (k, 3) scales."""
+    w, x, y, z = np.moveaxis(np.asarray(quaternions, dtype=np.float64), -1, 0)
+    rotations = np.stack(
+        (
+            np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=-1),
+            np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=-1),
+            np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=-1),
+        ),
+        axis=-2,
+    )
+    matrices = np.tile(np.eye(4), (len(rotations), 1, 1))
+    matrices[:, :3, :3] = rotations * np.asarray(scales)[:, None, :]
+    matrices[:, :3, 3] = locations
+    return matrices
+
+
+def subsample_points(template_vertices: List[np.ndarray], max_points: int = MAX_POINTS) -> List[np.ndarray]:
+    """At most max_points evenly spaced vertices of every template."""
+    return [vertices[:: max(1, -(-len(vertices) // max_points))] for vertices in template_vertices]
+
+
+def score_visibility(
+    template_points: List[np.ndarray],
+    instance_template: np.ndarray,
+    matrices: np.ndarray,
+    camera_matrix: np.ndarray,
+    intrinsics: np.ndarray,
+    resolution: Tuple[int, int],
+    buffer_size: int = 64,
+) -> Dict[str, np.ndarray]:
+    """
+    Visibility of every instance from its points splatted into a depth buffer of buffer_size pixels along the longer
+    side of the image. Points are sparser than the surfaces they sample, so occlusion is underestimated for props
+    with few vertices.
+
+        Parameters:
+            template_points (list(np.ndarray)): (n_points, 3) local points of each template, e.g. from
+                subsample_points.
+            instance_template (np.ndarray): (k,) index into template_points of every instance.
+            matrices (np.ndarray): (k, 4, 4) world matrices of the instances.
+
+        Returns:
+            scores (dict(str, np.ndarray)): "in_frame" (k,) fraction of the points of the instance in the image,
+            "visible" (k,) fraction of the buffer cells covered by the instance where it is in front and "pixels" (k,)
+            image pixels of those cells.
+    """
+    width, height = resolution
+    scale = buffer_size / max(width, height)
+    buffer_width, buffer_height = max(1, round(width * scale)), max(1, round(height * scale))
+    n_instances = len(instance_template)
+
+    # Points of every instance in the image
+    instance_ids = []
+    pixels = []
+    depths = []
+    for template_idx, points in enumerate(template_points):
+        instances = np.flatnonzero(instance_template == template_idx)
+        if len(instances) == 0 or len(points) == 0:
+            continue
+        template_pixels, template_depth = project(transform(matrices[instances], points), camera_matrix, intrinsics)
+        instance_ids.append(np.repeat(instances, len(points)))
+        pixels.append(template_pixels.reshape(-1, 2))
+        depths.append(template_depth.ravel())
+    if not instance_ids:
+        zeros = np.zeros(n_instances)
+        return {"in_frame": zeros, "visible": zeros, "pixels": zeros}
+    instance_ids = np.concatenate(instance_ids)
+    pixels = np.concatenate(pixels)
+    depths = np.concatenate(depths)
+
+    inside = (depths > NEAR) & np.all(pixels >= 0, axis=1) & (pixels[:, 0] < width) & (pixels[:, 1] < height)
+    n_points = np.bincount(instance_ids, minlength=n_instances)
+    in_frame = np.bincount(instance_ids[inside], minlength=n_instances) / np.maximum(n_points, 1)
+
+    # Nearest point of every cell, and the cells covered by every instance
+    columns = np.minimum((pixels[inside, 0] * scale).astype(np.int64), buffer_width - 1)
+    rows = np.minimum((pixels[inside, 1] * scale).astype(np.int64), buffer_height - 1)
+    cells = rows * buffer_width + columns
+    instance_ids = instance_ids[inside]
+    order = np.argsort(depths[inside])
+    _, nearest = np.unique(cells[order], return_index=True)
+    in_front = np.bincount(instance_ids[order][nearest], minlength=n_instances)
+    n_cells = buffer_width * buffer_height
+    covered = np.bincount(np.unique(instance_ids * n_cells + cells) // n_cells, minlength=n_instances)
+    return {
+        "in_frame": in_frame,
+        "visible": in_front / np.maximum(covered, 1),
+        "pixels": in_front * (width * height) / n_cells,
+    }
+
+
+def frame_score(scores: Dict[str, np.ndarray], policy: Dict) -> float:
+    """Fraction of useful instances, see load_visibility_policy."""
+    useful = (
+        (scores["in_frame"] >= policy["min_in_frame"])
+        & (scores["visible"] >= policy["min_visible"])
+        & (scores["pixels"] >= policy["min_pixels"])
+    )
+    return float(useful.mean()) if len(useful) else 0.0
+
+
+def screen_poses(sample: Callable, score: Callable, n_frames: int, policy: Dict) -> Dict[str, np.ndarray]:
+    """
+    Poses of n_frames frames with the rejected ones drawn again.
+
+        Parameters:
+            sample (callable): sample(attempt) gives the poses of the frames drawn by attempt, see
+                sampling.sample_poses.
+            score (callable): score(poses, k) gives the frame_score of row k.
+
+        Returns:
+            poses (dict(str, np.ndarray)): Poses of sample(0) with the rows of rejected frames replaced by the best
+            attempt, and "prepass_attempt" (n,) the attempt of every row, "prepass_tried" (n,) the number of poses
+            scored for it, "prepass_score" (n,) the score of the row and "prepass_accepted" (n,) whether it reached
+            min_useful.
+    """
+    poses = sample(0)
+    scores = np.array([score(poses, k) for k in range(n_frames)], dtype=np.float64)
+    attempts = np.zeros(n_frames, dtype=np.int64)
+    tried = np.ones(n_frames, dtype=np.int64)
+    for attempt in range(1, policy["max_attempts"]):
+        rejected = np.flatnonzero(scores < policy["min_useful"])
+        if len(rejected) == 0:
+            break
+        candidates = sample(attempt)
+        tried[rejected] += 1
+        for k in rejected:
+            candidate_score = score(candidates, k)
+            if candidate_score > scores[k]:
+                for key, value in candidates.items():
+                    poses[key][k] = value[k]
+                scores[k] = candidate_score
+                attempts[k] = attempt
+    poses["prepass_attempt"] = attempts
+    poses["prepass_tried"] = tried
+    poses["prepass_score"] = scores
+    poses["prepass_accepted"] = scores >= policy["min_useful"]
+    return poses
+
+
+def prepass_stats(poses: Dict[str, np.ndarray]) -> Dict:
+    """Acceptance of the poses from screen_poses, reported by render as a "prepass" event."""
+    attempts = poses["prepass_attempt"]
+    accepted = poses["prepass_accepted"]
+    return {
+        "frames": len(accepted),
+        "accepted_first": int(np.sum(accepted & (attempts == 0))),
+        "accepted": int(np.sum(accepted)),
+        "tried": int(np.sum(poses["prepass_tried"])),
+        "mean_score": float(np.mean(poses["prepass_score"])) if len(accepted) else 0.0,
+    }
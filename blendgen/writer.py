@@ -0,0 +1,169 @@
+"""
+Asynchronous image encoding and writing. Rendered pixel buffers are handed to a bounded thread pool, so compression and
+file I/O overlap with the next render. Encoders only use NumPy and zlib (which releases the GIL) since Blender's Python
+has no imaging library. Does not depend on bpy.
+"""
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+IMAGE_FORMATS = ("png", "npy", "exr")
+
+
+def linear_to_srgb(linear: np.ndarray) -> np.ndarray:
+    """sRGB transfer function, the "Standard" view transform of Blender."""
+    linear = np.clip(linear, 0, 1)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * np.power(linear, 1 / 2.4) - 0.055)
+
+
+def to_uint8(pixels: np.ndarray, linear: bool) -> np.ndarray:
+    """Float RGBA to 8 bit, with the sRGB transfer function applied to RGB unless linear."""
+    pixels = pixels.copy()
+    if not linear:
+        pixels[..., :3] = linear_to_srgb(pixels[..., :3])
+    return np.round(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+
+
+def encode_png(pixels: np.ndarray, compress_level: int = 1) -> bytes:
+    """(height, width, channels) uint8 array to PNG bytes, channels is 1, 3 or 4."""
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    # Filter type 0 (None) in front of every scanline
+    raw = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, width * channels)
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw.tobytes(), compress_level))
+        + chunk(b"IEND", b"")
+    )
+
+
+def encode_exr(pixels: np.ndarray) -> bytes:
+    """(height, width, 4) float RGBA array to an uncompressed 32 bit float scanline OpenEXR."""
+    height, width, channels = pixels.shape
+    names = "RGBA"[:channels]
+
+    def attribute(name, attribute_type, data):
+        return name.encode() + b"\0" + attribute_type.encode() + b"\0" + struct.pack("<i", len(data)) + data
+
+    # Channels are stored in alphabetical order, pixel type 2 is FLOAT
+    sorted_names = sorted(names)
+    channel_list = b"".join(name.encode() + b"\0" + struct.pack("<iB3xii", 2, 0, 1, 1) for name in sorted_names)
+    box = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = (
+        struct.pack("<ii", 20000630, 2)
+        + attribute("channels", "chlist", channel_list + b"\0")
+        + attribute("compression", "compression", b"\0")
+        + attribute("dataWindow", "box2i", box)
+        + attribute("displayWindow", "box2i", box)
+        + attribute("lineOrder", "lineOrder", b"\0")
+        + attribute("pixelAspectRatio", "float", struct.pack("<f", 1))
+        + attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0, 0))
+        + attribute("screenWindowWidth", "float", struct.pack("<f", 1))
+        + b"\0"
+    )
+
+    # One scanline per block: y, data size, then every channel of the line
+    order = [names.index(name) for name in sorted_names]
+    lines = np.ascontiguousarray(pixels[..., order].astype("<f4").transpose(0, 2, 1)).reshape(height, -1)
+    line_size = lines.shape[1] * 4
+    block_size = 8 + line_size
+    table_start = len(header)
+    first_block = table_start + 8 * height
+    offsets = np.arange(height, dtype="<u8") * block_size + first_block
+
+    blocks = np.empty((height, block_size), dtype=np.uint8)
+    blocks[:, :4] = np.arange(height, dtype="<i4").view(np.uint8).reshape(height, 4)
+    blocks[:, 4:8] = np.frombuffer(struct.pack("<i", line_size), dtype=np.uint8)
+    blocks[:, 8:] = lines.view(np.uint8)
+    return header + offsets.tobytes() + blocks.tobytes()
+
+
+class AsyncImageWriter:
+    """
+    Encodes and writes images on a thread pool. At most max_pending images are queued, submit blocks when the writer
+    falls behind (backpressure) and the time spent waiting is kept in blocked_seconds. The (crc32, size) of every
+    written file is kept in checksums until taken, e.g. by manifest.Manifest.
+    """
+
+    def __init__(self, image_format: str = "png", compress_level: int = 1, n_threads: int = 4, max_pending: int = 8):
+        assert image_format in IMAGE_FORMATS, f"image_format has to be one of {IMAGE_FORMATS}"
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="blendgen_writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.blocked_seconds = 0.0
+        self.checksums = {}
+
+    def submit(
+        self, frame: int, kind: str, path_without_extension: str, pixels: np.ndarray, linear: bool = False
+    ) -> str:
+        """
+        Queues a (height, width, 4) float RGBA buffer with row 0 at the bottom, as returned by Blender.
+
+            Parameters:
+                frame (int): Frame index, unused here (see dataset.ShardWriter).
+                kind (str): "image" or "mask", unused here.
+                linear (bool): Write 8 bit values without the sRGB transfer function, e.g. for exact id masks.
+
+            Returns:
+                path (str): Path the image will be written to.
+        """
+        self.raise_errors()
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.blocked_seconds += time.perf_counter() - start
+
+        path = f"{path_without_extension}.{self.image_format}"
+        future = self.executor.submit(self.write, path, pixels, linear)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return path
+
+    def write(self, path: str, pixels: np.ndarray, linear: bool) -> None:
+        pixels = pixels[::-1]
+        if self.image_format == "png":
+            data = encode_png(to_uint8(pixels, linear), self.compress_level)
+        elif self.image_format == "exr":
+            data = encode_exr(pixels)
+        else:
+            buffer = io.BytesIO()
+            if linear:
+                np.save(buffer, to_uint8(pixels, linear))  # Exact 8 bit values
+            else:
+                np.save(buffer, pixels.astype(np.float16))  # Linear HDR values
+            data = buffer.getvalue()
+
+        # Write to a temporary file first so readers never see partial images
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.checksums[path] = (zlib.crc32(data), len(data))
+
+    def raise_errors(self) -> None:
+        """Re-raises the first error of a finished write and forgets finished writes."""
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.futures = pending
+
+    def close(self) -> None:
+        """Waits until every queued image is written."""
+        self.executor.shutdown(wait=True)
+        self.raise_errors()
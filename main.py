@@ -1,13 +1,30 @@
 import argparse
 import os
+import random
 import subprocess
+import sys
 from datetime import datetime
 
+from blendgen.daemon import DEFAULT_PORT, daemon_running
+from blendgen.labels import MAX_INSTANCE_ID
+from blendgen.launch import (
+    blender_command,
+    build_template,
+    run_in_daemon,
+    run_workers,
+    scene_settings,
+    template_key,
+    template_path,
+)
+from blendgen.lod import LOD_POLICIES
+from blendgen.manifest import RUN_NAME, load_run, save_run
+from blendgen.profiles import RENDER_PROFILES
+from blendgen.visibility import VISIBILITY_POLICIES
+
 THIS_PATH = os.path.dirname(os.path.abspath(__file__))
 PACKAGE_PATH = os.path.join(THIS_PATH, "blendgen")
 SAVED_PROP_PATH = os.path.join(THIS_PATH, "props")
 EXECUTE_PATH = os.path.realpath(".")
-MAIN_BLENDER_PATH = os.path.join(THIS_PATH, "main_blender.py")
 SAVE_DIR_NAME = datetime.now().strftime("blendgen_%y%m%d%H%M%S")
 
 
@@ -45,9 +62,298 @@ def main():
     parser.add_argument(
         "--n-instances",
         "-i",
-        help="Number of instances of the model in each render.                         Maximum is 31. Default is 1.",
+        help=(
+            "Number of instances of the model in each render.                         Maximum is 31 with"
+            " --mask-encoding=ramp. Default is 1."
+        ),
         default=1,
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        help=(
+            "(Optional) Number of Blender processes rendering disjoint frame ranges in parallel, threads are split"
+            " evenly between them. Default is 1."
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--seed",
+        "-s",
+        help=(
+            "(Optional) Random seed of the scene, poses and appearance. Every image only depends on the seed and its"
+            " index, so the output does not depend on --workers. Default is a random seed."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--segmentation",
+        help=(
+            "(Optional) How segmentation masks are made. 'material' renders the scene a second time with a flat"
+            " material, 'passes' writes the mask from the object index pass of the same render (uses Cycles)."
+            " Default is material."
+        ),
+        choices=["material", "passes"],
+        default="material",
+    )
+    parser.add_argument(
+        "--depth",
+        help="(Optional) Also save a depth EXR per image. Requires --segmentation=passes.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--normal",
+        help="(Optional) Also save a normal EXR per image. Requires --segmentation=passes.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-prop-cache",
+        help=(
+            "(Optional) Import props from their .blend files instead of the preprocessed cache in"
+            " <prop-path>/.blendgen_cache/."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lazy-props",
+        help=(
+            "(Optional) Only index the prop directory and load props when they are sampled. For very large prop"
+            " directories. Can not be used with --pool, which creates instances of every prop."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-loaded-props",
+        help="(Optional) With --lazy-props, maximum number of props kept loaded at once. Default is 64.",
+        default=64,
+    )
+    parser.add_argument(
+        "--max-polycount",
+        help="(Optional) With --lazy-props, only sample props with at most this many polygons.",
+        default=None,
+    )
+    parser.add_argument(
+        "--mask-encoding",
+        help=(
+            "(Optional) Colours of the segmentation masks. 'ramp' uses random colours for at most 31 instances, 'id'"
+            " writes the instance id exactly as id = R + 256 * G + 65536 * B and labels/instance_ids.json maps ids"
+            " to props. Ids are Blender's object pass index, so at most 32767 instances (pool members with --pool)."
+            " Default is ramp up to 31 instances, id otherwise."
+        ),
+        choices=["ramp", "id"],
+        default=None,
+    )
+    parser.add_argument(
+        "--lens-range",
+        help="(Optional) Camera focal length in mm is sampled uniformly between MIN and MAX. Default is 50 50.",
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=(50, 50),
+    )
+    parser.add_argument(
+        "--labels",
+        help=(
+            "(Optional) Compute bounding boxes, areas and run-length encoded masks of every instance from the masks"
+            " into labels/labels_*.npz. Requires --mask-encoding=id."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--geometry-labels",
+        help=(
+            "(Optional) Compute 2D boxes, oriented 3D boxes and keypoints of every instance by projecting the prop"
+            " meshes through the camera into labels/labels_*.npz. Needs no extra render."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--async-write",
+        help=(
+            "(Optional) Encode and write images on background threads while the next frame renders. Uses the"
+            " Standard view transform."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--image-format",
+        help="(Optional) With --async-write, format of images and masks: png, npy or exr. Default is png.",
+        choices=["png", "npy", "exr"],
+        default="png",
+    )
+    parser.add_argument(
+        "--compress-level",
+        help="(Optional) With --async-write, PNG compression level from 0 (none) to 9. Default is 1.",
+        default=1,
+    )
+    parser.add_argument(
+        "--writer-threads",
+        help="(Optional) With --async-write, number of threads encoding images. Default is 4.",
+        default=4,
+    )
+    parser.add_argument(
+        "--max-pending",
+        help="(Optional) With --async-write, images queued before rendering waits for the writer. Default is 8.",
+        default=8,
+    )
+    parser.add_argument(
+        "--output-format",
+        help=(
+            "(Optional) 'files' writes one image and mask file per frame, 'shards' packs images and masks into"
+            " memory-mappable .npy shards in renders/ with an index for random access"
+            " (blendgen.dataset.ShardedDataset). Default is files."
+        ),
+        choices=["files", "shards"],
+        default="files",
+    )
+    parser.add_argument(
+        "--shard-size", help="(Optional) With --output-format=shards, frames per shard. Default is 1000.", default=1000
+    )
+    parser.add_argument(
+        "--resume",
+        help=(
+            "(Optional) Continue the run in save-path/save-name with the arguments it was started with. Frames that"
+            " are missing, do not match their checksums in manifest.jsonl or were rendered with other poses are"
+            " rendered again."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        help=(
+            f"(Optional) Render settings, one of {', '.join(RENDER_PROFILES)} or a profile file written by --autotune."
+            " --segmentation=passes always renders with Cycles. Default is the settings of a new scene."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--autotune",
+        help=(
+            "(Optional) Before the run, time a few calibration frames with candidate settings and use the fastest"
+            " that reaches --min-psnr against a high sample Cycles reference. Written to profile.json."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--autotune-frames", help="(Optional) Calibration frames of --autotune. Default is 3.", default=3
+    )
+    parser.add_argument(
+        "--min-psnr",
+        help="(Optional) Lowest PSNR in dB of any calibration frame accepted by --autotune. Default is 30.",
+        default=30.0,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help=(
+            "(Optional) Keyframe the poses of this many consecutive frames and render them with one animation render,"
+            " which saves the per-frame overhead of render calls. Not with --async-write or --output-format=shards."
+            " Default is 0 (one render call per frame)."
+        ),
+        default=0,
+    )
+    parser.add_argument(
+        "--layout",
+        help=(
+            "(Optional) Placement of the instances. 'grid' is a regular cubic lattice, 'random' places them at random"
+            " positions without overlap, 'ground' does the same on a ground plane with the camera above it."
+            " Default is grid."
+        ),
+        choices=["grid", "random", "ground"],
+        default="grid",
+    )
+    parser.add_argument(
+        "--density",
+        help=(
+            "(Optional) With --layout=random/ground, fraction of the volume (ground area) covered by the instances'"
+            " bounding spheres. Default is 0.2."
+        ),
+        default=0.2,
+    )
+    parser.add_argument(
+        "--scale-range",
+        help="(Optional) With --layout=random/ground, instances are scaled uniformly in [MIN, MAX). Default is 1 1.",
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        default=(1, 1),
+    )
+    parser.add_argument(
+        "--pool",
+        help=(
+            "(Optional) Create a pool of instances of every prop once and show a new random composition of"
+            " n-instances of them in every image, by hiding, showing and moving pool members. Uses"
+            " --mask-encoding=id."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pool-size",
+        help="(Optional) With --pool, instances created per prop. Default is n-instances.",
+        default=None,
+    )
+    parser.add_argument(
+        "--lod",
+        help=(
+            "(Optional) Render props with decimated levels of detail chosen per frame from their projected size,"
+            f" policy {', '.join(LOD_POLICIES)} or a JSON file with \"ratios\" and \"min_pixels\". Levels are cached in"
+            " .blendgen_cache/lod of the prop directory. The level of every instance is recorded as \"lod\" in the"
+            " manifest (not written with --output-format=shards) and, with --labels, in the labels."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--material-variants",
+        help=(
+            "(Optional) Build a pool of this many random materials (colour, roughness, noise texture) once and give"
+            " every prop a variant from it in every image. The variants are recorded in the labels and the manifest."
+            " Default is 0, the props' own materials."
+        ),
+        default=0,
+    )
+    parser.add_argument(
+        "--light-rigs",
+        help=(
+            "(Optional) Build a pool of this many placements of the lights (position, energy, colour) once and use"
+            " one of them in every image, recorded as light_rig. Default is 0, fixed lights."
+        ),
+        default=0,
+    )
+    parser.add_argument(
+        "--visibility-filter",
+        help=(
+            "(Optional) Score every sampled pose from the projected prop meshes before rendering and draw new poses"
+            " for frames where too few props are in the frame, unoccluded and large enough. Policy"
+            f" {', '.join(VISIBILITY_POLICIES)} or a JSON file with its thresholds. Acceptance rates are shown at the"
+            " end of the run."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--fast-start",
+        help=(
+            "(Optional) Workers open a template .blend with the lights, camera, render settings and segmentation"
+            " already in place instead of building the scene. Built on first use in .blendgen_cache/templates of the"
+            " prop directory."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--daemon-port",
+        help=(
+            "(Optional) Port of a BlendGen daemon, a Blender kept running with props loaded that renders jobs"
+            f" without startup cost. Jobs with one worker are sent to it when it is running. Default is {DEFAULT_PORT}."
+        ),
+        default=DEFAULT_PORT,
+    )
+    parser.add_argument(
+        "--no-daemon", help="(Optional) Always start a new Blender, even if a daemon is running.", action="store_true"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help=(
+            "(Optional) Serve frames per second, ETA, per-stage timings, peak memory and bpy.data counts of the run"
+            " as Prometheus text on http://127.0.0.1:PORT/metrics. Every frame is also logged to events.jsonl."
+        ),
+        default=None,
+    )
 
     # Parse arguments
     args = vars(parser.parse_args())
@@ -57,6 +363,47 @@ def main():
     save_name = args["save_name"]
     n_images = int(args["n_images"])
     n_instances = int(args["n_instances"])
+    n_workers = int(args["workers"])
+    seed = int(args["seed"]) if args["seed"] is not None else random.randrange(2**31)
+    segmentation = args["segmentation"]
+    depth = args["depth"]
+    normal = args["normal"]
+    prop_cache = not args["no_prop_cache"]
+    lazy_props = args["lazy_props"]
+    max_loaded_props = int(args["max_loaded_props"])
+    max_polycount = args["max_polycount"]
+    mask_encoding = args["mask_encoding"]
+    lens_range = [float(length) for length in args["lens_range"]]
+    labels = args["labels"]
+    geometry_labels = args["geometry_labels"]
+    async_write = args["async_write"]
+    image_format = args["image_format"]
+    compress_level = int(args["compress_level"])
+    writer_threads = int(args["writer_threads"])
+    max_pending = int(args["max_pending"])
+    output_format = args["output_format"]
+    shard_size = int(args["shard_size"])
+    resume = args["resume"]
+    profile = args["profile"]
+    autotune = args["autotune"]
+    autotune_frames = int(args["autotune_frames"])
+    min_psnr = float(args["min_psnr"])
+    batch_size = int(args["batch_size"])
+    layout = args["layout"]
+    density = float(args["density"])
+    scale_range = [float(scale) for scale in args["scale_range"]]
+    pool = args["pool"]
+    pool_size = args["pool_size"]
+    lod = args["lod"]
+    material_variants = int(args["material_variants"])
+    light_rigs = int(args["light_rigs"])
+    fast_start = args["fast_start"]
+    visibility_filter = args["visibility_filter"]
+    daemon_port = int(args["daemon_port"])
+    use_daemon = not args["no_daemon"]
+    metrics_port = int(args["metrics_port"]) if args["metrics_port"] is not None else None
+    if mask_encoding is None:
+        mask_encoding = "ramp" if n_instances < 31 and not pool else "id"
 
     # Make assertions on arguments
     if os.path.isdir(prop_path):
@@ -69,23 +416,141 @@ def main():
     else:
         print(f"ERROR: save_path is not a directory: {save_path}")
 
-    assert n_instances < 31, "n_instances maximum is 31"
+    assert mask_encoding == "id" or n_instances < 31, "n_instances maximum is 31 with --mask-encoding=ramp"
+    assert n_instances <= MAX_INSTANCE_ID, f"n_instances maximum is {MAX_INSTANCE_ID}"
+    assert n_workers >= 1, "workers minimum is 1"
+    assert segmentation == "passes" or not (depth or normal), "--depth and --normal require --segmentation=passes"
+    assert mask_encoding == "id" or not labels, "--labels requires --mask-encoding=id"
+    assert async_write or image_format == "png", "--image-format requires --async-write"
+    assert 0 <= compress_level <= 9, "compress-level has to be between 0 and 9"
+    assert output_format == "files" or segmentation == "material", "--output-format=shards requires material masks"
+    assert profile is None or profile in RENDER_PROFILES or os.path.isfile(profile), f"no profile {profile}"
+    assert not autotune or segmentation == "material", "--autotune requires --segmentation=material"
+    assert 0 < density < 1, "density has to be between 0 and 1"
+    assert not pool or mask_encoding == "id", "--pool requires --mask-encoding=id"
+    assert not pool or batch_size <= 1, "--pool can not be used with --batch-size"
+    assert not pool or not lazy_props, "--pool loads every prop, it can not be used with --lazy-props"
+    assert lod is None or lod in LOD_POLICIES or os.path.isfile(lod), f"no lod policy {lod}"
+    assert lod is None or batch_size <= 1, "--lod can not be used with --batch-size"
+    assert (
+        visibility_filter is None or visibility_filter in VISIBILITY_POLICIES or os.path.isfile(visibility_filter)
+    ), f"no visibility policy {visibility_filter}"
+    assert material_variants >= 0 and light_rigs >= 0, "material-variants and light-rigs minimum is 0"
+    assert batch_size <= 1 or not (material_variants or light_rigs), "--batch-size can not randomize appearance"
+    assert batch_size <= 1 or not (async_write or output_format == "shards"), "--batch-size writes files with Blender"
 
-    # Create save directories
+    # Create save directories, or continue the run in them
     save_dir_path = os.path.join(save_path, save_name)
     renders_path = os.path.join(save_dir_path, "renders")
     labels_path = os.path.join(save_dir_path, "labels")
-    os.mkdir(save_dir_path)
-    os.mkdir(renders_path)
-    os.mkdir(labels_path)
+    if resume:
+        if not os.path.isfile(os.path.join(save_dir_path, RUN_NAME)):
+            print(f"ERROR: no run to resume in {save_dir_path}")
+            quit()
+    elif os.path.exists(save_dir_path):
+        print(f"ERROR: {save_dir_path} already exists, use --resume to continue the run in it")
+        quit()
+    else:
+        os.mkdir(save_dir_path)
+        os.mkdir(renders_path)
+        os.mkdir(labels_path)
+
+    # Options passed on to main_blender.py
+    options = ["--segmentation", segmentation, "--mask-encoding", mask_encoding]
+    options += ["--lens-range", str(lens_range[0]), str(lens_range[1])]
+    if labels:
+        options.append("--labels")
+    if geometry_labels:
+        options.append("--geometry-labels")
+    if async_write:
+        options += ["--async-write", "--image-format", image_format, "--compress-level", str(compress_level)]
+        options += ["--writer-threads", str(writer_threads), "--max-pending", str(max_pending)]
+    if output_format == "shards":
+        options += ["--output-format", "shards", "--shard-size", str(shard_size)]
+    if batch_size > 1:
+        options += ["--batch-size", str(batch_size)]
+    if pool:
+        options.append("--pool")
+        if pool_size is not None:
+            options += ["--pool-size", str(int(pool_size))]
+    if material_variants > 0:
+        options += ["--material-variants", str(material_variants)]
+    if light_rigs > 0:
+        options += ["--light-rigs", str(light_rigs)]
+    if visibility_filter is not None:
+        path = os.path.realpath(visibility_filter)
+        options += ["--visibility-filter", path if os.path.isfile(visibility_filter) else visibility_filter]
+    if lod is not None:
+        options += ["--lod", os.path.realpath(lod) if os.path.isfile(lod) else lod]
+    if layout != "grid":
+        options += ["--layout", layout, "--density", str(density)]
+        options += ["--scale-range", str(scale_range[0]), str(scale_range[1])]
+    if depth:
+        options.append("--depth")
+    if normal:
+        options.append("--normal")
+    if not prop_cache:
+        options.append("--no-prop-cache")
+    if lazy_props:
+        options += ["--lazy-props", "--max-loaded-props", str(max_loaded_props)]
+        if max_polycount is not None:
+            options += ["--max-polycount", str(int(max_polycount))]
+
+    # Resumed runs use the arguments of the first run, so they produce the same frames
+    if resume:
+        run = load_run(save_dir_path)
+        assert run["output_format"] == "files", "--resume requires --output-format=files"
+        prop_path, n_images, n_instances = run["prop_path"], run["n_images"], run["n_instances"]
+        seed = run["seed"]
+        options = run["options"] + ["--resume"]
+    else:
+        if autotune:
+            # Calibration run, writes profile.json to the save directory
+            command = blender_command(prop_path, save_dir_path, autotune_frames, n_instances, "--seed", seed, *options)
+            if subprocess.run(command + ["--autotune", "--min-psnr", str(min_psnr)]).returncode != 0:
+                print("ERROR: --autotune failed")
+                quit()
+            profile = os.path.join(save_dir_path, "profile.json")
+        if profile is not None:
+            options += ["--profile", os.path.realpath(profile) if os.path.isfile(profile) else profile]
+        run = {"prop_path": prop_path, "n_images": n_images, "n_instances": n_instances, "seed": seed}
+        save_run(save_dir_path, {**run, "output_format": output_format, "options": options})
+
+    # Render in the running daemon
+    if n_workers == 1 and use_daemon and daemon_running(daemon_port):
+        exit_code = run_in_daemon(
+            prop_path,
+            save_dir_path,
+            n_images,
+            n_instances,
+            seed,
+            *options,
+            port=daemon_port,
+            metrics_port=metrics_port,
+        )
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    # Template scene opened by every worker, built once for the scene settings
+    template = None
+    if fast_start:
+        template = template_path(prop_path, template_key(n_instances, **scene_settings(options)))
+        if not os.path.isfile(template) and build_template(template, n_instances, *options) != 0:
+            quit()
 
-    # Launch Blender
-    command = (
-        f"blender --background --python {MAIN_BLENDER_PATH}         --"
-        f" {prop_path} {save_dir_path} {n_images} {n_instances}"
+    # Launch Blender workers, also a single one so its events are merged here
+    exit_code = run_workers(
+        prop_path,
+        save_dir_path,
+        n_images,
+        n_instances,
+        n_workers,
+        seed,
+        *options,
+        metrics_port=metrics_port,
+        template=template,
     )
-    subprocess.run(command, shell=True)
-    # subprocess.run(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 
@@ -5,18 +6,157 @@ DIR_THIS_FILE = os.path.dirname(os.path.abspath(__file__))
 if DIR_THIS_FILE not in sys.path:
     sys.path.append(DIR_THIS_FILE)
 
+import bpy  # noqa: E402 I001
+
 import blendgen  # noqa: E402 I001
+from blendgen.daemon import DEFAULT_PORT, serve  # noqa: E402 I001
+from blendgen.generate import build_template, load_props  # noqa: E402 I001
+from blendgen.launch import scene_settings  # noqa: E402 I001
+from blendgen.utils import removeScene  # noqa: E402 I001
 
 
 def main():
     # Get all arguments after --
     argv = sys.argv[sys.argv.index("--") + 1 :]
-    prop_path = argv[0]
-    save_path = argv[1]
-    n_images = int(argv[2])
-    n_instances = int(argv[3])
 
-    blendgen.generate(prop_path, save_path, n_images, n_instances)
+    if argv and argv[0] == "--daemon":
+        run_daemon(argv[1:])
+    elif argv and argv[0] == "--build-template":
+        run_build_template(argv[1:])
+    else:
+        run_job(argv)
+
+
+def run_daemon(argv):
+    """Keeps this Blender running and renders the jobs sent by the blendgen CLI, see blendgen/daemon.py."""
+    parser = argparse.ArgumentParser(prog="main_blender.py --daemon")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--preload", nargs="*", default=[], help="Prop paths imported before the first job.")
+    args = parser.parse_args(argv)
+
+    # Imported props stay in bpy.data between jobs
+    session = {}
+    for prop_path in args.preload:
+        load_props(os.path.realpath(prop_path), session=session)
+    base_scene = bpy.context.scene
+
+    def daemon_job(job_argv):
+        try:
+            run_job(job_argv, session=session)
+        finally:
+            # Every job builds its scene from scratch, remove it but keep the props
+            scene = bpy.context.scene
+            if scene != base_scene:
+                if bpy.context.window is not None:
+                    bpy.context.window.scene = base_scene
+                removeScene(scene)
+
+    serve(daemon_job, port=args.port)
+
+
+def run_build_template(argv):
+    """Saves the template scene of jobs with the options after path and n_instances, see launch.build_template."""
+    path, n_instances = argv[0], int(argv[1])
+    build_template(path, n_instances, **scene_settings(argv[2:]))
+
+
+def run_job(argv, session=None):
+    parser = argparse.ArgumentParser(prog="main_blender.py")
+    parser.add_argument("prop_path")
+    parser.add_argument("save_path")
+    parser.add_argument("n_images", type=int)
+    parser.add_argument("n_instances", type=int)
+    parser.add_argument("--frame-start", type=int, default=0)
+    parser.add_argument("--frame-end", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--scene-seed", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--segmentation", choices=["material", "passes"], default="material")
+    parser.add_argument("--depth", action="store_true")
+    parser.add_argument("--normal", action="store_true")
+    parser.add_argument("--no-prop-cache", action="store_true")
+    parser.add_argument("--lazy-props", action="store_true")
+    parser.add_argument("--max-loaded-props", type=int, default=64)
+    parser.add_argument("--max-polycount", type=int, default=None)
+    parser.add_argument("--mask-encoding", choices=["ramp", "id"], default="ramp")
+    parser.add_argument("--lens-range", type=float, nargs=2, default=(50, 50))
+    parser.add_argument("--labels", action="store_true")
+    parser.add_argument("--geometry-labels", action="store_true")
+    parser.add_argument("--async-write", action="store_true")
+    parser.add_argument("--image-format", choices=["png", "npy", "exr"], default="png")
+    parser.add_argument("--compress-level", type=int, default=1)
+    parser.add_argument("--writer-threads", type=int, default=4)
+    parser.add_argument("--max-pending", type=int, default=8)
+    parser.add_argument("--output-format", choices=["files", "shards"], default="files")
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--profile", default=None)
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--min-psnr", type=float, default=30.0)
+    parser.add_argument("--batch-size", type=int, default=0)
+    parser.add_argument("--layout", choices=["grid", "random", "ground"], default="grid")
+    parser.add_argument("--density", type=float, default=0.2)
+    parser.add_argument("--scale-range", type=float, nargs=2, default=(1, 1))
+    parser.add_argument("--pool", action="store_true")
+    parser.add_argument("--pool-size", type=int, default=None)
+    parser.add_argument("--stream-port", type=int, default=None)
+    parser.add_argument("--stream-chunk", type=int, default=64)
+    parser.add_argument("--stream-stride", type=int, default=None)
+    parser.add_argument("--lod", default=None)
+    parser.add_argument("--material-variants", type=int, default=0)
+    parser.add_argument("--light-rigs", type=int, default=0)
+    parser.add_argument("--visibility-filter", default=None)
+    args = parser.parse_args(argv)
+
+    blendgen.generate(
+        args.prop_path,
+        args.save_path,
+        args.n_images,
+        args.n_instances,
+        frame_start=args.frame_start,
+        frame_end=args.frame_end,
+        seed=args.seed,
+        scene_seed=args.scene_seed,
+        threads=args.threads,
+        worker=args.worker,
+        segmentation=args.segmentation,
+        depth=args.depth,
+        normal=args.normal,
+        prop_cache=not args.no_prop_cache,
+        lazy_props=args.lazy_props,
+        max_loaded_props=args.max_loaded_props,
+        max_polycount=args.max_polycount,
+        mask_encoding=args.mask_encoding,
+        lens_range=tuple(args.lens_range),
+        labels=args.labels,
+        geometry_labels=args.geometry_labels,
+        async_write=args.async_write,
+        image_format=args.image_format,
+        compress_level=args.compress_level,
+        writer_threads=args.writer_threads,
+        max_pending=args.max_pending,
+        output_format=args.output_format,
+        shard_size=args.shard_size,
+        resume=args.resume,
+        profile=args.profile,
+        autotune=args.autotune,
+        min_psnr=args.min_psnr,
+        batch_size=args.batch_size,
+        layout=args.layout,
+        density=args.density,
+        scale_range=tuple(args.scale_range),
+        pool=args.pool,
+        pool_size=args.pool_size,
+        session=session,
+        stream_port=args.stream_port,
+        stream_chunk=args.stream_chunk,
+        stream_stride=args.stream_stride,
+        lod=args.lod,
+        material_variants=args.material_variants,
+        light_rigs=args.light_rigs,
+        visibility=args.visibility_filter,
+    )
 
 
 def load_prop_paths(prop_dir_path):
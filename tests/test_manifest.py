@@ -0,0 +1,79 @@
+import numpy as np
+
+from blendgen.manifest import Manifest, file_checksum, finished_frames, load_manifest, pose_hash
+from blendgen.writer import AsyncImageWriter
+
+
+def test_writer_and_external_paths(tmp_path):
+    """Frames with files from the writer and files written by Blender, as with --async-write --segmentation=passes."""
+    save_path = str(tmp_path)
+    writer = AsyncImageWriter("png", n_threads=2, max_pending=2)
+    manifest = Manifest(save_path, seed=7, checksums=writer.checksums)
+
+    pixels = np.random.default_rng(0).random((8, 6, 4), dtype=np.float32)
+    for frame in range(3):
+        image = writer.submit(frame, "image", f"{save_path}/render{frame}", pixels)
+        external = [f"{save_path}/render{frame}_segmentation.png", f"{save_path}/render{frame}_depth.exr"]
+        for path in external:
+            with open(path, "wb") as f:
+                f.write(bytes([frame]) * (frame + 1))
+        manifest.add(frame, [image], external, camera_location=[0.0, 0.0, frame])
+
+    writer.close()
+    manifest.close()
+    assert not manifest.pending
+    assert not writer.checksums
+
+    entries = load_manifest(save_path)
+    assert sorted(entries) == [0, 1, 2]
+    for frame, entry in entries.items():
+        assert entry["seed"] == 7
+        assert entry["camera_location"] == [0.0, 0.0, frame]
+        names = {f"render{frame}.png", f"render{frame}_segmentation.png", f"render{frame}_depth.exr"}
+        assert set(entry["files"]) == names
+        for name, checksum in entry["files"].items():
+            assert tuple(checksum) == file_checksum(f"{save_path}/{name}")
+    assert finished_frames(save_path, range(3)) == [0, 1, 2]
+
+    # A changed external file is rendered again
+    with open(f"{save_path}/render1_depth.exr", "wb") as f:
+        f.write(b"changed")
+    assert finished_frames(save_path, range(3)) == [0, 2]
+
+
+def test_waits_for_writer_paths(tmp_path):
+    """A frame is only written once the checksums of all its writer paths are in."""
+    save_path = str(tmp_path)
+    checksums = {}
+    manifest = Manifest(save_path, seed=0, checksums=checksums)
+    external = f"{save_path}/mask.png"
+    with open(external, "wb") as f:
+        f.write(b"mask")
+
+    manifest.add(0, [f"{save_path}/image.png"], [external])
+    assert len(manifest.pending) == 1
+    assert load_manifest(save_path) == {}
+
+    checksums[f"{save_path}/image.png"] = (1, 2)
+    manifest.close()
+    assert load_manifest(save_path)[0]["files"] == {"image.png": [1, 2], "mask.png": list(file_checksum(external))}
+
+
+def test_resume_checks_poses(tmp_path):
+    """Frames recorded with other prop poses are rendered again."""
+    save_path = str(tmp_path)
+    rng = np.random.default_rng(0)
+    poses = {"frame": np.arange(2), "camera_location": rng.random((2, 3)), "prop_rotation": rng.random((2, 5, 4))}
+    manifest = Manifest(save_path, seed=0)
+    for frame in range(2):
+        path = f"{save_path}/render{frame}.png"
+        with open(path, "wb") as f:
+            f.write(b"image")
+        manifest.add(frame, [path], pose_sha1=pose_hash(poses, frame))
+    manifest.close()
+
+    hashes = {frame: pose_hash(poses, frame) for frame in range(2)}
+    assert finished_frames(save_path, range(2), pose_hashes=hashes) == [0, 1]
+    poses["prop_rotation"][1, 3] = 0
+    hashes = {frame: pose_hash(poses, frame) for frame in range(2)}
+    assert finished_frames(save_path, range(2), pose_hashes=hashes) == [0]
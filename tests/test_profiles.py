@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+from blendgen.profiles import FLAT_SEGMENTATION, RENDER_PROFILES, apply_profile, read_profile, swap_profile
+
+
+def make_scene():
+    shading = SimpleNamespace(
+        light="MATCAP",
+        color_type="SINGLE",
+        show_object_outline=True,
+        show_shadows=True,
+        show_cavity=True,
+        show_specular_highlight=True,
+    )
+    return SimpleNamespace(
+        render=SimpleNamespace(engine="CYCLES"), display=SimpleNamespace(shading=shading, render_aa="32")
+    )
+
+
+def test_colour_render_keeps_profile_shading():
+    """The mask render swaps in flat shading, the colour renders before and after it keep the profile's."""
+    scene = make_scene()
+    profile = RENDER_PROFILES["draft"]
+    apply_profile(scene, profile)
+    for _ in range(2):
+        assert read_profile(scene, profile) == profile
+        old = swap_profile(scene, FLAT_SEGMENTATION)
+        assert read_profile(scene, FLAT_SEGMENTATION) == FLAT_SEGMENTATION
+        apply_profile(scene, old)
+    assert read_profile(scene, profile) == profile
+    assert scene.display.shading.show_shadows